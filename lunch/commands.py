@@ -28,7 +28,11 @@ Author: Alexandre Quessy <alexandre@quessy.net>
 """
 import os
 import stat
+import hashlib
+import json
+import pipes
 import time
+import collections
 import logging
 import warnings
 
@@ -43,13 +47,22 @@ from twisted.python import failure
 from twisted.python import logfile
 from twisted.python import procutils
 
+from lunch import framing
 from lunch import sig
+from lunch import socketslave
 from lunch import graph
 from lunch.states import *
 from lunch import logger
 
 log = logger.start(name='commands')
 
+# Version 1: "key arguments" text lines. 
+# Version 2: the arguments of the lines are JSON objects, and a single "start" line sets up and runs the child.
+# The lunch-slave tells its version in its "ready" line. The older ones send no version.
+PROTOCOL_VERSION = 2
+RECENT_OUTPUT_LINES = 1000 # how many lines of the output of the child a command keeps
+MAXIMUM_SOCKET_PATH_LENGTH = 100 # A bit less than the size of sun_path, since SSH adds a suffix to the temporary socket.
+
 def run_and_wait(executable, *arguments):
     """
     Runs a command and trigger its deferred with the output when done.
@@ -72,6 +85,224 @@ def run_and_wait(executable, *arguments):
     d.addErrback(eb, executable, list(arguments))
     return d
 
+def get_slave_command_line(host=None, user=None, ssh_port=None, arguments=None, ssh_options=None, use_pty=True):
+    """
+    Returns the command line to start a lunch-slave, through SSH if a host is given.
+    @param arguments: list of arguments for the lunch-slave.
+    @param ssh_options: list of options for SSH, such as the ones of L{SSHConnectionPool.prepare}.
+    @param use_pty: If False, SSH does not allocate a pseudo-terminal on the remote host, and does not ask for passwords.
+    @rtype: C{list}
+    """
+    if host is None:
+        # TODO: Set gid if user is not None...
+        ret = []
+    else:
+        ret = ["ssh"]
+        if not use_pty:
+            ret.extend(["-T", "-o", "BatchMode=yes"])
+        if ssh_options is not None:
+            ret.extend(ssh_options)
+        if ssh_port is not None:
+            ret.extend(["-p", str(ssh_port)])
+        if user is not None:
+            ret.extend(["-l", user])
+        ret.append(host)
+        # I hope you put your SSH key on the remote host !
+        # FIXME: we should pop-up a terminal if keys are not set up.
+    ret.append("lunch-slave")
+    if arguments is not None:
+        ret.extend(arguments)
+    return ret
+
+def spawn_slave_process(process_protocol, args, environ, use_pty=True):
+    """
+    Spawns a lunch-slave process, or SSH, as given by get_slave_command_line.
+    Raises a RuntimeError if the executable is not found.
+    @param args: Command line, starting with the executable.
+    @param use_pty: Whether to connect to it through a pseudo-terminal, or pipes.
+    @return: The transport of the process.
+    """
+    try:
+        proc_path = procutils.which(args[0])[0]
+    except IndexError:
+        raise RuntimeError("Could not find path of executable %s." % (args[0]))
+    return reactor.spawnProcess(process_protocol, proc_path, [proc_path] + args[1:], environ, usePTY=use_pty)
+
+class RoundTripTimes(object):
+    """
+    Statistics of the round-trip times of the heartbeats of a lunch-slave.
+
+    Keeps the last one, an exponentially weighted moving average, and the
+    last SAMPLES ones to compute percentiles.
+    """
+    SAMPLES = 100 # how many of the last round-trip times are kept
+    EWMA_WEIGHT = 0.125 # weight of each new round-trip time in the average, as in TCP
+
+    def __init__(self):
+        self.last = None # seconds
+        self.ewma = None # seconds
+        self.count = 0 # how many round-trip times were measured
+        self.timeouts = 0 # how many heartbeats had no answer in time
+        self._samples = collections.deque(maxlen=self.SAMPLES)
+
+    def add(self, rtt):
+        """
+        Adds a round-trip time, in seconds.
+        """
+        self.last = rtt
+        if self.ewma is None:
+            self.ewma = rtt
+        else:
+            self.ewma += self.EWMA_WEIGHT * (rtt - self.ewma)
+        self.count += 1
+        self._samples.append(rtt)
+
+    def get_percentile(self, percent):
+        """
+        Returns the given percentile of the last round-trip times, or None if there is none.
+        """
+        if len(self._samples) == 0:
+            return None
+        samples = sorted(self._samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def get_statistics(self):
+        """
+        @rtype: C{dict}
+        """
+        return {
+            "last": self.last,
+            "ewma": self.ewma,
+            "p99": self.get_percentile(99),
+            "count": self.count,
+            "timeouts": self.timeouts,
+            }
+
+class SSHConnectionPool(object):
+    """
+    Keeps one SSH connection to each remote host, shared by all its lunch-slaves.
+
+    It relies on the ControlMaster feature of OpenSSH: the first ssh process
+    for a host, user and port creates a control socket, and the next ones 
+    send their session through it, instead of connecting and authenticating 
+    again. The master connection stays in the background for persist seconds
+    once its last session is closed, and is closed by L{close_all}.
+
+    Starting a lunch-slave when the control socket exists is a hit. Otherwise,
+    it is a miss. The time between the spawning of the lunch-slave and its
+    "ready" message is its setup time.
+    """
+    def __init__(self, directory=None, persist=600, ssh_executable="ssh"):
+        """
+        @param directory: Where to create the control sockets. Defaults to a directory of the user in /tmp.
+        @param persist: How long a master connection stays open once it is not used anymore, in seconds.
+        @param ssh_executable: Name or path of the ssh executable.
+        """
+        if directory is None:
+            directory = os.path.join("/tmp", "lunch-ssh-%d" % (os.getuid()))
+        self.directory = directory
+        self.persist = persist
+        self.ssh_executable = ssh_executable
+        self.keys = set() # (host, user, ssh_port) tuples we created control sockets for.
+        self.statistics = {
+            "hits": 0, # lunch-slaves started through an existing connection
+            "misses": 0, # lunch-slaves which had to create the connection
+            "hit_setup_time": 0.0, # total setup time of the hits, in seconds
+            "miss_setup_time": 0.0, # total setup time of the misses, in seconds
+            }
+
+    def get_control_path(self, host, user=None, ssh_port=None):
+        """
+        Returns the path to the control socket for a host, user and port.
+        """
+        name = "%s@%s:%s" % (user or "", host, ssh_port or 22)
+        path = os.path.join(self.directory, name)
+        if len(path) > MAXIMUM_SOCKET_PATH_LENGTH:
+            path = os.path.join(self.directory, hashlib.md5(name).hexdigest())
+        return path
+
+    def is_connected(self, host, user=None, ssh_port=None):
+        """
+        Checks if there is a control socket for a host, user and port.
+        """
+        return os.path.exists(self.get_control_path(host, user, ssh_port))
+
+    def prepare(self, host, user=None, ssh_port=None):
+        """
+        To be called just before spawning an ssh process for a host. 
+        Counts a hit or a miss, and returns the options to give to SSH.
+        @return: list of SSH options, and whether it is a hit.
+        @rtype: C{tuple}
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError, e:
+                log.error("Could not create the directory for the SSH control sockets: %s" % (e))
+        hit = self.is_connected(host, user, ssh_port)
+        if hit:
+            self.statistics["hits"] += 1
+        else:
+            self.statistics["misses"] += 1
+        self.keys.add((host, user, ssh_port))
+        options = [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % (self.get_control_path(host, user, ssh_port)),
+            "-o", "ControlPersist=%d" % (self.persist),
+            ]
+        return options, hit
+
+    def record_setup_time(self, hit, duration):
+        """
+        To be called when a lunch-slave spawned after L{prepare} is ready.
+        @param hit: What L{prepare} returned.
+        @param duration: Time from the spawning until it is ready, in seconds.
+        """
+        if hit:
+            self.statistics["hit_setup_time"] += duration
+        else:
+            self.statistics["miss_setup_time"] += duration
+
+    def get_statistics(self):
+        """
+        Returns the hits, misses, and the average setup time of each.
+        @rtype: C{dict}
+        """
+        ret = dict(self.statistics)
+        for key, count in [("hit", self.statistics["hits"]), ("miss", self.statistics["misses"])]:
+            ret["mean_%s_setup_time" % (key)] = 0.0
+            if count != 0:
+                ret["mean_%s_setup_time" % (key)] = self.statistics["%s_setup_time" % (key)] / count
+        return ret
+
+    def close_all(self):
+        """
+        Asks each master connection to exit, with "ssh -O exit".
+        @rtype: L{twisted.internet.defer.DeferredList}
+        """
+        deferreds = []
+        try:
+            executable = procutils.which(self.ssh_executable)[0]
+        except IndexError:
+            log.error("Could not find executable %s to close the SSH connections." % (self.ssh_executable))
+            return defer.DeferredList([])
+        for host, user, ssh_port in sorted(self.keys):
+            if not self.is_connected(host, user, ssh_port):
+                continue
+            args = ["-O", "exit", "-o", "ControlPath=%s" % (self.get_control_path(host, user, ssh_port))]
+            if ssh_port is not None:
+                args.extend(["-p", str(ssh_port)])
+            if user is not None:
+                args.extend(["-l", user])
+            args.append(host)
+            log.info("Closing the SSH connection to %s: $ ssh %s" % (host, " ".join(args)))
+            d = utils.getProcessOutputAndValue(executable, args, env=os.environ)
+            d.addErrback(lambda reason: log.error("Error closing an SSH connection: %s" % (reason.getErrorMessage())))
+            deferreds.append(d)
+        self.keys = set()
+        return defer.DeferredList(deferreds)
+
 class SlaveProcessProtocol(protocol.ProcessProtocol):
     """
     Process of a lunch-slave. (through SSH, or directly bash)
@@ -83,6 +314,8 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
         @param command: L{Command} instance.
         """
         self.command = command
+        self._out_framer = framing.LineFramer(self._received_lines)
+        self._err_framer = framing.LineFramer(self._received_error_lines)
 
     def connectionMade(self):
         """
@@ -96,9 +329,12 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
 
         Twisted will not splitlines, it gives an arbitrary amount of
         data at a time. This way, our manager only gets one line at 
-        a time.
+        a time. The end of the data is kept until its line is complete.
         """
-        for line in data.splitlines():
+        self._out_framer.feed(data)
+
+    def _received_lines(self, lines):
+        for line in lines:
             if line != "":
                 self.command._received_message(line)
 
@@ -106,9 +342,12 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
         """
         Called when text is received from the lunch-slave process stderr
         """
-        for line in data.splitlines().strip():
-            if line != "":
-                log.debug("stderr: " + line + "\n")
+        self._err_framer.feed(data)
+
+    def _received_error_lines(self, lines):
+        for line in lines:
+            if line.strip() != "":
+                self.command._received_error(line)
 
     def processEnded(self, reason):
         """
@@ -162,7 +401,7 @@ class Command(object):
     #TODO: move send_* and recv_* methods to the SlaveProcessProtocol.
     #TODO: add wait_returned attribute. (commands after which we should wait them to end before calling next)
     
-    def __init__(self, command=None, identifier=None, env=None, user=None, host=None, order=None, sleep_after=0.25, respawn=True, minimum_lifetime_to_respawn=0.5, log_dir=None, depends=None, verbose=False, try_again_delay=0.25, give_up_after=0, enabled=None, delay_before_kill=8.0, ssh_port=None):
+    def __init__(self, command=None, identifier=None, env=None, user=None, host=None, order=None, sleep_after=0.25, respawn=True, minimum_lifetime_to_respawn=0.5, log_dir=None, depends=None, verbose=False, try_again_delay=0.25, give_up_after=0, enabled=None, delay_before_kill=8.0, ssh_port=None, clock=None, use_pty=True, heartbeat_interval=0.0, heartbeat_timeout=None, slave_address=None, reattach=False, slave_options=None):
         """
         @param command: Shell string. The first item is the name of the name of the executable.
         @param depends: Commands to which this command depends on. List of strings.
@@ -196,6 +435,19 @@ class Command(object):
         @type try_again_delay: C{float}
         @param give_up_after: How many times to try again before giving up.
         @type give_up_after: C{int}
+        @param clock: Provider of twisted.internet.interfaces.IReactorTime. Defaults to the reactor. Should be the same as the one of the master.
+        @param use_pty: If False, the lunch-slave is connected with pipes, instead of a pseudo-terminal, and SSH is started with -T. It then does not echo what we send to it.
+        @type use_pty: C{bool}
+        @param heartbeat_interval: Time between each ping sent to the lunch-slave once it is ready. 0 disables the heartbeats.
+        @type heartbeat_interval: C{float}
+        @param heartbeat_timeout: Time after which a ping without answer means the lunch-slave, or its SSH connection, is dead. It is then killed. Defaults to three times the interval.
+        @type heartbeat_timeout: C{float}
+        @param slave_address: Address of a lunch-slave daemon to connect to, instead of spawning a lunch-slave. "unix:/path/to/socket", "tcp:port" or "tcp:host:port". If a host is given, the address is on that host, and we connect to it through SSH and "lunch-slave --proxy".
+        @type slave_address: C{str}
+        @param reattach: If True, first asks the lunch-slave daemon for the child it kept running after we lost our connection to it. (see its --grace option) Only used with a slave_address.
+        @type reattach: C{bool}
+        @param slave_options: Options of the lunch-slave, sent as they are with the command of the child, such as {"direct_exec": True, "use_pty": False, "log_generations": 5}. Only those are sent, so the lunch-slave keeps its defaults for the others. (see the "opts" command of lunch-slave and its manual) Its "use_pty" option is about the child, not about the lunch-slave. With "forward_output", the lines of the child are also written to "forwarded-<identifier>.log" in the log directory, and given to the output_received_signal.
+        @type slave_options: C{dict}
         """
         self.command = command
         self.identifier = identifier
@@ -205,6 +457,19 @@ class Command(object):
         self.user = user
         self.host = host
         self.ssh_port = ssh_port
+        self.use_pty = use_pty
+        self.slave_address = slave_address
+        self.reattach = reattach
+        self.slave_options = {} # dict of lunch-slave options given with its child
+        if slave_options is not None:
+            self.slave_options.update(slave_options)
+        self.output_lines_dropped = 0 # lines of the child that the lunch-slave could not forward to us
+        self._attach_sent = False # True once we asked the lunch-slave daemon for our child
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.round_trip_times = RoundTripTimes()
+        self._heartbeat_call = None # DelayedCall for the next heartbeat.
+        self._ping_sent_time = None # when the ping waiting for its pong was sent.
         self.order = order
         self.sleep_after = sleep_after
         self.respawn = respawn
@@ -226,9 +491,19 @@ class Command(object):
         self._current_try_again_delay = try_again_delay # doubles up each time we try
         self._next_try_time = 0
         self._received_ready = False
+        self.protocol_version = 1 # of the protocol spoken with the lunch-slave. Known once it is ready.
+        self._is_starting = False # True from when we start it until the child is running, or failed to.
         self._previous_launching_time = 0
         self.give_up_after = give_up_after # 0 means infinity of times
         self.minimum_lifetime_to_respawn = minimum_lifetime_to_respawn #FIXME: rename
+        self.clock = clock # IReactorTime provider, such as the reactor or a twisted.internet.task.Clock.
+        if clock is None:
+            self.clock = reactor
+        self.slave_pool = None # L{lunch.multislave.SlavePool} if its child is managed by a lunch-slave shared with other commands. Set by the master.
+        self.ssh_pool = None # L{SSHConnectionPool} if its SSH connection is shared with other commands. Set by the master.
+        self.warm_pool = None # L{lunch.warmpool.WarmSlavePool} if it can take a lunch-slave started in advance. Set by the master.
+        self._must_send_identifier = False # True if its lunch-slave was not started with our identifier, such as from the warm_pool.
+        self._ssh_pool_hit = None # Whether the last lunch-slave was started through an existing SSH connection. None if not measured.
         self._quit_slave_deferred = None
         if log_dir is None:
             log_dir = "/var/tmp/lunch"# XXX Overriding the child's log dir.
@@ -245,6 +520,10 @@ class Command(object):
         self.child_pid_changed_signal = sig.Signal() # params: self, new_pid
         self.command_not_found_signal = sig.Signal() # params: self, command
         self.ssh_error_signal = sig.Signal() # params: self, error_message
+        self.heartbeat_timeout_signal = sig.Signal() # params: self
+        self.output_received_signal = sig.Signal() # params: self, list of lines
+        self.recent_output = collections.deque(maxlen=RECENT_OUTPUT_LINES) # lines of the child received with request_tail
+        self._following_output = False # True if the lunch-slave must send us the lines of the child as they come
         if command is None:
             raise RuntimeError("You must provide a command to be run.")
         log.info("Creating command %s ($ %s) on %s@%s" % (self.identifier, self.command, self.user, self.host))
@@ -254,16 +533,39 @@ class Command(object):
         # Some attributes might be changed by the master, namely identifier and host.
         # That's why we sait until start() is called to initiate the slave_logger.
         self.slave_logger = None
+        self.forwarded_logger = None # log file of the lines forwarded by the lunch-slave, if its forward_output option is set
         self.child_pid = None
+        if slave_address is not None:
+            socketslave.parse_address(slave_address) # raises a ValueError if it is invalid
 
-    def is_ready_to_be_started(self):
-        # self.enabled
-        ret = self._next_try_time <= time.time() and self.child_state == STATE_STOPPED
+    def is_ready_to_be_started(self, now=None):
+        """
+        Checks if the child is stopped, and if we are not waiting before trying to start it again.
+        @param now: Current time. If None, it is read from the clock.
+        @rtype: C{bool}
+        """
+        if now is None:
+            now = self.clock.seconds()
+        ret = self._next_try_time <= now and self.child_state == STATE_STOPPED
         if ret and self.slave_state == STATE_RUNNING:
             if not self._received_ready:
                 # log.debug("Not ready to start child %s since we did not receive the ready message." % (self))
                 ret = False
         return ret
+
+    def get_next_try_time(self):
+        """
+        Returns the time before which we should not try to start it again, after it crashed.
+        @rtype: C{float}
+        """
+        return self._next_try_time
+
+    def is_starting(self):
+        """
+        Checks if we asked to start the child, and it is not running yet, nor failed to start.
+        @rtype: C{bool}
+        """
+        return self._is_starting
     
     def _start_logger(self):
         """
@@ -278,6 +580,8 @@ class Command(object):
                 except OSError, e:
                     raise RuntimeError("You need to be able to write in the current working directory in order to write log files. %s" % (e))
             self.slave_logger = logfile.LogFile(slave_log_file, self.slave_log_dir)
+        if self.slave_options.get("forward_output") and self.forwarded_logger is None:
+            self.forwarded_logger = logfile.LogFile("forwarded-%s.log" % (self.identifier), self.slave_log_dir)
     
     def start(self):
         """
@@ -311,47 +615,70 @@ class Command(object):
                 # --------------- start the lunch-slave, and then its child
                 self.number_of_lines_received_from_slave = 0
                 self._received_ready = False
-                if self.host is None:
-                    # if self.user is not None:
-                        # TODO: Set gid if user is not None...
-                    is_remote = False # not using SSH
-                    _command = ["lunch-slave", "--id", self.identifier]
-                else:
+                self.protocol_version = 1
+                self._attach_sent = False
+                arguments = ["--id", self.identifier]
+                if self.slave_address is not None:
+                    self.log("We will connect to the lunch-slave at %s" % (self.slave_address))
+                    if self.host is not None:
+                        arguments = ["--proxy", self.slave_address]
+                if self.host is not None:
                     self.log("We will use SSH since host is %s" % (self.host))
-                    is_remote = True # using SSH
-                    _command = ["ssh"]
-                    if self.ssh_port is not None:
-                        _command.extend(["-p", str(self.ssh_port)])
-                    if self.user is not None:
-                        _command.extend(["-l", self.user])
-                    _command.extend([self.host])
-                    _command.extend(["lunch-slave", "--id", self.identifier])
-                    # I hope you put your SSH key on the remote host !
-                    # FIXME: we should pop-up a terminal if keys are not set up.
-                try:
-                    _command[0] = procutils.which(_command[0])[0]
-                except IndexError:
-                    raise RuntimeError("Could not find path of executable %s." % (_command[0]))
+                ssh_options = None
+                self._ssh_pool_hit = None
+                if self.host is not None and self.ssh_pool is not None and self.slave_pool is None:
+                    ssh_options, self._ssh_pool_hit = self.ssh_pool.prepare(self.host, self.user, self.ssh_port)
+                _command = get_slave_command_line(self.host, self.user, self.ssh_port, arguments, ssh_options, self.use_pty)
                 log.info("lunch-slave %s> $ %s" % (self.identifier, " ".join(_command)))
                 self._process_protocol = SlaveProcessProtocol(self)
                 #try:
-                proc_path = _command[0]
-                args = _command
                 environ = {}
                 environ.update(os.environ) # passing the whole env (for SSH keys and more)
                 self.set_slave_state(STATE_STARTING)
+                self._is_starting = True
                 self.log("Starting lunch-slave: %s" % (self.identifier))
-                self._previous_launching_time = time.time()
-                self._process_transport = reactor.spawnProcess(self._process_protocol, proc_path, args, environ, usePTY=True)
+                self._previous_launching_time = self.clock.seconds()
+                self._process_transport = self._spawn_slave(_command, environ)
+
+    def _spawn_slave(self, args, environ):
+        """
+        Spawns the lunch-slave process, controlled by self._process_protocol.
+        Override this to run something else than a real process, such as in L{lunch.simulator}.
+        @param args: Command line, starting with the executable.
+        @type args: C{list}
+        @param environ: Environment variables.
+        @type environ: C{dict}
+        @return: The transport of the process.
+        """
+        self._must_send_identifier = False
+        if self.slave_address is not None:
+            self._must_send_identifier = True
+            if self.host is None:
+                return socketslave.connect(self.slave_address, self._process_protocol)
+            return self._spawn_process(args, environ) # lunch-slave --proxy, through SSH
+        if self.slave_pool is not None:
+            return self.slave_pool.attach(self, self._process_protocol)
+        if self.warm_pool is not None:
+            transport = self.warm_pool.take(self, self._process_protocol)
+            if transport is not None:
+                self._must_send_identifier = True
+                self._ssh_pool_hit = None # its setup time is not ours
+                return transport
+        return self._spawn_process(args, environ)
+
+    def _spawn_process(self, args, environ):
+        """
+        Spawns a new lunch-slave process, when no pool gives us one.
+        @return: The transport of the process.
+        """
+        return spawn_slave_process(self._process_protocol, args, environ, self.use_pty)
     
     def _format_env(self):
         """
         Format the environment variables to send them to the lunch-slave as a series of key-value pairs.
+        The pairs are quoted like in a shell if they contain spaces or quotes.
         """
-        txt = ""
-        for k, v in self.env.iteritems():
-            txt += "%s=%s " % (k, v)
-        return txt 
+        return " ".join([pipes.quote("%s=%s" % (k, v)) for k, v in self.env.iteritems()])
     
     def _on_connection_made(self):
         if self.slave_state == STATE_STARTING:
@@ -367,7 +694,60 @@ class Command(object):
         self.send_message("do", self.command) 
     
     def send_ping(self):
-        self.send_message("ping") # for fun
+        self.send_message("ping")
+
+    def get_heartbeat_timeout(self):
+        """
+        Returns the time after which a ping without answer means the lunch-slave is dead.
+        """
+        if self.heartbeat_timeout is None:
+            return 3 * self.heartbeat_interval
+        return self.heartbeat_timeout
+
+    def _start_heartbeat(self):
+        if self.heartbeat_interval > 0 and self._heartbeat_call is None:
+            self._ping_sent_time = None
+            self._heartbeat_call = self.clock.callLater(self.heartbeat_interval, self._heartbeat)
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_call is not None:
+            if self._heartbeat_call.active():
+                self._heartbeat_call.cancel()
+            self._heartbeat_call = None
+        self._ping_sent_time = None
+
+    def _heartbeat(self):
+        """
+        Sends a ping, unless one is still waiting for its pong, 
+        in which case it checks if it waited for too long.
+        """
+        self._heartbeat_call = None
+        now = self.clock.seconds()
+        delay = self.heartbeat_interval
+        if self._ping_sent_time is None:
+            self._ping_sent_time = now
+            self.send_ping()
+        else:
+            timeout = self.get_heartbeat_timeout()
+            if now - self._ping_sent_time >= timeout:
+                self._on_heartbeat_timeout()
+                return
+            delay = min(delay, self._ping_sent_time + timeout - now)
+        self._heartbeat_call = self.clock.callLater(delay, self._heartbeat)
+
+    def _on_heartbeat_timeout(self):
+        """
+        The lunch-slave did not answer our ping in time. Kills it, so that the master starts a new one.
+        """
+        self.round_trip_times.timeouts += 1
+        self._ping_sent_time = None
+        self.log("lunch-slave %s> No answer to the heartbeat for %s seconds. Killing it." % (self.identifier, self.get_heartbeat_timeout()), logging.ERROR)
+        self.heartbeat_timeout_signal(self)
+        self.set_slave_state(STATE_STOPPING)
+        try:
+            self._process_transport.signalProcess(9) # signal.SIGKILL
+        except (OSError, error.ProcessExitedAlready), e:
+            self.log("Could not kill lunch-slave %s: %s" % (self.identifier, e), logging.ERROR)
 
     def send_run(self):
         self.send_message("run")
@@ -379,6 +759,98 @@ class Command(object):
     def send_logdir(self):
         self.send_message("logdir", self.child_log_dir)
 
+    def send_start(self):
+        """
+        Sends to the lunch-slave everything it needs to start its child, in a single line.
+        (version 2 of the protocol)
+        """
+        options = {"delay_kill": self.delay_before_kill}
+        options.update(self.slave_options)
+        self.send_frame("start", {
+            "version": self.protocol_version,
+            "identifier": self.identifier,
+            "command": self.command,
+            "env": self.env,
+            "logdir": self.child_log_dir,
+            "options": options,
+            })
+        self.log("lunch-child %s> $ %s" % (self.identifier, self.command), logging.INFO)
+
+    def request_tail(self, count=None, follow=False):
+        """
+        Asks the lunch-slave for the last lines written by the child, from memory.
+        They replace the recent_output, and the output_received_signal is triggered with them.
+        @param count: How many lines. All the ones the lunch-slave kept if None.
+        @param follow: If True, the lunch-slave then sends the next lines as they come, until stop_tail is called. Even if it is restarted.
+        """
+        self._following_output = follow
+        self.recent_output.clear()
+        if self.slave_state == STATE_RUNNING and self._received_ready:
+            args = []
+            if count is not None:
+                args.append(str(count))
+            if follow:
+                args.append("follow")
+            self.send_message("tail", " ".join(args))
+
+    def stop_tail(self):
+        """
+        Asks the lunch-slave to stop sending the lines of the child as they come.
+        """
+        self._following_output = False
+        if self.slave_state == STATE_RUNNING and self._received_ready:
+            self.send_message("untail")
+
+    def recv_output(self, mess):
+        """
+        Callback for the "output" message from the lunch-slave.
+        Its argument is a line written by the child.
+        """
+        self._on_output({"lines": [mess]})
+
+    def _on_output(self, frame):
+        lines = frame["lines"]
+        self.recent_output.extend(lines)
+        if self.forwarded_logger is not None:
+            for line in lines:
+                if isinstance(line, unicode):
+                    line = line.encode("utf-8")
+                self.forwarded_logger.write(line + "\n")
+            self.forwarded_logger.flush()
+        self.output_received_signal(self, lines)
+
+    def recv_output_dropped(self, mess):
+        """
+        Callback for the "output_dropped" message from the lunch-slave.
+        Its argument is how many lines of the child it could not forward to us.
+        """
+        self._on_output_dropped({"count": int(mess.split(" ")[0])})
+
+    def _on_output_dropped(self, frame):
+        count = int(frame["count"])
+        self.output_lines_dropped += count
+        self.log("lunch-child %s> %d lines of output were dropped by the lunch-slave." % (self.identifier, count), logging.WARNING)
+        if self.forwarded_logger is not None:
+            self.forwarded_logger.write("[%d lines dropped]\n" % (count))
+            self.forwarded_logger.flush()
+
+    def send_attach(self):
+        """
+        Asks the lunch-slave daemon for the child it kept running with our identifier.
+        It answers with "attached" or "not_attached".
+        """
+        if self.protocol_version >= 2:
+            self.send_frame("attach", {"version": self.protocol_version, "identifier": self.identifier})
+        else:
+            self.send_message("attach", self.identifier)
+
+    def send_frame(self, key, fields):
+        """
+        Sends a command with a JSON object as arguments. (version 2 of the protocol)
+        @param fields: dict
+        """
+        self.send_message(key, json.dumps(fields))
+
     def send_message(self, key, data=""):
         """
         Sends a command to the lunch-slave.
@@ -394,6 +866,8 @@ class Command(object):
         #TODO: send "stop" and SIGKILL if the lunch-slave and the child processes are stil running.
         if self.slave_logger is not None:
             self.slave_logger.close()
+        if self.forwarded_logger is not None:
+            self.forwarded_logger.close()
         
     def _looks_like_ssh_error(self, line):
         """
@@ -426,6 +900,8 @@ class Command(object):
             ret = "Some SSH problem occurred exchanging the identification on host %s. Is your host blacklisted?" % (self.host)
         elif "Could not resolve hostname" in line:
             ret = "Could not resolve hostname %s." % (self.host)
+        elif "Permission denied" in line and not self.use_pty:
+            ret = "The SSH server did not accept your public key on host %s, and we cannot type a password without a pseudo-terminal. Make sure you use the right user name and that your public SSH key is installed on that host." % (self.host)
         if ret is not None:
             ret += "\nThe line received from SSH is :\n" + line
             ret += "\nThis error happend when trying to launch %s" % (self)
@@ -436,10 +912,14 @@ class Command(object):
     def _received_message(self, line):
         """
         Received one line of text from the lunch-slave through its stdout.
+
+        Each line is parsed by its recv_* method, or, if its arguments are a 
+        JSON object (version 2 of the protocol), given to its _on_* method.
         """
         #self.log("%8s: %s" % (self.identifier, line))
-        # FIXME: right now, we check all the output from that guy
-        if True: #self.number_of_lines_received_from_slave == 0:
+        # SSH and the shell complain before the lunch-slave is ready. 
+        # After that, the lines come from the lunch-slave.
+        if not self._received_ready:
             ssh_error = self._looks_like_ssh_error(line)
             if ssh_error is not None: # It's a str
                 log.error("--------- SSH PROBLEM: " + ssh_error + " -----------")
@@ -450,31 +930,54 @@ class Command(object):
                 return
                 #TODO: handle this
         self.number_of_lines_received_from_slave += 1
-        try:
-            words = line.split(" ")
-            key = words[0]
-            mess = line[len(key) + 1:]
-        except IndexError, e:
-            #self.log("Index error parsing message from lunch-slave. %s" % (e), logging.ERROR)
-            self.log('IndexError From lunch-slave %s: %s' % (self.identifier, line), logging.ERROR)
+        key, sep, mess = line.partition(" ")
+        # Dispatch the command to the appropriate method.  Note that all you
+        # need to do to implement a new command is add another recv_* method.
+        if self.use_pty and key in ["do", "env", "run", "logdir", "stop", "quit", "start", "ping", "id", "attach", "opt", "tail", "untail"]:
+            pass # The pseudo-terminal echoes what we send to the lunch-slave's stdin.
+        elif self.protocol_version >= 2 and mess.startswith("{"):
+            try:
+                frame = json.loads(mess)
+                method = getattr(self, '_on_' + key)
+            except (ValueError, AttributeError), e:
+                self.log('%s: Parsing a line from lunch-slave %s: %s' % (e.__class__.__name__, self.identifier, line), logging.ERROR)
+            else:
+                try:
+                    method(frame)
+                except (KeyError, TypeError, ValueError), e:
+                    self.log('%s: Parsing a line from lunch-slave %s: %s' % (e.__class__.__name__, self.identifier, line), logging.ERROR)
         else:
-            # Dispatch the command to the appropriate method.  Note that all you
-            # need to do to implement a new command is add another do_* method.
-            if key in ["do", "env", "run", "logdir", "stop"]: # FIXME: receiving in stdin what we send to stdin lunch-slave !!!
-                pass #warnings.warn("We receive from the lunch-slave's stdout what we send to its stdin !")
+            try:
+                method = getattr(self, 'recv_' + key)
+            except AttributeError, e:
+                self.log('AttributeError: Parsing a line from lunch-slave %s: %s' % (self.identifier, line), logging.ERROR)
             else:
                 try:
-                    method = getattr(self, 'recv_' + key)
-                except AttributeError, e:
-                    self.log('AttributeError: Parsing a line from lunch-slave %s: %s' % (self.identifier, line), logging.ERROR)
-                    #self.log(line)
-                else:
                     method(mess)
+                except (ValueError, IndexError), e:
+                    self.log('%s: Parsing a line from lunch-slave %s: %s' % (e.__class__.__name__, self.identifier, line), logging.ERROR)
+
+    def _received_error(self, line):
+        """
+        Received one line of text from the stderr of the lunch-slave, or of SSH.
+
+        Without a pseudo-terminal, that is where SSH writes its errors.
+        """
+        ssh_error = self._looks_like_ssh_error(line)
+        if ssh_error is not None:
+            if not self._has_shown_ssh_error:
+                self._has_shown_ssh_error = True
+                self.ssh_error_signal(self, ssh_error)
+        else:
+            log.debug("lunch-slave %s> stderr: %s" % (self.identifier, line))
 
     def recv_ok(self, mess):
         """
         Callback for the "ok" message from the lunch-slave.
         """
+        self._on_ok({})
+
+    def _on_ok(self, frame):
         pass
 
     def recv_not_found(self, mess):
@@ -483,6 +986,9 @@ class Command(object):
         
         That's when bash complains that it didn't find the command we are trying to run.
         """
+        self._on_not_found({"command": mess})
+
+    def _on_not_found(self, frame):
         log.error("lunch-slave %s> Command not found: %s" % (self, self.command))
         if not self._has_shown_notfound_error:
             self._has_shown_notfound_error = True
@@ -494,50 +1000,79 @@ class Command(object):
         
         The arg is the child's PID
         """
-        self.log("lunch-slave %s> child_pid %s" % (self.identifier, mess))
-        words = mess.split(" ")
-        self.child_pid = int(words[0])
+        self._on_child_pid({"pid": int(mess.split(" ")[0])})
+
+    def _on_child_pid(self, frame):
+        self.child_pid = int(frame["pid"])
         self.log("%s: PID of child is %s" % (self.identifier, self.child_pid), logging.INFO)
-        self.child_state_changed_signal(self, self.child_pid)
+        self.child_pid_changed_signal(self, self.child_pid)
 
     def recv_msg(self, mess):
         """
         Callback for the "msg" message from the lunch-slave.
         """
+        self._on_msg({"message": mess})
+
+    def _on_msg(self, frame):
         pass
     
     def recv_retval(self, mess):
         """
         Callback for the "retval" message from the lunch-slave.
         """
-        self.log("lunch-slave %s> retval %s" % (self.identifier, mess))
-        words = mess.split(" ")
-        self.retval = int(words[0])
+        self._on_retval({"retval": int(mess.split(" ")[0])})
+
+    def _on_retval(self, frame):
+        self.retval = int(frame["retval"])
         self.log("%s: Return value of child is %s" % (self.identifier, self.retval), logging.INFO)
     
     def recv_log(self, mess):
         """
         Callback for the "log" message from the lunch-slave.
         """
-        self.log("lunch-slave %s> log %s" % (self.identifier, mess))
+        level, sep, message = mess.partition(" ")
+        self._on_log({"level": level, "message": message})
+
+    def _on_log(self, frame):
+        self.log("lunch-slave %s> log %s %s" % (self.identifier, frame.get("level"), frame.get("message")))
 
     def recv_error(self, mess):
         """
         Callback for the "error" message from the lunch-slave.
         """
-        self.log("lunch-slave %s> error %s" % (self.identifier, mess), logging.ERROR)
+        self._on_error({"message": mess})
+
+    def _on_error(self, frame):
+        self.log("lunch-slave %s> error %s" % (self.identifier, frame.get("message")), logging.ERROR)
     
     def recv_pong(self, mess):
         """
         Callback for the "pong" message from the lunch-slave.
         """
-        pass #self.log("pong from %s" % (self.identifier))
+        self._on_pong({})
+
+    def _on_pong(self, frame):
+        if self._ping_sent_time is not None:
+            self.round_trip_times.add(self.clock.seconds() - self._ping_sent_time)
+            self._ping_sent_time = None
 
     def recv_bye(self, mess):
         """
         Callback for the "bye" message from the lunch-slave.
         """
+        self._on_bye({"message": mess})
+
+    def _on_bye(self, frame):
         self.log("lunch-slave %s> %s" % (self.identifier, "BYE (slave quits)"), logging.ERROR)
+
+    def recv_status(self, mess):
+        """
+        Callback for the "status" message from the lunch-slave.
+        """
+        self._on_status({"state": mess})
+
+    def _on_status(self, frame):
+        pass
     
     def get_state_info(self):
         """
@@ -572,7 +1107,7 @@ class Command(object):
             self.enabled = False
             log.info("Gave up restarting command %s" % (self.identifier))
         else:
-            self._next_try_time = time.time() + self._current_try_again_delay
+            self._next_try_time = self.clock.seconds() + self._current_try_again_delay
             log.info("%s: Will wait %f seconds before trying again." % (self.identifier, self._current_try_again_delay))
             self._current_try_again_delay *= 2
             self.how_many_times_tried += 1
@@ -583,12 +1118,17 @@ class Command(object):
         Received child state.
         """
         words = mess.split(" ")
-        previous_state = self.child_state
-        new_state = words[0]
+        frame = {"state": words[0]}
+        if len(words) > 1:
+            frame["running_time"] = float(words[1])
+        self._on_state(frame)
+
+    def _on_state(self, frame):
+        new_state = frame["state"]
         #print("%s's child state: %s" % (self.identifier, new_state))
         self.log("lunch-child %s> Its state changed to %s" % (self.identifier, new_state))
         if new_state == STATE_STOPPED and self.enabled and self.respawn:
-            child_running_time = float(words[1])
+            child_running_time = float(frame.get("running_time", 0.0))
             if child_running_time < self.minimum_lifetime_to_respawn:
                 self.log("lunch-child %s> Its running time of %s has been shorter than its minimum of %s." % (self.identifier, child_running_time, self.minimum_lifetime_to_respawn))
                 self._give_up_if_we_should()
@@ -604,30 +1144,98 @@ class Command(object):
         
         The lunch-slave sends that to the master when launched.
         It means it is ready to received commands.
+        Its argument is the version of the protocol it speaks, if more than 1.
         """
+        version = 1
+        words = mess.split()
+        if len(words) != 0 and words[0].isdigit():
+            version = int(words[0])
+        self._on_ready({"version": version})
+
+    def _on_ready(self, frame):
+        self.protocol_version = min(PROTOCOL_VERSION, int(frame.get("version", 1)))
         self._received_ready = True
+        if self._ssh_pool_hit is not None:
+            self.ssh_pool.record_setup_time(self._ssh_pool_hit, self.clock.seconds() - self._previous_launching_time)
+            self._ssh_pool_hit = None
+        self._start_heartbeat()
+        if self._following_output:
+            self.send_message("tail", "0 follow")
+        if self.enabled:
+            self._send_all_startup_commands()
+
+    def recv_attached(self, mess):
+        """
+        Callback for the "attached" message from the lunch-slave daemon.
+        Its arguments are the identifier, the state and the PID of the child.
+        """
+        words = mess.split()
+        pid = None
+        if words[2].isdigit():
+            pid = int(words[2])
+        self._on_attached({"identifier": words[0], "state": words[1], "pid": pid})
+
+    def _on_attached(self, frame):
+        """
+        The lunch-slave daemon gave us back the child it kept running after we lost our connection.
+        """
+        self.log("lunch-child %s> Reattached to child, which is %s." % (self.identifier, frame["state"]), logging.INFO)
+        if frame.get("pid") is not None:
+            self._on_child_pid(frame)
+        self._set_child_state(frame["state"], reattached=True)
+
+    def recv_not_attached(self, mess):
+        """
+        Callback for the "not_attached" message from the lunch-slave daemon.
+        """
+        self._on_not_attached({"identifier": mess.strip()})
+
+    def _on_not_attached(self, frame):
+        """
+        The lunch-slave daemon has no child for us: we start a new one.
+        """
+        self.log("lunch-child %s> No child to reattach to. Starting a new one." % (self.identifier))
         if self.enabled:
             self._send_all_startup_commands()
+        else:
+            self._is_starting = False
 
     def _send_all_startup_commands(self):
         """
         Tells the lunch-slave to launch its child process.
         Sets up the environment and command so that the lunch-slave can launch the child.
         """
+        self._is_starting = True
+        if self.reattach and self.slave_address is not None and not self._attach_sent:
+            self._attach_sent = True
+            self.send_attach()
+            return
+        if self.protocol_version >= 2:
+            self.send_start()
+            return
+        if self._must_send_identifier:
+            self.send_message("id", self.identifier)
         self.send_do()
+        for key, value in sorted(self.slave_options.items()):
+            if isinstance(value, bool):
+                value = int(value) # the lunch-slave expects 0 or 1
+            self.send_message("opt", "%s %s" % (key, value))
         self.send_logdir()
         self.send_env()
         #self.send_ping()
         self.send_run()
 
-    def _set_child_state(self, new_state):
+    def _set_child_state(self, new_state, reattached=False):
         """
         Called when it is time to change the state of the child process.
+        @param reattached: True if the child was already running, and we only reattached to it.
         """
         if new_state == STATE_STOPPED:
             self.child_pid = None
+        if new_state in [STATE_RUNNING, STATE_STOPPED]:
+            self._is_starting = False
         if self.child_state != new_state:
-            if new_state == STATE_RUNNING:
+            if new_state == STATE_RUNNING and not reattached:
                 self.how_many_times_run += 1
             self.child_state = new_state
         #    log.msg(" --------------- XXX Trigerring signal %s" % (self.child_state))
@@ -648,6 +1256,7 @@ class Command(object):
         """
         self.reset()
         self.enabled = False
+        self._is_starting = False
         if self.child_state in [STATE_RUNNING, STATE_STARTING]:
             self.log('%s: stop' % (self.identifier), logging.INFO)
             self.send_stop()
@@ -672,14 +1281,15 @@ class Command(object):
         DELAY_BETWEEN_EACH_SIGNAL = self.delay_before_kill
         if self._quit_slave_deferred is not None:
             raise RuntimeError("Slave seems to be already quitting.")
+        self._stop_heartbeat()
         self._quit_slave_deferred = defer.Deferred()
-        _sigkill_delayed_call = None
+        _sigkill_delayed_call = [] # the DelayedCall, once scheduled by _cl_sigterm
         
         def _on_ended(result):
             # cancels the call fo _cl_sigkill if the lunch-slave died.
-            if _sigkill_delayed_call is not None:
-                if _sigkill_delayed_call.active():
-                    _sigkill_delayed_call.cancel()
+            for delayed_call in _sigkill_delayed_call:
+                if delayed_call.active():
+                    delayed_call.cancel()
             if not self._quit_slave_deferred.called:
                 self._quit_slave_deferred.callback(None)
             return result
@@ -690,7 +1300,7 @@ class Command(object):
             self._process_transport.signalProcess(15) # signal.SIGTERM
             self.set_slave_state(STATE_STOPPING)
             self.log('Will stop lunch-slave %s.' % (self.identifier))
-            _sigkill_delayed_call = reactor.callLater(DELAY_BETWEEN_EACH_SIGNAL, _cl_sigkill)
+            _sigkill_delayed_call.append(self.clock.callLater(DELAY_BETWEEN_EACH_SIGNAL, _cl_sigkill))
             # ---------------------------------------
         def _cl_sigkill():
             # sends sigkill if the lunch-slave is still running
@@ -707,7 +1317,7 @@ class Command(object):
             if self.slave_state in [STATE_RUNNING, STATE_STARTING]:
                 if self.child_state in [STATE_RUNNING, STATE_STARTING]:
                     self.stop() # self.send_stop()
-                    reactor.callLater(DELAY_BETWEEN_EACH_SIGNAL, _cl_sigterm)
+                    self.clock.callLater(DELAY_BETWEEN_EACH_SIGNAL, _cl_sigterm)
                 elif self.child_state == STATE_STOPPED:
                     _cl_sigterm()
             elif self.slave_state == STATE_STOPPING:
@@ -732,7 +1342,12 @@ class Command(object):
                 self.log('Slave %s exited with error %s.' % (self.identifier, exit_code))
         elif former_slave_state == STATE_STOPPING:
             self.log('Slave exited as expected.')
+        self._stop_heartbeat()
+        self._is_starting = False
         self.set_slave_state(STATE_STOPPED)
+        if self.child_state != STATE_STOPPED:
+            # Nobody is watching its child anymore. A new lunch-slave will start a new one.
+            self._set_child_state(STATE_STOPPED)
         self._process_transport.loseConnection()
         #if self.respawn and self.enabled: #No! The master will take care of that.
         #    self.log("Restarting the lunch-slave %s." % (self.identifier), logging.INFO)
@@ -776,7 +1391,7 @@ class Command(object):
         self.log(msg)
         if self.slave_state != new_state:
             self.slave_state = new_state
-            self.slave_state_changed_signal(self.slave_state)
+            self.slave_state_changed_signal(self, self.slave_state)
 
     def __str__(self):
         return "%s" % (self.identifier)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Splits the streams of processes into lines, as they arrive in chunks of 
+any size.
+
+The scripts/lunch-slave script has its own copy of L{LineFramer}, since it 
+does not import the lunch module. Keep them the same.
+"""
+
+MAXIMUM_LINE_LENGTH = 65536 # bytes
+
+class LineFramer(object):
+    """
+    Gives the complete lines of a stream to a callback, in batches.
+
+    The end of a chunk is kept until its line is complete. A line longer 
+    than the maximum length is cut, and the rest of it is dropped. Empty 
+    lines are kept, and the carriage returns of a pseudo-terminal are 
+    removed.
+    """
+    def __init__(self, callback, max_length=MAXIMUM_LINE_LENGTH):
+        """
+        @param callback: Called with a list of lines, without their newline.
+        @param max_length: Maximum length of a line, in bytes.
+        """
+        self.callback = callback
+        self.max_length = max_length
+        self.truncated = 0 # how many lines were cut
+        self._buffer = "" # beginning of a line not received entirely yet
+        self._dropping = False # True while dropping the end of a line that was too long
+
+    def feed(self, data):
+        """
+        Adds a chunk of the stream.
+        """
+        if self._dropping:
+            index = data.find("\n")
+            if index == -1:
+                return
+            data = data[index + 1:]
+            self._dropping = False
+        if self._buffer != "":
+            data = self._buffer + data
+        lines = data.split("\n")
+        self._buffer = lines.pop()
+        if len(self._buffer) > self.max_length:
+            lines.append(self._buffer)
+            self._buffer = ""
+            self._dropping = True
+        if len(lines) == 0:
+            return
+        # Each line is only copied again if it needs to.
+        if len(data) > self.max_length:
+            for i in xrange(len(lines)):
+                if len(lines[i]) > self.max_length:
+                    lines[i] = lines[i][:self.max_length]
+                    self.truncated += 1
+        if "\r" in data:
+            lines = [line[:-1] if line.endswith("\r") else line for line in lines]
+        self.callback(lines)
+
+    def flush(self):
+        """
+        Gives the last line, even if it did not end with a newline yet.
+        Call this once the stream is closed.
+        """
+        if self._buffer != "":
+            line = self._buffer
+            self._buffer = ""
+            if line.endswith("\r"):
+                line = line[:-1]
+            self.callback([line])
+        self._dropping = False
@@ -26,6 +26,8 @@ Example : sc needs jackd. We would start jackd first, then sc. If jackd crashes,
 we stop both, start jackd again, and then sc.
 """
 
+from collections import OrderedDict
+
 class GraphError(Exception):
     """
     Any error thrown by handling graph nodes.
@@ -38,19 +40,77 @@ class DirectedGraph(object):
     Useful for handling dependencies between processes.
 
     Some nodes can have two parents, but orphans are children of the root.
+
+    The edges are stored in both directions, in hash tables, so that looking 
+    up the dependencies or the dependees of a node does not need to scan the 
+    whole graph. The nodes are kept in the order in which they were added, 
+    since it defines the launching order.
+
+    The transitive closure of the graph is cached as well: the set of all
+    the ancestors and all the descendants of each node. It is updated 
+    incrementally each time nodes or edges are added or removed.
+
+    The launching order and the depth of each node are computed once, and 
+    then only when the graph changes. See get_launch_order().
     
     Inspired from networkx.digraph.DiGraph
     """
     ROOT = "__ROOT__" # the root node, to which all depend
     def __init__(self):
-        self.deps = [] # dict node: list of [k, []] lists.
-        self.deps.append([self.ROOT, []])
+        self.deps = None # OrderedDict node: list of nodes it depends on.
+        self.dependees = None # dict node: OrderedDict of nodes that depend on it. (used as an ordered set)
+        self._index = None # dict node: int order in which it was added.
+        self._ancestors = None # dict node: set of all the nodes it depends on, recursively. (without the root)
+        self._descendants = None # dict node: set of all the nodes that depend on it, recursively.
+        self._launch_order = None # list of nodes, or None if it must be computed again.
+        self._levels = None # dict node: int depth. (computed with the launch order)
+        self._level_groups = None # list of lists of nodes. (computed with the launch order)
+        self._positions = None # dict node: int index in the launch order. (computed with the launch order)
+        self._counter = 0
+        self.clear()
 
     def clear(self):
         """
         Removes all nodes and dependencies, except the root.
         """
-        self.deps = [[self.ROOT, []]]
+        self.deps = OrderedDict()
+        self.dependees = {}
+        self._index = {}
+        self._ancestors = {}
+        self._descendants = {}
+        self._counter = 0
+        self._invalidate_order()
+        self._add_node_entry(self.ROOT)
+
+    def _add_node_entry(self, node):
+        """
+        Creates the empty entries for a new node.
+        """
+        self.deps[node] = []
+        self.dependees[node] = OrderedDict()
+        self._index[node] = self._counter
+        self._counter += 1
+        if node != self.ROOT:
+            self._ancestors[node] = set()
+            self._descendants[node] = set()
+        self._invalidate_order()
+
+    def _invalidate_order(self):
+        """
+        Called each time the graph changes, so that the launching order is 
+        computed again next time it is needed.
+        """
+        self._launch_order = None
+        self._levels = None
+        self._level_groups = None
+        self._positions = None
+
+    def has_node(self, node):
+        """
+        Checks if a node is in the graph.
+        @rettype: bool
+        """
+        return node in self.deps
     
     def add_node(self, node, deps=None):
         """
@@ -59,9 +119,9 @@ class DirectedGraph(object):
         @param deps: :{list} of L{str} Its dependencies.
         Raises a GraphError if creating circular dependencies.
         """
-        if node not in self.get_all_nodes():
-            self.deps.append([node, []])
-        if deps is not None:
+        if node not in self.deps:
+            self._add_node_entry(node)
+        if deps is not None and deps != []:
             if type(deps) is list:
                 self.add_dependencies(node, deps)
             else:
@@ -81,15 +141,236 @@ class DirectedGraph(object):
         @param node_to: str
         """
         # makes sure we don't already have this node
-        dependencies = self.get_dependencies(node_from)
+        dependencies = self._get_dependencies(node_from)
+        if node_to not in self.deps:
+            raise GraphError("The is no %s node in the dependencies graph." % (node_to))
         if node_to not in dependencies:
             # prevent from circular dependencies
-            if self.depends_on(node_to, node_from):
+            if node_to == node_from or self.depends_on(node_to, node_from):
                 raise GraphError("Circular dependency detected. A node cannot depend on itself.")
             else:
                 dependencies.append(node_to)
-        elif node_to not in self.deps:
-            raise GraphError("The is no %s node in the dependencies graph." % (node_to))
+                self._add_dependee(node_to, node_from)
+                self._add_to_closure(node_from, node_to)
+                self._invalidate_order()
+
+    def add_nodes(self, nodes):
+        """
+        Adds many nodes at once, each pointing to its dependencies.
+
+        The nodes can depend on each other, in any order: the circular 
+        dependencies are detected once they are all in, only among the nodes 
+        that the new edges lead to. The ancestors and descendants are then 
+        updated for each new edge.
+
+        Raises a GraphError if a dependency does not exist, or if creating 
+        circular dependencies. In that case, the graph is left as it was.
+        @param nodes: L{list} of (node, deps) tuples. The deps are as in add_node.
+        """
+        new_nodes = []
+        new_edges = []
+        for node, deps in nodes:
+            if node not in self.deps:
+                self._add_node_entry(node)
+                new_nodes.append(node)
+        try:
+            for node, deps in nodes:
+                if deps is None or deps == []:
+                    deps = [self.ROOT]
+                elif type(deps) is not list:
+                    deps = [deps]
+                for dependency in deps:
+                    if dependency not in self.deps:
+                        raise GraphError("The is no %s node in the dependencies graph." % (dependency))
+                    if dependency == node:
+                        raise GraphError("Circular dependency detected. A node cannot depend on itself.")
+                    if dependency not in self.deps[node]:
+                        self.deps[node].append(dependency)
+                        self._add_dependee(dependency, node)
+                        new_edges.append((node, dependency))
+            cycles = self._find_cycles([node for node, dependency in new_edges])
+            if len(cycles) != 0:
+                raise GraphError("Circular dependency detected between nodes %s." % (", ".join([str(node) for node in cycles[0]])))
+        except GraphError:
+            for node, dependency in new_edges:
+                self.deps[node].remove(dependency)
+                del self.dependees[dependency][node]
+            for node in new_nodes:
+                del self.deps[node]
+                del self.dependees[node]
+                del self._index[node]
+                del self._ancestors[node]
+                del self._descendants[node]
+            self._invalidate_order()
+            raise
+        self._invalidate_order()
+        for node, dependency in new_edges:
+            self._add_to_closure(node, dependency)
+
+    def _find_cycles(self, starts=None):
+        """
+        Returns the list of the groups of nodes that depend on each other.
+        Each group is a list of nodes. If the list is empty, there is no 
+        circular dependency in the graph.
+
+        Finds the strongly connected components with Tarjan's algorithm.
+        Not recursive, so it is not limited by sys.getrecursionlimit().
+        @param starts: Nodes to start from. Only the nodes they depend on, 
+        recursively, are visited. All the nodes if None.
+        @rettype: list of lists
+        """
+        index = {} # dict node: int order in which it was visited.
+        lowest = {} # dict node: int lowest index reachable from it.
+        stack = []
+        on_stack = set()
+        ret = []
+        counter = 0
+        if starts is None:
+            starts = self.deps
+        for start in starts:
+            if start in index:
+                continue
+            index[start] = lowest[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack.add(start)
+            work = [(start, iter(self.deps[start]))] # stack of (node, iterator)
+            while work:
+                node, dependencies = work[-1]
+                went_deeper = False
+                for dependency in dependencies:
+                    if dependency not in index:
+                        index[dependency] = lowest[dependency] = counter
+                        counter += 1
+                        stack.append(dependency)
+                        on_stack.add(dependency)
+                        work.append((dependency, iter(self.deps[dependency])))
+                        went_deeper = True
+                        break
+                    elif dependency in on_stack:
+                        lowest[node] = min(lowest[node], index[dependency])
+                if went_deeper:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowest[parent] = min(lowest[parent], lowest[node])
+                if lowest[node] == index[node]:
+                    component = []
+                    while True:
+                        other = stack.pop()
+                        on_stack.discard(other)
+                        component.append(other)
+                        if other == node:
+                            break
+                    if len(component) > 1:
+                        ret.append(component)
+        return ret
+
+    def _add_to_closure(self, node_from, node_to):
+        """
+        Updates the cached ancestors and descendants after adding an edge.
+        """
+        if node_to == self.ROOT:
+            return
+        new_ancestors = self._ancestors[node_to] | set([node_to])
+        new_descendants = self._descendants[node_from] | set([node_from])
+        for node in new_descendants:
+            self._ancestors[node] |= new_ancestors
+        for node in new_ancestors:
+            self._descendants[node] |= new_descendants
+
+    def _remove_from_closure(self, node_from, node_to):
+        """
+        Updates the cached ancestors and descendants after removing an edge.
+
+        Only the ancestors of node_from and its descendants can have changed, 
+        as well as the descendants of node_to and its ancestors. Those are 
+        computed again from their direct neighbours, in topological order.
+        """
+        if node_to == self.ROOT:
+            return
+        self._compute_ancestors(self._descendants[node_from] | set([node_from]))
+        self._compute_descendants(self._ancestors[node_to] | set([node_to]))
+
+    def _compute_ancestors(self, nodes):
+        """
+        Computes again the ancestors of some nodes, from their direct 
+        dependencies, in topological order. The ancestors of the other nodes 
+        must be up to date.
+        """
+        for node in self._sorted_within(nodes, self.deps):
+            ancestors = set()
+            for dependency in self.deps[node]:
+                if dependency != self.ROOT:
+                    ancestors.add(dependency)
+                    ancestors |= self._ancestors[dependency]
+            self._ancestors[node] = ancestors
+
+    def _compute_descendants(self, nodes):
+        """
+        Computes again the descendants of some nodes, from their direct 
+        dependees, in topological order. The descendants of the other nodes 
+        must be up to date.
+        """
+        for node in self._sorted_within(nodes, self.dependees):
+            descendants = set()
+            for dependee in self.dependees[node]:
+                descendants.add(dependee)
+                descendants |= self._descendants[dependee]
+            self._descendants[node] = descendants
+
+    def _sorted_within(self, nodes, edges):
+        """
+        Sorts a set of nodes so that each node comes after its neighbours in 
+        the given edges table, only considering the neighbours in that set.
+        (Kahn's algorithm)
+        """
+        waiting = {}
+        ready = []
+        for node in nodes:
+            count = 0
+            for other in edges[node]:
+                if other in nodes:
+                    count += 1
+            if count == 0:
+                ready.append(node)
+            else:
+                waiting[node] = count
+        neighbours_of = self.dependees if edges is self.deps else self.deps
+        ret = []
+        while ready:
+            node = ready.pop()
+            ret.append(node)
+            for other in neighbours_of[node]:
+                if other in waiting:
+                    waiting[other] -= 1
+                    if waiting[other] == 0:
+                        del waiting[other]
+                        ready.append(other)
+        return ret
+
+    def _add_dependee(self, node, dependee):
+        """
+        Stores the reverse edge, keeping the dependees in the order their nodes were added.
+        """
+        dependees = self.dependees[node]
+        if len(dependees) != 0 and self._index[next(reversed(dependees))] > self._index[dependee]:
+            # not the newest one: need to sort them again.
+            items = dependees.keys() + [dependee]
+            items.sort(key=self._index.__getitem__)
+            self.dependees[node] = OrderedDict.fromkeys(items)
+        else:
+            dependees[dependee] = None
+
+    def _get_dependencies(self, node):
+        """
+        Returns the very list of dependencies of a node. (not a copy)
+        """
+        try:
+            return self.deps[node]
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
 
     def get_dependencies(self, node):
         """
@@ -98,14 +379,10 @@ class DirectedGraph(object):
         @rettype list
         @param node: str
         """
-        for k, v in self.deps:
-            if k is node:
-                return v
-        # else:
-        raise GraphError("No node %s in graph." % (node))
+        return list(self._get_dependencies(node))
 
     def get_all_nodes(self):
-        return [k for k, v in self.deps]
+        return self.deps.keys()
 
     def get_root(self):
         """
@@ -118,26 +395,78 @@ class DirectedGraph(object):
         """
         If no dependency if left, it will depend on the root.
         """
-        # might raise a ValueError
-        dependencies = self.get_dependencies(node_from)
+        dependencies = self._get_dependencies(node_from)
         if node_to in dependencies:
             dependencies.remove(node_to) 
+            del self.dependees[node_to][node_from]
+            self._remove_from_closure(node_from, node_to)
+            self._invalidate_order()
             if dependencies == []:
                 dependencies.append(self.ROOT)
+                self._add_dependee(self.ROOT, node_from)
         else:
-            raise GraphError("No dependency %s for node %s.", node_to, node_from)
+            raise GraphError("No dependency %s for node %s." % (node_to, node_from))
         
     def remove_node(self, node):
         """
         Removes a node from the graph.
         Removes all the dependencies of other nodes to this one.
+        Those which are left with no dependency will depend on the root.
         """
-        if node in self.get_all_nodes():
-            for k, v in self.deps:
-                if k is node:
-                    self.deps.remove([k, v])
-        else:
+        if node not in self.deps or node == self.ROOT:
             raise GraphError("No node %s in graph." % (node))
+        for dependee in self.dependees[node].keys():
+            self.remove_dependency(dependee, node)
+        # Now that nothing depends on it, it can only be reached by itself.
+        for dependency in self._ancestors[node]:
+            self._descendants[dependency].discard(node)
+        for dependency in self.deps[node]:
+            del self.dependees[dependency][node]
+        del self.deps[node]
+        del self.dependees[node]
+        del self._index[node]
+        del self._ancestors[node]
+        del self._descendants[node]
+        self._invalidate_order()
+
+    def remove_nodes(self, nodes):
+        """
+        Removes many nodes at once.
+        Like remove_node, but the ancestors and descendants are computed only 
+        once, and only for the nodes that were related to the removed ones.
+        """
+        for node in nodes:
+            if node not in self.deps or node == self.ROOT:
+                raise GraphError("No node %s in graph." % (node))
+        removed = set(nodes)
+        lower = set() # nodes whose ancestors may change
+        upper = set() # nodes whose descendants may change
+        for node in removed:
+            lower |= self._descendants[node]
+            upper |= self._ancestors[node]
+        lower -= removed
+        upper -= removed
+        for node in removed:
+            for dependee in self.dependees[node]:
+                if dependee in removed:
+                    continue
+                dependencies = self.deps[dependee]
+                dependencies.remove(node)
+                if dependencies == []:
+                    dependencies.append(self.ROOT)
+                    self._add_dependee(self.ROOT, dependee)
+            for dependency in self.deps[node]:
+                if dependency not in removed:
+                    del self.dependees[dependency][node]
+        for node in removed:
+            del self.deps[node]
+            del self.dependees[node]
+            del self._index[node]
+            del self._ancestors[node]
+            del self._descendants[node]
+        self._invalidate_order()
+        self._compute_ancestors(lower)
+        self._compute_descendants(upper)
 
     def get_supported_by(self, node=None):
         """
@@ -146,11 +475,10 @@ class DirectedGraph(object):
         """
         if node is None:
             node = self.ROOT
-        ret = []
-        for k, v in self.deps:
-            if node in v:
-                ret.append(k)
-        return ret
+        try:
+            return self.dependees[node].keys()
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
 
     def get_all_dependees(self, node=None):
         """
@@ -160,10 +488,9 @@ class DirectedGraph(object):
         if node is None:
             node = self.ROOT
         ret = []
-        for k, v in self.deps:
-            if node in v:
-                ret.append(k)
-                ret.extend(self.get_all_dependees(k))
+        for k in self.get_supported_by(node):
+            ret.append(k)
+            ret.extend(self.get_all_dependees(k))
         return ret
         
     def get_all_dependencies(self, node):
@@ -172,33 +499,151 @@ class DirectedGraph(object):
         @param node: str 
         """
         ret = []
-        for k in self.get_dependencies(node):
+        for k in self._get_dependencies(node):
             if k != self.ROOT:
                 ret.append(k)
                 ret.extend(self.get_all_dependencies(k))
         return ret
 
+    def get_ancestors(self, node):
+        """
+        Returns the set of all the nodes to which a node depends, recursively.
+        The root is not part of it.
+
+        This is read from the cache, so it is fast, but the caller must not 
+        modify the set.
+        @rettype: set
+        @param node: str
+        """
+        if node == self.ROOT:
+            return set()
+        try:
+            return self._ancestors[node]
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
+
+    def get_descendants(self, node=None):
+        """
+        Returns the set of all the nodes that depend on a node, recursively.
+
+        This is read from the cache, so it is fast, but the caller must not 
+        modify the set.
+        @rettype: set
+        @param node: str or None. If None, will return the nodes supported by the root.
+        """
+        if node is None or node == self.ROOT:
+            return set(self.deps.keys()[1:])
+        try:
+            return self._descendants[node]
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
+
     def depends_on(self, node, searched):
         """
         Checks if a node depends on another.
-        Recursive method. (might be limited by sys.getrecursionlimit())
         """
-        if node is self.ROOT:
+        if node == self.ROOT:
             return False
-        #elif node is searched:
-        #    raise GraphError("Both given nodes are the same.")
+        elif searched == self.ROOT:
+            self._get_dependencies(node) # raises a GraphError if not in graph
+            return True
         else:
-            li = self.get_dependencies(node)
-            for i in li:
-                if i is searched:
-                    return True
-                else:
-                    if i is not self.ROOT:
-                        res = self.depends_on(i, searched)
-                        if res:
-                            return True
-            # if not found
-            return False
+            return searched in self.get_ancestors(node)
+
+    def get_launch_order(self):
+        """
+        Returns the list of all the nodes, but the root, in the order in which 
+        they should be started.
+
+        Each node comes after all the nodes it depends on. Other than that, 
+        the graph is walked from the root to the leaves, prioritizing each 
+        next node on the same level by the order in which it was added.
+
+        The list is cached until the graph changes, so the caller must not 
+        modify it.
+        @rettype: list
+        """
+        if self._launch_order is None:
+            self._compute_launch_order()
+        return self._launch_order
+
+    def get_level(self, node):
+        """
+        Returns the depth of a node in the graph. 
+        
+        The root is at level 0, the nodes that depend only on the root are at 
+        level 1, and any other node is one level deeper than the deepest of 
+        its dependencies.
+        @rettype: int
+        """
+        if self._levels is None:
+            self._compute_launch_order()
+        try:
+            return self._levels[node]
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
+
+    def get_launch_position(self, node):
+        """
+        Returns the index of a node in the launching order.
+        See get_launch_order().
+        @rettype: int
+        """
+        if self._positions is None:
+            self._compute_launch_order()
+        try:
+            return self._positions[node]
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
+
+    def get_levels(self):
+        """
+        Returns the nodes grouped by level, each group being in launching order. 
+        The first group is level 1. (the root is not part of it)
+
+        The list is cached until the graph changes, so the caller must not 
+        modify it.
+        @rettype: list of lists
+        """
+        if self._level_groups is None:
+            self._compute_launch_order()
+        return self._level_groups
+
+    def _compute_launch_order(self):
+        """
+        Computes the launching order and the levels.
+        
+        A node is visited once for each of its dependencies, and is only 
+        added to the order once the last of them has been. 
+        Not recursive, so it is not limited by sys.getrecursionlimit().
+        """
+        order = []
+        levels = {self.ROOT: 0}
+        remaining = {} # dict node: number of dependencies not visited yet.
+        for node, dependencies in self.deps.iteritems():
+            remaining[node] = len(dependencies)
+        stack = [iter(self.dependees[self.ROOT].keys())] # stack of iterators
+        while stack:
+            try:
+                node = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                continue
+            remaining[node] -= 1
+            if remaining[node] == 0:
+                levels[node] = 1 + max([levels[dependency] for dependency in self.deps[node]])
+                order.append(node)
+                stack.append(iter(self.dependees[node].keys()))
+        groups = []
+        for node in order:
+            level = levels[node]
+            while len(groups) < level:
+                groups.append([])
+            groups[level - 1].append(node)
+        self._launch_order = order
+        self._levels = levels
+        self._level_groups = groups
+        self._positions = dict([(node, index) for index, node in enumerate(order)])
 
     def _traverse(self, node, indent=0):
         """
@@ -223,21 +668,11 @@ def iter_from_root_to_leaves(graph):
     Generator function to iterate through all nodes of a graph, 
     from the root to its leaves, prioritizing each next node on the same
     level by the order in which it was added.
+
+    Yields the root first, and then the nodes in the launching order. 
+    See L{DirectedGraph.get_launch_order}.
     @return: An iterator.
     """
-    current = graph.ROOT
-    visited = [] # list of visited nodes.
-    stack = [] # stack of iterators
-    while True:
-        if current not in visited:
-            visited.append(current)
-            # DO YOUR STUFF HERE
-            yield current
-            children = graph.get_supported_by(current)
-            stack.append(iter(children))
-        try:
-            current = stack[-1].next()
-        except StopIteration:
-            stack.pop()
-        except IndexError:
-            break
+    yield graph.ROOT
+    for node in graph.get_launch_order():
+        yield node
@@ -65,6 +65,7 @@ You should have received a copy of the GNU General Public License
 along with Lunch.  If not, see <http://www.gnu.org/licenses/>.""")
 
 PADDING_IN_TEXTVIEW = 22 # number of spaces before text contents in the textview
+OUTPUT_LINES_IN_TEXTVIEW = 20 # how many of the last lines written by the selected child to show
 ICON_FILE = "/usr/share/pixmaps/lunch.png"
 
 def run_once(executable, *args):
@@ -206,6 +207,7 @@ class LunchApp(object):
         global ICON_FILE
         self.master = lunch_master
         self.confirm_close = True # should we ask if the user is sure to close the app?
+        self._followed_command = None # L{lunch.commands.Command} whose recent output is shown
         _commands = self.master.get_all_commands()
 
         # ------------------------------------------------------
@@ -270,8 +272,8 @@ class LunchApp(object):
         for command in _commands:
             self._add_command_in_tree(command)
 
-        self.master.command_added_signal.connect(self.on_command_added)
-        self.master.command_removed_signal.connect(self.on_command_removed)
+        self.master.commands_added_signal.connect(self.on_commands_added)
+        self.master.commands_removed_signal.connect(self.on_commands_removed)
         
         # ------------------------------------------------------
         # TextView for the details
@@ -348,6 +350,9 @@ class LunchApp(object):
             for key, val in keyval:
                 _format = "%" + ("%ds" % PADDING_IN_TEXTVIEW) + ": %s\n"
                 txt += _format % (key, val)
+            lines = list(command.recent_output)[-OUTPUT_LINES_IN_TEXTVIEW:]
+            if len(lines) != 0:
+                txt += "\n" + _("Recent output:") + "\n" + "\n".join(lines) + "\n"
         self.set_textview_text(txt)
 
     def _update_text_in_textview_if_command_is_selected(self, command):
@@ -357,20 +362,47 @@ class LunchApp(object):
     #def on_treeview_tooltip_queried(self, *args):
     #    log.debug("on_treeview_tooltip_queried %s" % (str(args)))
 
-    def on_command_added(self, command):
-        log.debug("on_command_added")
-        self._add_command_in_tree(command)
+    def on_commands_added(self, commands):
+        log.debug("on_commands_added")
+        for command in commands:
+            self._add_command_in_tree(command)
         self._update_text_in_textview()
         
-    def on_command_removed(self, command):
-        log.debug("on_command_removed")
-        self._remove_command_from_tree(command)
+    def on_commands_removed(self, commands):
+        log.debug("on_commands_removed")
+        for command in commands:
+            self._remove_command_from_tree(command)
+            if command is self._followed_command:
+                self._followed_command = None
         self._update_text_in_textview()
 
     def on_selected_command_changed(self, *args):
         log.debug("on_selected_command_changed")
+        self._follow_output_of_selected_command()
         self._update_buttons_according_to_selected_contact()
         self._update_text_in_textview()
+
+    def _follow_output_of_selected_command(self):
+        """
+        Asks the lunch-slave of the selected command for the last lines of its child, and for the next ones.
+        They are kept in memory by the lunch-slave, so that no SSH session nor xterm is needed.
+        """
+        command = self._get_currently_selected_command(False)
+        if command is self._followed_command:
+            return
+        if self._followed_command is not None:
+            self._followed_command.stop_tail()
+        self._followed_command = command
+        if command is not None:
+            command.request_tail(OUTPUT_LINES_IN_TEXTVIEW, follow=True)
+
+    def on_command_output_received(self, command, lines):
+        """
+        Called when the output_received_signal of the command is triggered.
+        @param command L{lunch.commands.Command} 
+        @param lines list of str
+        """
+        self._update_text_in_textview_if_command_is_selected(command)
     
     def _update_buttons_according_to_selected_contact(self):
         command = self._get_currently_selected_command(False)
@@ -465,6 +497,7 @@ class LunchApp(object):
         command.child_pid_changed_signal.connect(self.on_command_child_pid_changed)
         command.ssh_error_signal.connect(self.on_ssh_error)
         command.command_not_found_signal.connect(self.on_command_not_found)
+        command.output_received_signal.connect(self.on_command_output_received)
 
 #    # FIXME: did not get this to work yet
 #    def _set_tooltip_for_command(self, command):
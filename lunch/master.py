@@ -45,6 +45,10 @@ from twisted.python import procutils
 
 from lunch import sig
 from lunch import graph
+from lunch import timers
+from lunch import multislave
+from lunch import warmpool
+from lunch import commands
 from lunch.states import *
 from lunch import logger
 
@@ -67,12 +71,19 @@ class Master(object):
     """
     The Lunch Master launches slaves, which in turn launch childs.
     """
-    def __init__(self, log_dir=DEFAULT_LOG_DIR, pid_file=None, log_file=None, config_file=None, verbose=False):
+    def __init__(self, log_dir=DEFAULT_LOG_DIR, pid_file=None, log_file=None, config_file=None, verbose=False, parallel_launch=False, max_concurrent_starts=0, event_driven=False, clock=None, shared_slaves=False, ssh_multiplexing=False, warm_slaves=0):
         """
         @param log_dir: str Path.
         @param pid_file: str Path.
         @param log_file: str Path.
         @param config_file: str Path.
+        @param parallel_launch: If True, the sleep_after of a command only delays the commands that depend on it, and commands whose dependencies are satisfied are started at the same time, level by level.
+        @param max_concurrent_starts: Maximum number of commands being started at the same time when parallel_launch is True. 0 means no limit.
+        @param event_driven: If True, the commands are not checked 20 times a second, but only when their state changes, or when it is time to start one of them.
+        @param clock: Provider of twisted.internet.interfaces.IReactorTime used to schedule the iterations. Defaults to the reactor. The commands should use the same one.
+        @param shared_slaves: If True, a single lunch-slave manages the children of all the commands of a host, instead of one lunch-slave for each command.
+        @param ssh_multiplexing: If True, the lunch-slaves of a remote host share a single SSH connection.
+        @param warm_slaves: How many idle lunch-slaves to keep started in advance for each host. 0 disables it.
         """
         # attributes:
         self.commands = {} # dict of str identifier: L{lunch.commands.Command}
@@ -93,13 +104,50 @@ class Master(object):
         self.config_file = config_file
         self.verbose = verbose
         self.main_loop_every = 0.05 # checks process to start/stop 20 times a second.
-        self._time_now = time.time()
-        self.launch_next_time = time.time() # time in future
+        self.clock = clock # IReactorTime provider, such as the reactor or a twisted.internet.task.Clock.
+        if clock is None:
+            self.clock = reactor
+        self._time_now = self.clock.seconds()
+        self.launch_next_time = self.clock.seconds() # time in future
+        self.parallel_launch = parallel_launch
+        self.max_concurrent_starts = max_concurrent_starts # 0 means infinity
+        self.slave_pool = None # L{lunch.multislave.SlavePool} if the lunch-slaves are shared.
+        if shared_slaves:
+            self.slave_pool = multislave.SlavePool(clock=self.clock)
+        self.ssh_pool = None # L{lunch.commands.SSHConnectionPool} if the SSH connections are shared.
+        if ssh_multiplexing:
+            self.ssh_pool = commands.SSHConnectionPool()
+        self.warm_pool = None # L{lunch.warmpool.WarmSlavePool} if lunch-slaves are started in advance.
+        if warm_slaves > 0:
+            self.warm_pool = warmpool.WarmSlavePool(size=warm_slaves, clock=self.clock)
+        self.heartbeat_interval = 0.0 # given to the commands that do not set theirs. 0 disables the heartbeats.
+        self.heartbeat_timeout = None # given with the heartbeat_interval. None means three times the interval.
+        self._start_gates = {} # dict node: time after which the commands that depend on it can be started. (parallel launch only)
+        self._launching = set() # nodes that we started, and which are still starting. (parallel launch only)
+        self.event_driven = False
+        self._dirty = set() # nodes whose state, or the state of a related node, changed since the last iteration.
+        self._waiting = set() # nodes that could not be started yet, and must be checked again at each iteration.
+        self._gated = set() # nodes waiting for launch_next_time. (serial launch only)
+        self.timers = timers.TimerHeap() # deadlines, with ("retry", node) or ("gate", node) keys. The gate of the serial launch has None as node.
+        self._tick_call = None # DelayedCall for the next iteration. (event-driven only)
+        self._wake_up_call = None # DelayedCall for when the earliest deadline expires.
+        self._wake_up_time = None # time at which the _wake_up_call is scheduled.
+        self.tick_statistics = {
+            "ticks": 0, # how many iterations so far
+            "evaluated": 0, # how many nodes were checked during the last iteration
+            "skipped": 0, # how many nodes were not checked during the last iteration
+            "total_evaluated": 0,
+            "total_skipped": 0,
+            "total_cpu": 0.0, # processor time spent checking the nodes, in seconds
+            }
         self._looping_call = task.LoopingCall(self.main_loop)
-        self._looping_call.start(self.main_loop_every, False) 
+        self._looping_call.clock = self.clock
+        self.set_event_driven(event_driven)
         self.wants_to_live = False # The master is either trying to make every child live or die. 
         self.command_added_signal = sig.Signal() # param: Command object
         self.command_removed_signal = sig.Signal() # param: command object -- Called when actually deleted from the graph
+        self.commands_added_signal = sig.Signal() # param: list of Command objects -- Called once for each call to add_commands
+        self.commands_removed_signal = sig.Signal() # param: list of Command objects -- Called once for all the commands deleted in an iteration
         
         # actions:
         self.start_all()
@@ -108,6 +156,32 @@ class Master(object):
     #def __del__(self):
     #    self._looping_call.stop()
 
+    def set_event_driven(self, enabled=True):
+        """
+        Chooses between checking all the commands 20 times a second, or only 
+        the commands whose state changed, when it changed.
+        @param enabled: bool
+        """
+        self.event_driven = enabled
+        if enabled:
+            if self._looping_call.running:
+                self._looping_call.stop()
+            self._mark_all_dirty()
+        else:
+            self._cancel_delayed_calls()
+            if not self._looping_call.running:
+                self._looping_call.start(self.main_loop_every, False) 
+
+    def _cancel_delayed_calls(self):
+        """
+        Cancels the calls scheduled by the event-driven scheduler.
+        """
+        for call in [self._tick_call, self._wake_up_call]:
+            if call is not None and call.active():
+                call.cancel()
+        self._tick_call = None
+        self._wake_up_call = None
+
     def _guess_local_ip_and_hostname_for_local_host(self):
         """
         Lunch master guesses the hostname of the local machine, and should at least guess one IP (for one interface) 
@@ -130,26 +204,168 @@ class Master(object):
             c.enabled = True
         self.prepare_all_commands()
         self.wants_to_live = True
+        self._mark_all_dirty()
     
     def add_command(self, command):
         """
         This method is wrapped (called) by the add_command function.
         @param command: L{lunch.commands.Command} object.
         """    
-        # check if addr is local, set it to none if so.
-        if command.host in self.local_addresses:
-            log.info("Filtering out host %s since it is in list of local addresses." % (command.host))
-            command.host = None    
-        # set default names if they are none:
-        if command.identifier is None:
-            command.identifier = "default_%d" % (self.i) #TODO: use the first word of the command
-            self.i += 1
-        while command.identifier in self.commands: # making sure it is unique
-            command.identifier += "X"
-        self.tree.add_node(command.identifier, command.depends) # Adding it the the dependencies tree.
-        self.commands[command.identifier] = command
-        # calls the signal
-        self.command_added_signal(command)
+        self.add_commands([command])
+
+    def add_commands(self, commands):
+        """
+        Adds many commands at once.
+
+        The whole batch is checked first, and then inserted in the dependencies 
+        graph in a single pass. If one of them has a wrong dependency, a 
+        GraphError is raised and none of them is added.
+        Calls the commands_added_signal once, and command_added_signal for each.
+        @param commands: L{list} of L{lunch.commands.Command} objects.
+        """
+        # Chooses the identifiers and hosts first, so that the commands are left as they were if the batch is refused.
+        identifiers = set(self.commands.keys())
+        counter = self.i
+        changes = [] # list of (identifier, host) tuples, one for each command
+        for command in commands:
+            # check if addr is local, set it to none if so.
+            host = command.host
+            if host in self.local_addresses:
+                log.info("Filtering out host %s since it is in list of local addresses." % (host))
+                host = None
+            # set default names if they are none:
+            identifier = command.identifier
+            if identifier is None:
+                identifier = "default_%d" % (counter) #TODO: use the first word of the command
+                counter += 1
+            while identifier in identifiers: # making sure it is unique
+                identifier += "X"
+            identifiers.add(identifier)
+            changes.append((identifier, host))
+        # Adding them the the dependencies tree.
+        if len(commands) == 1:
+            self._add_node(changes[0][0], commands[0].depends)
+        else:
+            self.tree.add_nodes([(identifier, command.depends) for command, (identifier, host) in zip(commands, changes)])
+        self.i = counter
+        for command, (identifier, host) in zip(commands, changes):
+            command.identifier = identifier
+            command.host = host
+        for command in commands:
+            self.commands[command.identifier] = command
+            if self.slave_pool is not None:
+                command.slave_pool = self.slave_pool
+            if self.ssh_pool is not None:
+                command.ssh_pool = self.ssh_pool
+            if self.warm_pool is not None:
+                command.warm_pool = self.warm_pool
+            if self.heartbeat_interval > 0 and command.heartbeat_interval == 0:
+                command.heartbeat_interval = self.heartbeat_interval
+                command.heartbeat_timeout = self.heartbeat_timeout
+            command.child_state_changed_signal.connect(self._on_command_state_changed)
+            command.slave_state_changed_signal.connect(self._on_command_state_changed)
+            self._mark_dirty(command.identifier)
+        # calls the signals
+        for command in commands:
+            self.command_added_signal(command)
+        if len(commands) != 0:
+            self.commands_added_signal(list(commands))
+
+    def _add_node(self, identifier, depends):
+        """
+        Adds a single new node to the dependencies tree, incrementally.
+        Its dependencies are checked first, so that it is not left half-added.
+        """
+        if depends is not None and depends != []:
+            if type(depends) is not list:
+                depends = [depends]
+            for dependency in depends:
+                if not self.tree.has_node(dependency):
+                    raise graph.GraphError("The is no %s node in the dependencies graph." % (dependency))
+        self.tree.add_node(identifier, depends)
+
+    def _on_command_state_changed(self, command, new_state):
+        """
+        Called when the state of the child or of the lunch-slave of a command changes.
+        """
+        if command.identifier in self.commands:
+            if command.child_state != STATE_STOPPED:
+                self.timers.cancel(("retry", command.identifier))
+            self._mark_dirty(command.identifier)
+
+    def _mark_dirty(self, node):
+        """
+        Tells the scheduler that a node and all the nodes related to it must be checked.
+        """
+        self._dirty.add(node)
+        self._dirty.update(self.tree.get_ancestors(node))
+        self._dirty.update(self.tree.get_descendants(node))
+        self._schedule_tick()
+
+    def _mark_all_dirty(self):
+        """
+        Tells the scheduler that every node must be checked.
+        """
+        self._dirty.update(self.commands.keys())
+        self._schedule_tick()
+
+    def _schedule_tick(self):
+        """
+        Makes sure the event-driven scheduler will iterate as soon as possible.
+        Many changes in a row are handled in a single iteration.
+        """
+        if self.event_driven and self._tick_call is None:
+            self._tick_call = self.clock.callLater(0, self._event_tick)
+
+    def _event_tick(self):
+        """
+        One iteration of the event-driven scheduler.
+        
+        Checks only the nodes whose state, or the state of a related node, 
+        changed, and those that were waiting to be started.
+        Then sleeps until something changes, or until it is time to start 
+        one of the waiting nodes.
+        """
+        self._tick_call = None
+        self._time_now = self.clock.seconds()
+        self._treat_dirty_nodes()
+
+    def _schedule_wake_up(self):
+        """
+        Schedules an iteration for when the earliest deadline expires. 
+        Nodes that wait for something else than time will be checked again 
+        at the next iteration.
+        """
+        deadline = self.timers.get_earliest()
+        if self._wake_up_call is not None and self._wake_up_call.active():
+            if self._wake_up_time == deadline:
+                return
+            self._wake_up_call.cancel()
+        self._wake_up_call = None
+        self._wake_up_time = deadline
+        if deadline is not None:
+            self._wake_up_call = self.clock.callLater(max(0.0, deadline - self.clock.seconds()), self._on_wake_up)
+
+    def _on_wake_up(self):
+        self._wake_up_call = None
+        if self.event_driven:
+            self._schedule_tick()
+        else:
+            self.main_loop()
+
+    def _handle_expired_timers(self):
+        """
+        Marks as dirty the nodes whose deadline expired.
+        """
+        for kind, node in self.timers.pop_expired(self._time_now):
+            if kind == "gate":
+                if node is None:
+                    self._dirty.update(self._gated)
+                    self._gated = set()
+                elif node in self.commands:
+                    self._dirty.update(self.tree.get_supported_by(node))
+            elif node in self.commands: # retry
+                self._dirty.add(node)
 
     def prepare_all_commands(self):
         """
@@ -162,6 +378,10 @@ class Master(object):
         """
         Called in a looping call.
         This is actually the main loop of the application.
+
+        Only the nodes whose state, or the state of a related node, changed
+        since the last iteration are checked, as well as those which are 
+        waiting to be started. See tick_statistics.
         
         Starting by the process with no dependency, starts them, in the order they were given, sleeping some time before each, as configured using their sleep_after attribute. 
         
@@ -180,58 +400,81 @@ class Master(object):
         #self._manage_siblings(orphans, should_run=self.wants_to_live)
         #log.info("----- Managing slaves LOOP ----")
 
-        self._time_now = time.time()
-        iterator = graph.iter_from_root_to_leaves(self.tree)
-        for current in iterator:
-            if current != self.tree.ROOT:
-                self._treat_node(current)
+        self._time_now = self.clock.seconds()
+        self._treat_dirty_nodes()
+
+    def _treat_dirty_nodes(self):
+        """
+        Checks the nodes that changed since the last iteration, those whose 
+        deadline expired, and those that are waiting.
+        Then schedules a wake-up for the next deadline.
+        """
+        begin = time.clock()
+        self._handle_expired_timers()
+        nodes = self._dirty | self._waiting
+        self._dirty = set()
+        self._waiting = set()
+        self._treat_nodes(nodes)
+        self._schedule_wake_up()
+        self.tick_statistics["total_cpu"] += time.clock() - begin
+
+    def _treat_nodes(self, nodes):
+        """
+        Checks each of the given nodes, in launching order.
+        @param nodes: Iterable of node names.
+        """
+        if self.parallel_launch:
+            for node in list(self._launching):
+                if node not in self.commands or not self.commands[node].is_starting():
+                    self._launching.discard(node)
+            # Level by level, so that the shallowest ones are started first if there is a limit.
+            key = lambda node: (self.tree.get_level(node), self.tree.get_launch_position(node))
+        else:
+            key = self.tree.get_launch_position
+        nodes = sorted([node for node in nodes if node in self.commands], key=key)
+        stats = self.tick_statistics
+        stats["ticks"] += 1
+        stats["evaluated"] = len(nodes)
+        stats["skipped"] = len(self.commands) - len(nodes)
+        stats["total_evaluated"] += stats["evaluated"]
+        stats["total_skipped"] += stats["skipped"]
+        for current in nodes:
+            self._treat_node(current)
+        # Those to delete are removed all at once, at the end of the iteration.
+        to_delete = [node for node in nodes if self.commands[node].to_be_deleted]
+        if len(to_delete) != 0:
+            self._delete_commands(to_delete)
 
     def _treat_node(self, node):
         """
         Called once for each command on each main loop iteration.
         """
         command = self.commands[node]
-        all_dependencies = self.tree.get_all_dependencies(node)
-        all_dependees = self.tree.get_all_dependees(node)
-
-        has_dependees_to_wait_for = False # to wait so that they quit
-        for dependee_name in all_dependees:
-            dependee = self.commands[dependee_name]
-            if dependee.child_state != STATE_STOPPED:
-                has_dependees_to_wait_for = True
-        
         # If RUNNING, check if we should stop it:
         if command.child_state == STATE_RUNNING:
             self._stop_node_if_needed(node)
         elif command.child_state == STATE_STOPPED:
             self._start_node_if_needed(node)
             self._stop_nodes_that_depend_on_this_one(node)
-        if command.to_be_deleted:
-            self._delete_command(node)
 
     def _node_has_dependees_that_are_stopped(self, node):
         """
         Checks if this node has nodes which depend on it which are running.
         @rtype: C{bool}
         """
-        command = self.commands[node]
-        all_dependees = self.tree.get_all_dependees(node)
-
-        ret = False 
-        for dependee_name in all_dependees:
+        for dependee_name in self.tree.get_descendants(node):
             dependee = self.commands[dependee_name]
             if dependee.child_state != STATE_STOPPED:
-                ret = True
-        return ret
+                return True
+        return False
 
     def _stop_nodes_that_depend_on_this_one(self, current_node):
         """
         Pre-condition: Node is not running. (might have changed a second ago)
         """
-        all_dependees = self.tree.get_all_dependees(current_node)
         command = self.commands[current_node]
         if command.child_state == STATE_STOPPED:
-            for dependee in all_dependees:
+            for dependee in self.tree.get_descendants(current_node):
                 other = self.commands[dependee]
                 if other.child_state == STATE_RUNNING:
                     other.stop()
@@ -242,9 +485,7 @@ class Master(object):
         Pre-condition: Node is running.
         """
         command = self.commands[node]
-        all_dependencies = self.tree.get_all_dependencies(node)
-        all_dependees = self.tree.get_all_dependees(node)
-        has_dependees_to_wait_for = self._node_has_dependees_that_are_stopped(node)
+        all_dependencies = self.tree.get_ancestors(node)
         
         if self.wants_to_live is False:
             command.stop()
@@ -265,19 +506,25 @@ class Master(object):
         Pre-condition: Node is not running.
         """
         command = self.commands[node]
-        all_dependencies = self.tree.get_all_dependencies(node)
-        all_dependees = self.tree.get_all_dependees(node)
-        has_dependees_to_wait_for = self._node_has_dependees_that_are_stopped(node)
+        all_dependencies = self.tree.get_ancestors(node)
         
+        if not self.wants_to_live or not command.enabled:
+            return
         # self.launch_next_time is for launching the next process... so it must be updated as 
         # soon as we start one.
-        if self.wants_to_live and self.launch_next_time <= self._time_now and command.enabled and command.is_ready_to_be_started():
-            if has_dependees_to_wait_for: # We cannot start this node if there are nodes that depend on this one to be running.
+        if not self._launch_gate_is_open(node):
+            self._wait_for_launch_gate(node)
+        elif not command.is_ready_to_be_started(self._time_now):
+            next_try_time = command.get_next_try_time()
+            if next_try_time > self._time_now:
+                self.timers.schedule(("retry", node), next_try_time)
+            else:
+                self._waiting.add(node) # try again at next iteration
+        else:
+            if self._node_has_dependees_that_are_stopped(node): # We cannot start this node if there are nodes that depend on this one to be running.
                 pass #command.stop()
             else:
                 start_it = True
-                if not command.is_ready_to_be_started():
-                    start_it = False
                 if not command.respawn and command.how_many_times_run >= 1:
                     start_it = False # already ran this once
                 #
@@ -293,21 +540,75 @@ class Master(object):
                         start_it = False
                 # Finally, start it if we are ready to.
                 if start_it:
-                    self.launch_next_time = self._time_now + command.sleep_after
+                    if self.parallel_launch:
+                        self._start_gates[node] = self._time_now + command.sleep_after
+                        self.timers.schedule(("gate", node), self._start_gates[node])
+                        self._launching.add(node)
+                    else:
+                        self.launch_next_time = self._time_now + command.sleep_after
+                        self.timers.schedule(("gate", None), self.launch_next_time)
                     log.info("Will start %s." % (command.identifier))
                     command.start()
+                    # If the lunch-slave refuses to start it without a state change, nothing would wake it up.
+                    self.timers.schedule(("retry", node), self._time_now + command.try_again_delay)
+
+    def _wait_for_launch_gate(self, node):
+        """
+        Makes sure a node whose launch gate is closed will be checked again when it opens.
+        """
+        if not self.parallel_launch:
+            self._gated.add(node)
+        elif self.max_concurrent_starts != 0 and len(self._launching) >= self.max_concurrent_starts:
+            self._waiting.add(node)
+        # else, the gate of one of its dependencies will wake it up.
+
+    def _launch_gate_is_open(self, node):
+        """
+        Checks if enough time has passed since the previous commands were started to start this one.
+
+        When launching in parallel, only the sleep_after of the commands this one directly depends on is considered, and there might be a limit to how many commands are starting at the same time. Otherwise, commands are started one at a time.
+        @rtype: C{bool}
+        """
+        if not self.parallel_launch:
+            return self.launch_next_time <= self._time_now
+        if self.max_concurrent_starts != 0 and len(self._launching) >= self.max_concurrent_starts:
+            return False
+        for dependency in self.tree.get_dependencies(node):
+            if self._start_gates.get(dependency, 0) > self._time_now:
+                return False
+        return True
     
-    def _delete_command(self, node):
+    def _delete_commands(self, nodes):
         """
-        Actually deletes it.
+        Actually deletes them.
+        They are removed from the graph at once.
         """
-        ref = self.commands[node]
-        del self.commands[node]
+        removed = []
+        for node in nodes:
+            ref = self.commands[node]
+            del self.commands[node]
+            self._start_gates.pop(node, None)
+            self._launching.discard(node)
+            self._gated.discard(node)
+            self.timers.cancel(("retry", node))
+            self.timers.cancel(("gate", node))
+            ref.child_state_changed_signal.disconnect(self._on_command_state_changed)
+            ref.slave_state_changed_signal.disconnect(self._on_command_state_changed)
+            removed.append(ref)
+        dependees = set()
+        for node in nodes:
+            dependees |= self.tree.get_descendants(node)
+        dependees -= set(nodes)
         #log.debug(self.commands)
-        self.tree.remove_node(node) # XXX ?
-        log.info("Removed command %s from the graph" % (node))
-        self.command_removed_signal(ref)
-        ref.quit_slave()
+        self.tree.remove_nodes(nodes)
+        for dependee in dependees:
+            self._mark_dirty(dependee)
+        for ref in removed:
+            log.info("Removed command %s from the graph" % (ref.identifier))
+            self.command_removed_signal(ref)
+        self.commands_removed_signal(removed)
+        for ref in removed:
+            ref.quit_slave()
 
     def _get_all(self):
         """
@@ -342,6 +643,7 @@ class Master(object):
         #TODO: stop the looping call.
         _commands = self._get_all()
         self.wants_to_live = False
+        self._mark_all_dirty()
         for c in _commands:
             if c.child_state in [STATE_RUNNING, STATE_STARTING]:
                 c.stop()
@@ -353,11 +655,23 @@ class Master(object):
         """
         Removes a command
         """
-        if identifier in self.commands.keys():
-            command = self.commands[identifier]
-            if command.get_state_info() == STATE_RUNNING: #FIXME
-                command.stop()
-            command.to_be_deleted = True
+        self.remove_commands([identifier])
+
+    def remove_commands(self, identifiers):
+        """
+        Removes many commands.
+        Those which are running are stopped first. They are deleted from 
+        the graph at once, on the next iteration, and then the 
+        commands_removed_signal is called.
+        @param identifiers: L{list} of command identifiers.
+        """
+        for identifier in identifiers:
+            if identifier in self.commands:
+                command = self.commands[identifier]
+                if command.get_state_info() == STATE_RUNNING: #FIXME
+                    command.stop()
+                command.to_be_deleted = True
+                self._mark_dirty(identifier)
 
     def restart_all(self):
         """
@@ -365,7 +679,7 @@ class Master(object):
         """
         # TODO: use the looping call to do stuff in the future.
         self.stop_all()
-        reactor.callLater(0.1, self._start_if_all_stopped)
+        self.clock.callLater(0.1, self._start_if_all_stopped)
 
     def _start_if_all_stopped(self):
         """
@@ -381,7 +695,7 @@ class Master(object):
             self.start_all()
             log.info("Restarting all.")
         else:
-            reactor.callLater(0.1, self._start_if_all_stopped)
+            self.clock.callLater(0.1, self._start_if_all_stopped)
 
     def quit_master(self):
         """
@@ -395,6 +709,8 @@ class Master(object):
         Called before Twisted's shutdown. (end of master process)
         """
         MAXIMUM_TIME_TO_WAIT = 20.0
+        stats = self.tick_statistics
+        log.info("The scheduler checked %d nodes and skipped %d in %d iterations, using %f seconds of processor time." % (stats["total_evaluated"], stats["total_skipped"], stats["ticks"], stats["total_cpu"]))
         if self.pid_file is not None:
             log.info("Will now erase the %s PID file" % (self.pid_file))
             try:
@@ -432,11 +748,41 @@ class Master(object):
                 reactor.callLater(0.1, _later, self, data)
             else:
                 log.info("Done stopping the Lunch Master.")
-                deferred.callback(True) # stops reactor
+                if self.warm_pool is not None:
+                    log.info("Idle lunch-slaves: %s" % (self.warm_pool.statistics))
+                    self.warm_pool.close()
+                if self.ssh_pool is not None:
+                    log.info("SSH connections: %s" % (self.ssh_pool.get_statistics()))
+                    d = self.ssh_pool.close_all()
+                    d.addBoth(lambda result: deferred.callback(True))
+                else:
+                    deferred.callback(True) # stops reactor
         
         _later(self, _shutdown_data)
         return deferred
 
+    def get_latencies(self):
+        """
+        Returns the round-trip times of the heartbeats, for each host.
+        The "ewma" is the mean of the ones of its commands, and the "p99" the highest of them.
+        @return: dict of host: dict with the commands, ewma, p99 and timeouts keys. The local host is None.
+        @rtype: C{dict}
+        """
+        ret = {}
+        for command in self.get_all_commands():
+            stats = command.round_trip_times.get_statistics()
+            host = ret.setdefault(command.host, {"commands": 0, "ewma": None, "p99": None, "timeouts": 0, "_ewmas": []})
+            host["commands"] += 1
+            host["timeouts"] += stats["timeouts"]
+            if stats["ewma"] is not None:
+                host["_ewmas"].append(stats["ewma"])
+                host["p99"] = max(host["p99"], stats["p99"])
+        for host in ret.itervalues():
+            ewmas = host.pop("_ewmas")
+            if len(ewmas) != 0:
+                host["ewma"] = sum(ewmas) / len(ewmas)
+        return ret
+
     def cleanup(self):
         """
         Cleans up the reactor stuff.
@@ -445,16 +791,29 @@ class Master(object):
         log.info("_cleanup the Master")
         deferreds = []
         reactor.removeSystemEventTrigger(self._shutdown_event_id)
+        self._cancel_delayed_calls()
         # quit all slaves
+        quitting = []
         for command in self.get_all_commands():
             if command.slave_state == STATE_RUNNING:
-                deferreds.append(command.quit_slave())
+                quitting.append(command.quit_slave())
+        if self.warm_pool is not None:
+            quitting.append(self.warm_pool.close())
+        deferreds.extend(quitting)
+        # then close the SSH connections they were using
+        if self.ssh_pool is not None:
+            d = defer.DeferredList(quitting)
+            d.addCallback(lambda result: self.ssh_pool.close_all())
+            deferreds.append(d)
         # stop the master's loop
         if self._looping_call.running:
             d = self._looping_call.deferred
             self._looping_call.stop() # FIXME
             deferreds.append(d)
-        return defer.DeferredList(deferreds)
+        d = defer.DeferredList(deferreds)
+        # the lunch-slaves that quit changed the state of their commands, which woke up the scheduler.
+        d.addCallback(lambda result: self._cancel_delayed_calls())
+        return d
         
 def _validate_identifier(identifier):
     """
@@ -638,6 +997,11 @@ def execute_config_file(lunch_master, config_file, chmod_config_file=True):
     The functions to which the user can access in their lunch files are defined here.
      * add_command
      * add_local_address
+     * launch_in_parallel
+     * share_slaves
+     * multiplex_ssh
+     * heartbeat
+     * warm_slaves
     
     The user can also access the lunch_master variable, which is the Lunch Master.
     """
@@ -657,12 +1021,61 @@ def execute_config_file(lunch_master, config_file, chmod_config_file=True):
                 log.info("Adding %s in list of local addresses." % (address))
                 lunch_master.local_addresses.append(address)
     # --------------------------------
-    def add_command(command=None, identifier=None, env=None, user=None, host=None, group=None, order=None, sleep_after=0.25, respawn=True, minimum_lifetime_to_respawn=0.5, log_dir=None, sleep=None, depends=None, try_again_delay=0.25, give_up_after=0, ssh_port=None):
+    def launch_in_parallel(max_concurrent_starts=0):
+        """
+        Starts the commands whose dependencies are satisfied at the same time, 
+        instead of one after the other.
+        The sleep_after of a command then only delays the commands that depend on it.
+        :param max_concurrent_starts: int. Maximum number of commands starting at the same time. 0 means no limit.
+        """
+        lunch_master.parallel_launch = True
+        lunch_master.max_concurrent_starts = max_concurrent_starts
+    # --------------------------------
+    def share_slaves():
+        """
+        Uses a single lunch-slave for all the commands of each host, instead of 
+        one lunch-slave, and one SSH connection, for each command.
+        """
+        if lunch_master.slave_pool is None:
+            lunch_master.slave_pool = multislave.SlavePool(clock=lunch_master.clock)
+    # --------------------------------
+    def multiplex_ssh(persist=600):
+        """
+        Opens a single SSH connection to each remote host, through which all
+        its lunch-slaves are started, instead of one connection for each.
+        :param persist: How long to keep a connection open once it is not used, in seconds.
+        """
+        if lunch_master.ssh_pool is None:
+            lunch_master.ssh_pool = commands.SSHConnectionPool()
+        lunch_master.ssh_pool.persist = persist
+    # --------------------------------
+    def heartbeat(interval=2.0, timeout=None):
+        """
+        Pings each lunch-slave every interval seconds, and kills it if it does 
+        not answer within timeout seconds. The master then starts a new one.
+        :param timeout: Defaults to three times the interval.
+        """
+        lunch_master.heartbeat_interval = interval
+        lunch_master.heartbeat_timeout = timeout
+    # --------------------------------
+    def warm_slaves(size=1, idle_timeout=60.0):
+        """
+        Keeps size idle lunch-slaves started in advance for each host, so that 
+        a command that must be started again does not wait for a new one.
+        :param idle_timeout: Time after which an idle lunch-slave quits. The pool only starts new ones for a host when one of its commands takes one.
+        """
+        if lunch_master.warm_pool is None:
+            lunch_master.warm_pool = warmpool.WarmSlavePool(clock=lunch_master.clock)
+        lunch_master.warm_pool.size = size
+        lunch_master.warm_pool.idle_timeout = idle_timeout
+    # --------------------------------
+    def add_command(command=None, identifier=None, env=None, user=None, host=None, group=None, order=None, sleep_after=0.25, respawn=True, minimum_lifetime_to_respawn=0.5, log_dir=None, sleep=None, depends=None, try_again_delay=0.25, give_up_after=0, ssh_port=None, use_pty=True, slave_address=None, reattach=False, slave_options=None):
         """
         This is the only function that users use from within the configuration file.
         It adds a Command instance to the list of commands to run. 
 
-        This function calls the Master.add_command static method, passing to it a L{lunch.commands.Command} object
+        Each L{lunch.commands.Command} is added to the master right away, so that the
+        next lines can refer to it, and a wrong dependency is reported where it is.
         """
         # TODO: remove priority and sleep kwargs in a future version
         log.debug("Adding %s (%s) %s@%s" % (identifier, command, user, host))
@@ -676,7 +1089,7 @@ def execute_config_file(lunch_master, config_file, chmod_config_file=True):
             sleep_after = sleep
         #if priority is not None:
         #    warnings.warn("The priority keyword argument does not exist anymore. Only the order in which add_command calls are done is considered.", DeprecationWarning)
-        c = commands.Command(command=command, env=env, host=host, user=user, order=order, sleep_after=sleep_after, respawn=respawn, minimum_lifetime_to_respawn=minimum_lifetime_to_respawn, log_dir=log_dir, identifier=identifier, depends=depends, try_again_delay=try_again_delay, give_up_after=give_up_after, ssh_port=ssh_port)
+        c = commands.Command(command=command, env=env, host=host, user=user, order=order, sleep_after=sleep_after, respawn=respawn, minimum_lifetime_to_respawn=minimum_lifetime_to_respawn, log_dir=log_dir, identifier=identifier, depends=depends, try_again_delay=try_again_delay, give_up_after=give_up_after, ssh_port=ssh_port, use_pty=use_pty, slave_address=slave_address, reattach=reattach, slave_options=slave_options)
         lunch_master.add_command(c)
     # -------------------------------------
     #global _commands # is this necessary?
@@ -706,7 +1119,7 @@ def start_logging(identifier='lunchrc', log_to_file=False, log_dir=DEFAULT_LOG_D
     log.info("Started logging.")
     return log_file
 
-def run_master(config_file, log_to_file=False, log_dir=DEFAULT_LOG_DIR, chmod_config_file=True, verbose=False, log_level='info'):
+def run_master(config_file, log_to_file=False, log_dir=DEFAULT_LOG_DIR, chmod_config_file=True, verbose=False, log_level='info', event_driven=False):
     """
     Runs the master that calls commands using ssh or so.
 
@@ -726,7 +1139,7 @@ def run_master(config_file, log_to_file=False, log_dir=DEFAULT_LOG_DIR, chmod_co
     pid_file = write_master_pid_file(identifier=master_identifier, directory=log_dir)
     log.debug("-------------------- Starting master -------------------")
     log.info("Using lunch master module %s" % (__file__))
-    lunch_master = Master(log_dir=log_dir, pid_file=pid_file, log_file=log_file, config_file=config_file, verbose=verbose)
+    lunch_master = Master(log_dir=log_dir, pid_file=pid_file, log_file=log_file, config_file=config_file, verbose=verbose, event_driven=event_driven)
     execute_config_file(lunch_master, config_file, chmod_config_file=chmod_config_file)
     # TODO: return a Deferred
     return lunch_master
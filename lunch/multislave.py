@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shares a single lunch-slave process between all the commands of a host.
+
+The lunch-slave is then started with the --multi option. Each line sent to
+it, or received from it, starts with the identifier of a command, or with
+"*" for the lunch-slave itself.
+
+Each L{lunch.commands.Command} still believes it has its own lunch-slave:
+it is given a L{ChildChannel}, which looks like the transport of a process.
+"""
+import os
+
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.python import failure
+
+from lunch import commands
+from lunch import framing
+from lunch.states import *
+from lunch import logger
+
+log = logger.start(name='multislave')
+
+GLOBAL = "*" # prefix of the lines for the lunch-slave itself
+
+class ChildChannel(object):
+    """
+    Stands for the transport of the lunch-slave process of a command,
+    when its child is managed by a shared lunch-slave.
+    """
+    def __init__(self, host_slave, identifier, process_protocol):
+        self.host_slave = host_slave
+        self.identifier = identifier
+        self.process_protocol = process_protocol
+        self.connected = False
+        self.ended = False
+
+    def write(self, data):
+        """
+        Sends lines to the child, through the shared lunch-slave.
+        """
+        for line in data.splitlines():
+            self.host_slave.send_line("%s %s" % (self.identifier, line))
+
+    def signalProcess(self, signal_id):
+        """
+        Asks the shared lunch-slave to stop the child, and to forget about it.
+        SIGKILL, or any signal if not connected yet, ends it right away.
+        """
+        if self.ended:
+            raise error.ProcessExitedAlready()
+        if self.connected:
+            self.host_slave.send_line("%s quit" % (self.identifier))
+        if signal_id == 9 or not self.connected:
+            self.end(None, signal_id)
+
+    def loseConnection(self):
+        self.host_slave.detach(self)
+
+    def end(self, exit_code, signal_id=None):
+        """
+        Tells the command its lunch-slave is gone.
+        """
+        if self.ended:
+            return
+        self.ended = True
+        self.connected = False
+        if exit_code == 0:
+            reason = failure.Failure(error.ProcessDone(0))
+        else:
+            reason = failure.Failure(error.ProcessTerminated(exit_code, signal_id))
+        self.process_protocol.processEnded(reason)
+
+class HostSlaveProcessProtocol(protocol.ProcessProtocol):
+    """
+    Process of a shared lunch-slave. (through SSH, or directly)
+    """
+    def __init__(self, host_slave):
+        self.host_slave = host_slave
+        self._out_framer = framing.LineFramer(self._received_lines)
+        self._err_framer = framing.LineFramer(self._received_error_lines)
+
+    def connectionMade(self):
+        self.host_slave._on_connection_made()
+
+    def outReceived(self, data):
+        self._out_framer.feed(data)
+
+    def _received_lines(self, lines):
+        for line in lines:
+            if line != "":
+                self.host_slave._received_line(line)
+
+    def errReceived(self, data):
+        self._err_framer.feed(data)
+
+    def _received_error_lines(self, lines):
+        for line in lines:
+            if line.strip() != "":
+                self.host_slave._received_error(line)
+
+    def processEnded(self, reason):
+        log.info("Shared slave %s process ended with %s." % (self.host_slave, reason.value.exitCode))
+        self.host_slave._on_process_ended(reason.value.exitCode, getattr(reason.value, "signal", None))
+
+class HostSlave(object):
+    """
+    A lunch-slave process that manages the children of many commands.
+    """
+    def __init__(self, pool, key, args, ssh_pool=None, ssh_pool_hit=None, use_pty=True, clock=None):
+        """
+        @param pool: L{SlavePool}
+        @param key: (host, user, ssh_port, use_pty) tuple.
+        @param args: Command line of the lunch-slave.
+        @param use_pty: Whether to connect to the lunch-slave through a pseudo-terminal, or pipes.
+        @param ssh_pool: L{lunch.commands.SSHConnectionPool} to tell the setup time to, if any.
+        @param ssh_pool_hit: Whether the SSH connection existed when args were built.
+        @param clock: Provider of twisted.internet.interfaces.IReactorTime, to measure the SSH setup time. Defaults to the reactor.
+        """
+        self.pool = pool
+        self.clock = clock
+        if clock is None:
+            self.clock = reactor
+        self.key = key
+        self.args = args
+        self.use_pty = use_pty
+        self.ssh_pool = ssh_pool
+        self._ssh_pool_hit = ssh_pool_hit
+        self._spawn_time = None
+        self.channels = {} # dict of str identifier: L{ChildChannel}
+        self.state = STATE_STOPPED
+        self.process_protocol = HostSlaveProcessProtocol(self)
+        self.transport = None
+        self._received_ready = False
+
+    def start(self):
+        self.state = STATE_STARTING
+        environ = {}
+        environ.update(os.environ) # passing the whole env (for SSH keys and more)
+        log.info("Shared lunch-slave %s> $ %s" % (self, " ".join(self.args)))
+        self._spawn_time = self.clock.seconds()
+        self.transport = self.pool._spawn(self.process_protocol, self.args, environ, self.use_pty)
+
+    def attach(self, identifier, process_protocol):
+        """
+        Adds a command to the ones managed by this lunch-slave.
+        @rtype: L{ChildChannel}
+        """
+        channel = ChildChannel(self, identifier, process_protocol)
+        self.channels[identifier] = channel
+        if self._received_ready:
+            self._connect(channel)
+        return channel
+
+    def detach(self, channel):
+        """
+        Removes a command. Quits the lunch-slave if it was the last one.
+        """
+        if self.channels.get(channel.identifier) is channel:
+            del self.channels[channel.identifier]
+        if len(self.channels) == 0:
+            self.quit()
+
+    def quit(self):
+        """
+        Asks the lunch-slave to stop all its children and to quit.
+        A new one will be started if another command needs it.
+        """
+        self.pool._forget(self)
+        if self.state in [STATE_STARTING, STATE_RUNNING]:
+            self.send_line("%s quit" % (GLOBAL))
+            self.state = STATE_STOPPING
+
+    def _connect(self, channel):
+        channel.connected = True
+        channel.process_protocol.makeConnection(channel)
+        self.send_line("%s add %s" % (GLOBAL, channel.identifier))
+
+    def send_line(self, line):
+        if self.transport is not None:
+            self.transport.write(line + "\n")
+
+    def _on_connection_made(self):
+        if self.state == STATE_STARTING:
+            self.state = STATE_RUNNING
+
+    def _received_line(self, line):
+        """
+        Dispatches a line to the command it is for.
+        """
+        identifier = line.split(" ")[0]
+        mess = line[len(identifier) + 1:]
+        key = mess.split(" ")[0]
+        if identifier == GLOBAL:
+            if key == "ready":
+                self._received_ready = True
+                if self.ssh_pool is not None and self._ssh_pool_hit is not None:
+                    self.ssh_pool.record_setup_time(self._ssh_pool_hit, self.clock.seconds() - self._spawn_time)
+                    self._ssh_pool_hit = None
+                for channel in self.channels.values():
+                    if not channel.connected:
+                        self._connect(channel)
+            elif key == "error":
+                log.error("Shared slave %s> %s" % (self, mess))
+            # "add" and "quit" are what we sent, echoed by the pseudo-terminal, if any.
+        elif identifier in self.channels:
+            channel = self.channels[identifier]
+            if key == "bye":
+                channel.end(0)
+            else:
+                channel.process_protocol.outReceived(mess + "\n")
+        else:
+            # Probably an error message from SSH or the shell: each command checks it.
+            for channel in self.channels.values():
+                channel.process_protocol.outReceived(line + "\n")
+
+    def _received_error(self, line):
+        """
+        Gives a line of the stderr of the lunch-slave, or of SSH, to each command.
+        """
+        for channel in self.channels.values():
+            channel.process_protocol.errReceived(line + "\n")
+
+    def _on_process_ended(self, exit_code, signal_id=None):
+        self.state = STATE_STOPPED
+        self.transport = None
+        self.pool._forget(self)
+        for channel in self.channels.values():
+            channel.end(exit_code, signal_id)
+        self.channels = {}
+
+    def __str__(self):
+        host, user, ssh_port, use_pty = self.key
+        if host is None:
+            return "localhost"
+        elif user is None:
+            return host
+        return "%s@%s" % (user, host)
+
+class SlavePool(object):
+    """
+    Keeps one shared lunch-slave for each host, user and SSH port, and
+    for each way to connect to it: through a pseudo-terminal, or pipes.
+    """
+    def __init__(self, clock=None):
+        """
+        @param clock: Provider of twisted.internet.interfaces.IReactorTime. Defaults to the reactor.
+        """
+        self.clock = clock # IReactorTime provider, such as the reactor or a twisted.internet.task.Clock.
+        if clock is None:
+            self.clock = reactor
+        self.host_slaves = {} # dict of (host, user, ssh_port, use_pty): L{HostSlave}
+
+    def attach(self, command, process_protocol):
+        """
+        Gives the child of a command to the lunch-slave of its host,
+        starting it if needed.
+        @param command: L{lunch.commands.Command}
+        @param process_protocol: L{lunch.commands.SlaveProcessProtocol} of the command.
+        @rtype: L{ChildChannel}
+        """
+        key = (command.host, command.user, command.ssh_port, command.use_pty)
+        if key not in self.host_slaves:
+            ssh_pool = command.ssh_pool
+            ssh_options = None
+            hit = None
+            if command.host is not None and ssh_pool is not None:
+                ssh_options, hit = ssh_pool.prepare(command.host, command.user, command.ssh_port)
+            args = commands.get_slave_command_line(command.host, command.user, command.ssh_port, ["--multi"], ssh_options, command.use_pty)
+            host_slave = HostSlave(self, key, args, ssh_pool, hit, command.use_pty, self.clock)
+            self.host_slaves[key] = host_slave
+            host_slave.start()
+        return self.host_slaves[key].attach(command.identifier, process_protocol)
+
+    def _forget(self, host_slave):
+        if self.host_slaves.get(host_slave.key) is host_slave:
+            del self.host_slaves[host_slave.key]
+
+    def _spawn(self, process_protocol, args, environ, use_pty=True):
+        """
+        Spawns a shared lunch-slave process.
+        """
+        return commands.spawn_slave_process(process_protocol, args, environ, use_pty)
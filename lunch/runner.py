@@ -42,6 +42,7 @@ def run():
     parser.add_option("-v", "--verbose", action="store_true", help="Makes the logging output verbose.")
     parser.add_option("-d", "--debug", action="store_true", help="Makes the logging output very verbose.")
     parser.add_option("-k", "--kill", action="store_true", help="Kills another lunch master that uses the same config file and logging directory. Exits once it's done.")
+    parser.add_option("-e", "--event-driven", action="store_true", help="Checks the commands only when their state changes, instead of 20 times a second.")
     (options, args) = parser.parse_args()
     # --------- set configuration file
     if options.config_file:
@@ -100,7 +101,7 @@ def run():
             sys.exit(0)
         try:
             #print("DEBUG: using config_file %s" % (config_file))
-            lunch_master = master.run_master(config_file, log_to_file=file_logging_enabled, log_dir=logging_dir, log_level=log_level)
+            lunch_master = master.run_master(config_file, log_to_file=file_logging_enabled, log_dir=logging_dir, log_level=log_level, event_driven=options.event_driven is True)
         except master.FileNotFoundError, e:
             #print("Error starting lunch as master.")
             msg = "A configuration file is missing. Try the --help flag. "
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simulates a Lunch Master with many commands, without spawning any process.
+
+The lunch-slave processes are replaced by fake ones, which speak the same
+line protocol, and time is virtual, driven by a twisted.internet.task.Clock.
+(see L{Clock})
+The simulation is deterministic: the same seed gives the same results.
+
+Example::
+
+    simulation = Simulator(seed=1, event_driven=True)
+    simulation.add_commands([simulation.create_command("a"), simulation.create_command("b", depends=["a"])])
+    simulation.cold_start()
+    simulation.inject_crashes(["a"])
+    simulation.recover()
+    print(simulation.get_report())
+"""
+import time
+import json
+import heapq
+import random
+import itertools
+
+from twisted.internet import base
+from twisted.internet import error
+from twisted.internet import task
+from twisted.python import failure
+
+from lunch import commands
+from lunch import master
+from lunch import sig
+from lunch.states import *
+from lunch import logger
+
+log = logger.start(name='simulator')
+
+class Clock(task.Clock):
+    """
+    A twisted.internet.task.Clock which keeps its calls in a heap.
+
+    The original one sorts all its calls each time one is added or run, 
+    which is too slow to simulate thousands of commands. The cancelled 
+    calls are only dropped from the heap when their time comes.
+    """
+    def __init__(self):
+        task.Clock.__init__(self)
+        self._heap = [] # heap of (time, sequence number, DelayedCall)
+        self._sequence = itertools.count()
+
+    def callLater(self, when, what, *a, **kw):
+        """
+        See L{twisted.internet.interfaces.IReactorTime.callLater}.
+        """
+        call = base.DelayedCall(self.seconds() + when, what, a, kw, self._on_cancelled, self._push, self.seconds)
+        self._push(call)
+        return call
+
+    def _push(self, call):
+        heapq.heappush(self._heap, (call.getTime(), self._sequence.next(), call))
+
+    def _on_cancelled(self, call):
+        pass
+
+    def _drop_stale(self):
+        """
+        Drops the cancelled calls, and those whose time changed, from the top of the heap.
+        """
+        while self._heap:
+            when, sequence, call = self._heap[0]
+            if call.active() and when == call.getTime():
+                return
+            heapq.heappop(self._heap)
+
+    def get_next_time(self):
+        """
+        Returns the time of the earliest call, or None if there is none.
+        """
+        self._drop_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def getDelayedCalls(self):
+        """
+        See L{twisted.internet.interfaces.IReactorTime.getDelayedCalls}
+        """
+        return [call for when, sequence, call in sorted(self._heap) if call.active() and when == call.getTime()]
+
+    def advance(self, amount):
+        """
+        Moves time forward by the given amount and runs the calls that are due.
+        """
+        self.rightNow += amount
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > self.rightNow:
+                break
+            when, sequence, call = heapq.heappop(self._heap)
+            call.called = 1
+            call.func(*call.args, **call.kw)
+
+class ChildModel(object):
+    """
+    How a simulated lunch-slave and its child behave.
+    All durations are in simulated seconds.
+    """
+    def __init__(self, slave_latency=0.05, start_latency=0.1, stop_latency=0.05, mean_time_to_crash=None, start_failures=0, message_latency=0.0, protocol_version=commands.PROTOCOL_VERSION):
+        """
+        @param slave_latency: Time for the lunch-slave to be spawned. (SSH connection, etc.)
+        @param start_latency: Time for the child to be running once asked to.
+        @param stop_latency: Time for the child to exit once asked to.
+        @param mean_time_to_crash: Mean running time before the child crashes. (exponential distribution) None means it never crashes by itself.
+        @param start_failures: How many times the child exits right away before it starts successfully.
+        @param message_latency: Time for each line to go from the lunch-slave to the master.
+        @param protocol_version: Version of the protocol spoken by the lunch-slave. See L{lunch.commands.PROTOCOL_VERSION}.
+        """
+        self.slave_latency = slave_latency
+        self.start_latency = start_latency
+        self.stop_latency = stop_latency
+        self.mean_time_to_crash = mean_time_to_crash
+        self.start_failures = start_failures
+        self.message_latency = message_latency
+        self.protocol_version = protocol_version
+
+class FakeSlave(object):
+    """
+    Stands for the transport of a lunch-slave process.
+
+    Understands the lines sent by the L{lunch.commands.Command} and answers
+    like the lunch-slave script would, simulating the life of its child.
+    """
+    def __init__(self, simulator, command, process_protocol, model):
+        self.simulator = simulator
+        self.clock = simulator.clock
+        self.command = command
+        self.process_protocol = process_protocol
+        self.model = model
+        self.alive = True
+        self.frozen = False # if True, it does not answer anything anymore, like a hung SSH session.
+        self.child_state = STATE_STOPPED
+        self.child_pid = None
+        self.protocol_version = 1 # of the lines it sends. Version 2 once the master sent a "start".
+        self._start_failures_left = model.start_failures
+        self._child_started_time = 0
+        self._child_call = None # DelayedCall for the next change of state of the child.
+        self._later(self.model.slave_latency, self._on_slave_started)
+
+    def _later(self, delay, func, *args):
+        return self.clock.callLater(delay, func, *args)
+
+    def _on_slave_started(self):
+        if self.alive:
+            self.process_protocol.makeConnection(self)
+            if self.model.protocol_version >= 2:
+                self._send("ready %d" % (self.model.protocol_version))
+            else:
+                self._send("ready")
+
+    def _send(self, line):
+        """
+        Sends a line to the master, as if written on the stdout of the lunch-slave.
+        """
+        if self.frozen:
+            return
+        def _deliver():
+            if self.alive and not self.frozen:
+                self.process_protocol.outReceived(line + "\n")
+        self._later(self.model.message_latency, _deliver)
+
+    def _send_frame(self, key, text, fields):
+        """
+        Sends a line with text arguments, or a JSON object once version 2 is used.
+        """
+        if self.protocol_version >= 2:
+            self._send("%s %s" % (key, json.dumps(fields)))
+        else:
+            self._send("%s %s" % (key, text))
+
+    def write(self, data):
+        """
+        Receives lines from the master, as if written on the stdin of the lunch-slave.
+        """
+        for line in data.splitlines():
+            words = line.split(" ")
+            key = words[0]
+            if key in ["do", "logdir", "env"]:
+                self._send("ok")
+            elif key == "start" and self.model.protocol_version >= 2:
+                self.protocol_version = self.model.protocol_version
+                self._start_child()
+            elif key == "run":
+                self._start_child()
+            elif key == "stop":
+                self._stop_child()
+            elif key == "ping":
+                self._send("pong")
+            elif key == "quit":
+                self._send("bye")
+                self._later(0, self._end, 0)
+            else:
+                self._send_error("%s no such command." % (key))
+
+    def _send_error(self, message):
+        self._send_frame("error", message, {"message": message})
+
+    def _set_child_state(self, new_state):
+        if new_state == STATE_STOPPED:
+            running_time = self.clock.seconds() - self._child_started_time
+            self._send_frame("state", "%s %f" % (new_state, running_time), {"state": new_state, "running_time": running_time})
+        else:
+            self._send_frame("state", new_state, {"state": new_state})
+        self.child_state = new_state
+
+    def _cancel_child_call(self):
+        if self._child_call is not None and self._child_call.active():
+            self._child_call.cancel()
+        self._child_call = None
+
+    def _start_child(self):
+        if self.child_state != STATE_STOPPED:
+            self._send_error("Child is already %s. Cannot start it." % (self.child_state))
+            return
+        self._child_started_time = self.clock.seconds()
+        self.child_pid = self.simulator.next_pid()
+        self._set_child_state(STATE_STARTING)
+        self._send_frame("child_pid", str(self.child_pid), {"pid": self.child_pid})
+        if self._start_failures_left > 0:
+            self._start_failures_left -= 1
+            self._child_call = self._later(self.model.start_latency, self._on_child_ended, 1)
+        else:
+            self._child_call = self._later(self.model.start_latency, self._on_child_running)
+
+    def _on_child_running(self):
+        self._child_call = None
+        self._set_child_state(STATE_RUNNING)
+        if self.model.mean_time_to_crash is not None:
+            lifetime = self.simulator.random.expovariate(1.0 / self.model.mean_time_to_crash)
+            self._child_call = self._later(lifetime, self.crash_child)
+
+    def _stop_child(self):
+        if self.child_state in [STATE_RUNNING, STATE_STARTING]:
+            self._cancel_child_call()
+            self._set_child_state(STATE_STOPPING)
+            self._child_call = self._later(self.model.stop_latency, self._on_child_ended, 0)
+        elif self.child_state == STATE_STOPPED:
+            self._send_error("The child process is already stopped.")
+
+    def freeze(self):
+        """
+        Stops answering, while its process stays alive.
+        """
+        self.frozen = True
+
+    def crash_child(self):
+        """
+        Makes the child exit with an error, if it is running.
+        """
+        if self.child_state in [STATE_RUNNING, STATE_STARTING]:
+            self._cancel_child_call()
+            self._on_child_ended(1)
+
+    def _on_child_ended(self, exit_code):
+        self._child_call = None
+        self.child_pid = None
+        self._send_frame("retval", str(exit_code), {"retval": exit_code})
+        self._set_child_state(STATE_STOPPED)
+
+    def signalProcess(self, signal_id):
+        """
+        The lunch-slave and its child die when they receive any signal.
+        """
+        if not self.alive:
+            raise error.ProcessExitedAlready()
+        self._later(0, self._end, None, signal_id)
+
+    def _end(self, exit_code, signal_id=None):
+        if not self.alive:
+            return
+        self.alive = False
+        self._cancel_child_call()
+        self.simulator.slave_ended(self)
+        if exit_code == 0:
+            reason = failure.Failure(error.ProcessDone(0))
+        else:
+            reason = failure.Failure(error.ProcessTerminated(exit_code, signal_id))
+        self.process_protocol.processEnded(reason)
+
+    def loseConnection(self):
+        pass
+
+class FakeCommand(object):
+    """
+    Stands for a L{lunch.commands.Command}, without any lunch-slave.
+    Its state only changes when it is set by hand, such as with set_running.
+    Used by utils/benchmark.py and by the tests of the scheduler.
+    """
+    def __init__(self, identifier, depends=None, sleep_after=0.25):
+        self.identifier = identifier
+        self.depends = depends
+        self.sleep_after = sleep_after
+        self.host = None
+        self.child_state = STATE_STOPPED
+        self.slave_state = STATE_STOPPED
+        self.enabled = True
+        self.respawn = True
+        self.how_many_times_run = 0
+        self.to_be_deleted = False
+        self.verbose = False
+        self._is_starting = False
+        self.next_try_time = 0
+        self.try_again_delay = 0.25
+        self.child_state_changed_signal = sig.Signal()
+        self.slave_state_changed_signal = sig.Signal()
+
+    def is_ready_to_be_started(self, now=None):
+        return self.child_state == STATE_STOPPED and not self._is_starting and self.next_try_time <= now
+
+    def get_next_try_time(self):
+        return self.next_try_time
+
+    def is_starting(self):
+        return self._is_starting
+
+    def start(self):
+        self._is_starting = True
+
+    def stop(self):
+        self.enabled = False
+
+    def get_state_info(self):
+        return self.child_state
+
+    def quit_slave(self):
+        pass
+
+    def set_running(self):
+        self._is_starting = False
+        self.child_state = STATE_RUNNING
+        self.how_many_times_run += 1
+        self.child_state_changed_signal(self, self.child_state)
+
+class SimulatedCommand(commands.Command):
+    """
+    Command whose lunch-slave is a L{FakeSlave}.
+    It does not write any log file.
+    """
+    def __init__(self, simulator, model, **kwargs):
+        self.simulator = simulator
+        self.model = model
+        if kwargs.get("command") is None:
+            kwargs["command"] = "simulated %s" % (kwargs.get("identifier"))
+        commands.Command.__init__(self, clock=simulator.clock, **kwargs)
+
+    def _start_logger(self):
+        pass
+
+    def _spawn_slave(self, args, environ):
+        slave = FakeSlave(self.simulator, self, self._process_protocol, self.model)
+        self.simulator.slaves[self.identifier] = slave
+        return slave
+
+class Simulator(object):
+    """
+    Runs a L{lunch.master.Master} with simulated commands, in virtual time.
+    """
+    def __init__(self, seed=0, model=None, **kwargs):
+        """
+        @param seed: Seed of the random numbers generator.
+        @param model: Default L{ChildModel} for the commands.
+        @param kwargs: Given to the L{lunch.master.Master}. (parallel_launch, event_driven, etc.)
+        """
+        self.clock = Clock()
+        self.random = random.Random(seed)
+        self.model = model
+        if model is None:
+            self.model = ChildModel()
+        self.slaves = {} # dict of str identifier: L{FakeSlave} which are alive.
+        self._not_running = set() # commands whose child is not running.
+        self.cpu_time = 0.0 # processor time spent advancing the clock, in seconds.
+        self.results = {} # dict of measures, in simulated seconds.
+        self._pid = 1000
+        self._started_time = self.clock.seconds()
+        self.master = master.Master(clock=self.clock, **kwargs)
+
+    def next_pid(self):
+        self._pid += 1
+        return self._pid
+
+    def slave_ended(self, slave):
+        if self.slaves.get(slave.command.identifier) is slave:
+            del self.slaves[slave.command.identifier]
+
+    def create_command(self, identifier, depends=None, model=None, **kwargs):
+        """
+        Creates a simulated command, to be given to add_commands.
+        @param model: L{ChildModel}. If None, the default one is used.
+        @param kwargs: Given to the L{lunch.commands.Command}. (sleep_after, respawn, etc.)
+        @rtype: L{SimulatedCommand}
+        """
+        if model is None:
+            model = self.model
+        return SimulatedCommand(self, model, identifier=identifier, depends=depends, **kwargs)
+
+    def add_commands(self, commands):
+        """
+        Adds the simulated commands to the master.
+        @param commands: list of L{SimulatedCommand}.
+        """
+        self.master.add_commands(commands)
+        for command in commands:
+            command.child_state_changed_signal.connect(self._on_child_state_changed)
+            if command.child_state != STATE_RUNNING:
+                self._not_running.add(command)
+
+    def _on_child_state_changed(self, command, new_state):
+        if new_state == STATE_RUNNING:
+            self._not_running.discard(command)
+        else:
+            self._not_running.add(command)
+
+    def _step(self, until):
+        """
+        Advances the clock to the next scheduled call, if not later than the given time.
+        @return: False if there was none.
+        @rtype: C{bool}
+        """
+        next_time = self.clock.get_next_time()
+        if next_time is None or next_time > until:
+            return False
+        begin = time.clock()
+        self.clock.advance(max(0.0, next_time - self.clock.seconds()))
+        self.cpu_time += time.clock() - begin
+        return True
+
+    def advance(self, duration):
+        """
+        Runs the simulation for some time.
+        @param duration: Simulated seconds.
+        """
+        until = self.clock.seconds() + duration
+        while self._step(until):
+            pass
+        self.clock.advance(max(0.0, until - self.clock.seconds()))
+
+    def run_until(self, predicate, timeout=3600.0):
+        """
+        Runs the simulation until the predicate returns True.
+        @param predicate: Callable with no argument.
+        @param timeout: Maximum number of simulated seconds.
+        @return: The simulated time it took, or None if it timed out.
+        """
+        begin = self.clock.seconds()
+        deadline = begin + timeout
+        while not predicate():
+            if not self._step(deadline):
+                return None
+        return self.clock.seconds() - begin
+
+    def all_running(self):
+        """
+        Checks if the child of every enabled command is running.
+        @rtype: C{bool}
+        """
+        for command in self._not_running:
+            if command.enabled and command.identifier in self.master.commands:
+                return False
+        return True
+
+    def cold_start(self, timeout=3600.0):
+        """
+        Runs until all the commands are running.
+        @return: The simulated time it took, or None if it timed out.
+        """
+        self.results["cold_start_time"] = self.run_until(self.all_running, timeout)
+        return self.results["cold_start_time"]
+
+    def inject_crashes(self, identifiers):
+        """
+        Makes the children of the given commands crash now.
+        """
+        for identifier in identifiers:
+            if identifier in self.slaves:
+                self.slaves[identifier].crash_child()
+
+    def freeze_slaves(self, identifiers):
+        """
+        Makes the lunch-slaves of the given commands hang, without dying.
+        """
+        for identifier in identifiers:
+            if identifier in self.slaves:
+                self.slaves[identifier].freeze()
+
+    def recover(self, timeout=3600.0):
+        """
+        Runs until all the commands are running again, after crashes.
+        The children that crash are stopped by the lunch-slave after a few messages,
+        so the clock is first advanced until one of them is not running anymore.
+        @return: The simulated time it took, or None if it timed out.
+        """
+        begin = self.clock.seconds()
+        if self.run_until(lambda: not self.all_running(), timeout) is None:
+            return None
+        if self.run_until(self.all_running, timeout - (self.clock.seconds() - begin)) is None:
+            return None
+        self.results["crash_recovery_time"] = self.clock.seconds() - begin
+        return self.results["crash_recovery_time"]
+
+    def get_report(self):
+        """
+        Returns the measures of the simulation.
+         * commands: How many commands are simulated.
+         * simulated_time: Simulated seconds since the beginning.
+         * cold_start_time: Simulated seconds until all the commands were running.
+         * crash_recovery_time: Simulated seconds until they were all running again after the last injected crashes.
+         * cpu_per_simulated_second: Processor time spent by the master and the fake slaves.
+         * scheduler_cpu_per_simulated_second: Processor time spent by the scheduler of the master.
+        @rtype: C{dict}
+        """
+        simulated_time = self.clock.seconds() - self._started_time
+        stats = self.master.tick_statistics
+        ret = {
+            "commands": len(self.master.commands),
+            "simulated_time": simulated_time,
+            "cold_start_time": self.results.get("cold_start_time"),
+            "crash_recovery_time": self.results.get("crash_recovery_time"),
+            "ticks": stats["ticks"],
+            "cpu_time": self.cpu_time,
+            "scheduler_cpu_time": stats["total_cpu"],
+            "cpu_per_simulated_second": None,
+            "scheduler_cpu_per_simulated_second": None,
+            }
+        if simulated_time > 0:
+            ret["cpu_per_simulated_second"] = self.cpu_time / simulated_time
+            ret["scheduler_cpu_per_simulated_second"] = stats["total_cpu"] / simulated_time
+        return ret
+
+    def cleanup(self):
+        """
+        Quits the fake slaves and stops the master.
+        @rtype: L{twisted.internet.defer.DeferredList}
+        """
+        d = self.master.cleanup()
+        delay = 0.0
+        for command in self.master.get_all_commands():
+            delay = max(delay, command.delay_before_kill)
+        self.advance(2 * delay + 1.0)
+        return d
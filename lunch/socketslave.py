@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Connects a command to a lunch-slave daemon, instead of spawning a lunch-slave.
+
+The daemon is started with "lunch-slave --listen unix:/path/to/socket", or 
+"--listen tcp:port". Each connection to it manages one child, and speaks the 
+same line protocol as the stdin and stdout of a lunch-slave.
+
+The L{lunch.commands.Command} still believes it spawned a process: it is 
+given a L{SocketChannel}, which looks like the transport of a process.
+"""
+import os
+
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.python import failure
+
+from lunch import logger
+
+log = logger.start(name='socketslave')
+
+def parse_address(address):
+    """
+    Parses "unix:/path/to/socket", "tcp:port" or "tcp:host:port".
+    TCP addresses without a host are on 127.0.0.1.
+    @return: ("unix", path) or ("tcp", (host, port)) tuple.
+    @raise ValueError: If the address is invalid.
+    """
+    kind, sep, rest = address.partition(":")
+    if kind == "unix" and rest != "":
+        return ("unix", rest)
+    elif kind == "tcp":
+        host, sep, port = rest.rpartition(":")
+        if host == "":
+            host = "127.0.0.1"
+        if port.isdigit():
+            return ("tcp", (host, int(port)))
+    raise ValueError("Invalid lunch-slave address %s. Use unix:/path/to/socket, tcp:port or tcp:host:port." % (address))
+
+class SocketChannel(object):
+    """
+    Stands for the transport of the lunch-slave process of a command, 
+    when it is a connection to a lunch-slave daemon.
+    """
+    def __init__(self, address, process_protocol):
+        self.address = address
+        self.process_protocol = process_protocol
+        self.transport = None # of the connection, once connected.
+        self.ended = False
+        self._pending = [] # data written before we are connected
+
+    def write(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+        else:
+            self._pending.append(data)
+
+    def signalProcess(self, signal_id):
+        """
+        Asks the daemon to stop the child, and closes the connection.
+        SIGKILL closes it right away.
+        """
+        if self.ended:
+            raise error.ProcessExitedAlready()
+        if signal_id == 9 or self.transport is None:
+            self.loseConnection()
+        else:
+            self.transport.write("quit\n")
+
+    def loseConnection(self):
+        if self.transport is not None:
+            self.transport.loseConnection()
+        elif not self.ended:
+            self.end(None)
+
+    def _connected(self, transport):
+        self.transport = transport
+        self.process_protocol.makeConnection(self)
+        for data in self._pending:
+            transport.write(data)
+        self._pending = []
+
+    def end(self, exit_code):
+        """
+        Tells the command its lunch-slave is gone.
+        """
+        if self.ended:
+            return
+        self.ended = True
+        self.transport = None
+        if exit_code == 0:
+            reason = failure.Failure(error.ProcessDone(0))
+        else:
+            reason = failure.Failure(error.ProcessTerminated(exit_code))
+        self.process_protocol.processEnded(reason)
+
+class SlaveClientProtocol(protocol.Protocol):
+    """
+    Connection to a lunch-slave daemon.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    def connectionMade(self):
+        self.channel._connected(self.transport)
+
+    def dataReceived(self, data):
+        self.channel.process_protocol.outReceived(data)
+
+    def connectionLost(self, reason):
+        if reason.check(error.ConnectionDone):
+            self.channel.end(0)
+        else:
+            log.info("Lost the connection to the lunch-slave at %s: %s" % (self.channel.address, reason.getErrorMessage()))
+            self.channel.end(1)
+
+class SlaveClientFactory(protocol.ClientFactory):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def buildProtocol(self, addr):
+        return SlaveClientProtocol(self.channel)
+
+    def clientConnectionFailed(self, connector, reason):
+        log.error("Could not connect to the lunch-slave at %s: %s" % (self.channel.address, reason.getErrorMessage()))
+        self.channel.end(1)
+
+def connect(address, process_protocol):
+    """
+    Connects to a lunch-slave daemon. 
+    @param address: "unix:/path/to/socket", "tcp:port" or "tcp:host:port".
+    @param process_protocol: L{lunch.commands.SlaveProcessProtocol} of the command.
+    @rtype: L{SocketChannel}
+    @raise ValueError: If the address is invalid.
+    """
+    kind, where = parse_address(address)
+    channel = SocketChannel(address, process_protocol)
+    factory = SlaveClientFactory(channel)
+    if kind == "unix":
+        if not os.path.exists(where):
+            # Twisted fails with a TypeError when connecting to a missing socket.
+            log.error("Could not connect to the lunch-slave at %s: No such file." % (address))
+            reactor.callLater(0, channel.end, 1)
+        else:
+            reactor.connectUNIX(where, factory)
+    else:
+        host, port = where
+        reactor.connectTCP(host, port, factory)
+    return channel
@@ -0,0 +1,38 @@
+"""
+Fake transports, commands and pools shared by the test cases.
+"""
+from lunch import commands
+
+class FakeTransport(object):
+    """
+    Stands for the transport of a lunch-slave process. Keeps the lines written to it.
+    """
+    def __init__(self):
+        self.lines = []
+        self.closed = False
+
+    def write(self, data):
+        self.lines.extend(data.splitlines())
+
+    def loseConnection(self):
+        self.closed = True
+
+class NoLoggerCommand(commands.Command):
+    """
+    Does not write the log file of its lunch-slave.
+    """
+    def _start_logger(self):
+        pass
+
+class SpawnRecorder(object):
+    """
+    Mixin for the pools of lunch-slaves, such as L{lunch.multislave.SlavePool}.
+    Does not spawn any process, but keeps the (process_protocol, args) it was given, and returns a L{FakeTransport}.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SpawnRecorder, self).__init__(*args, **kwargs)
+        self.spawned = [] # list of (process_protocol, args) tuples
+
+    def _spawn(self, process_protocol, args, environ, use_pty=True):
+        self.spawned.append((process_protocol, args))
+        return FakeTransport()
@@ -1,13 +1,17 @@
 """
 Tests for lunch Master
 """
+import time
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.python import failure
 from twisted.internet import reactor
+from twisted.internet import task
 from lunch import master
+from lunch import graph
 from lunch import commands
 from lunch.states import *
+from lunch.simulator import FakeCommand
 
 LOG_LEVEL = "warning"
 #LOG_LEVEL = "info"
@@ -135,3 +139,222 @@ class Test_Master_Advanced(unittest.TestCase):
         #reactor.callLater(DELAY, _cl1)
         return self._deferred
 
+
+class RefusedCommand(FakeCommand):
+    """
+    Its lunch-slave refuses to start its child, without any state change.
+    """
+    how_many_times_tried = 0
+
+    def start(self):
+        self.how_many_times_tried += 1
+
+class Test_Parallel_Launch(unittest.TestCase):
+    def setUp(self):
+        self._master = master.Master(parallel_launch=True)
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def _add(self, *args, **kwargs):
+        command = FakeCommand(*args, **kwargs)
+        self._master.add_command(command)
+        return command
+
+    def test_independent_commands_start_together(self):
+        a = self._add("a", sleep_after=100.0)
+        b = self._add("b", sleep_after=100.0)
+        c = self._add("c", depends=["a"])
+        self._master.main_loop()
+        self.failUnless(a.is_starting())
+        self.failUnless(b.is_starting())
+        self.failIf(c.is_starting())
+        a.set_running()
+        self._master.main_loop()
+        # a is running, but its sleep_after delays c.
+        self.failIf(c.is_starting())
+        # pretend the sleep_after of a is over:
+        self._master._start_gates["a"] = 0
+        self._master.timers.schedule(("gate", "a"), 0)
+        self._master.main_loop()
+        self.failUnless(c.is_starting())
+
+    def test_serial_launch(self):
+        self._master.parallel_launch = False
+        a = self._add("a", sleep_after=100.0)
+        b = self._add("b")
+        self._master.main_loop()
+        self.failUnless(a.is_starting())
+        self.failIf(b.is_starting())
+
+    def test_max_concurrent_starts(self):
+        self._master.max_concurrent_starts = 2
+        commands = [self._add("c%d" % (i)) for i in range(4)]
+        self._master.main_loop()
+        self.failUnlessEqual([c.is_starting() for c in commands], [True, True, False, False])
+        commands[0].set_running()
+        self._master.main_loop()
+        self.failUnlessEqual([c.is_starting() for c in commands], [False, True, True, False])
+
+class Test_Dirty_Nodes(unittest.TestCase):
+    def setUp(self):
+        self._master = master.Master(parallel_launch=True)
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def test_only_changed_nodes_are_evaluated(self):
+        commands = [FakeCommand("c%d" % (i), sleep_after=0.0) for i in range(3)]
+        for command in commands:
+            self._master.add_command(command)
+        commands.append(FakeCommand("d", depends=["c0"], sleep_after=0.0))
+        self._master.add_command(commands[-1])
+        stats = self._master.tick_statistics
+        self._master.main_loop()
+        self.failUnlessEqual(stats["evaluated"], 4)
+        for command in commands[:3]:
+            command.set_running()
+        self._master.main_loop()
+        self.failUnless(commands[-1].is_starting())
+        commands[-1].set_running()
+        self._master.main_loop()
+        self.failUnlessEqual(stats["evaluated"], 2) # d and c0
+        # Nothing changed:
+        self._master.main_loop()
+        self.failUnlessEqual(stats["evaluated"], 0)
+        self.failUnlessEqual(stats["skipped"], 4)
+        # c1 crashed:
+        commands[1].child_state = STATE_STOPPED
+        commands[1].child_state_changed_signal(commands[1], STATE_STOPPED)
+        self._master.main_loop()
+        self.failUnlessEqual(stats["evaluated"], 1)
+        self.failUnless(commands[1].is_starting())
+
+class Test_Bulk(unittest.TestCase):
+    def setUp(self):
+        self._master = master.Master()
+        self._added = []
+        self._removed = []
+        self._master.commands_added_signal.connect(self._on_commands_added)
+        self._master.commands_removed_signal.connect(self._on_commands_removed)
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def _on_commands_added(self, commands):
+        self._added.append([command.identifier for command in commands])
+
+    def _on_commands_removed(self, commands):
+        self._removed.append([command.identifier for command in commands])
+
+    def test_add_and_remove_commands(self):
+        self._master.add_commands([FakeCommand("b", depends=["a"]), FakeCommand("a"), FakeCommand("a"), FakeCommand("c")])
+        self.failUnlessEqual(self._added, [["b", "a", "aX", "c"]])
+        self.failUnlessEqual(self._master.tree.get_launch_order(), ["a", "b", "aX", "c"])
+        self._master.remove_commands(["a", "b", "x"])
+        self._master.main_loop()
+        self.failUnlessEqual(self._removed, [["a", "b"]])
+        self.failUnlessEqual(sorted(self._master.commands.keys()), ["aX", "c"])
+        self.failUnlessEqual(self._master.tree.get_launch_order(), ["aX", "c"])
+
+    def test_add_commands_is_atomic(self):
+        self._master.add_command(FakeCommand("a"))
+        refused = [FakeCommand("a"), FakeCommand(None), FakeCommand("c", depends=["x"])]
+        self.failUnlessRaises(graph.GraphError, self._master.add_commands, refused)
+        self.failUnlessRaises(graph.GraphError, self._master.add_command, FakeCommand(None, depends=["x"]))
+        self.failUnlessEqual([command.identifier for command in refused], ["a", None, "c"])
+        self.failUnlessEqual(self._master.commands.keys(), ["a"])
+        self.failUnlessEqual(self._master.tree.get_all_nodes(), [graph.DirectedGraph.ROOT, "a"])
+        self.failUnlessEqual(self._added, [["a"]])
+
+class Test_Config_File(unittest.TestCase):
+    def setUp(self):
+        self._master = master.Master()
+        self._master.wants_to_live = False # does not start their lunch-slaves
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def _execute(self, code):
+        path = self.mktemp()
+        f = open(path, "w")
+        f.write(code)
+        f.close()
+        master.execute_config_file(self._master, path, chmod_config_file=False)
+
+    def test_commands_are_added_right_away(self):
+        self._execute("add_command('xeyes', identifier='a')\n"
+            "assert lunch_master.get_command('a').identifier == 'a'\n"
+            "add_command('xclock', identifier='b', depends=['a'])\n")
+        self.failUnlessEqual(self._master.tree.get_launch_order(), ["a", "b"])
+
+    def test_wrong_dependency(self):
+        self.failUnlessRaises(graph.GraphError, self._execute, "add_command('xeyes', identifier='a')\n"
+            "add_command('xclock', identifier='b', depends=['x'])\n")
+        self.failUnlessEqual(self._master.commands.keys(), ["a"])
+
+class Test_Event_Driven(unittest.TestCase):
+    timeout = 4.0
+
+    def setUp(self):
+        self._master = master.Master(event_driven=True)
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def test_no_polling(self):
+        self.failIf(self._master._looping_call.running)
+        self._master.set_event_driven(False)
+        self.failUnless(self._master._looping_call.running)
+
+    def test_start_on_state_changes(self):
+        a = FakeCommand("a", sleep_after=0.05)
+        b = FakeCommand("b", depends=["a"])
+        self._master.add_command(a)
+        self._master.add_command(b)
+
+        def _check_a_starting():
+            self.failUnless(a.is_starting())
+            self.failIf(b.is_starting())
+            a.set_running()
+            # b needs to wait for the sleep_after of a
+            return task.deferLater(reactor, 0.01, _check_b_waiting)
+
+        def _check_b_waiting():
+            self.failIf(b.is_starting())
+            self.failUnless("b" in self._master._gated)
+            self.failUnlessEqual(self._master.timers.get_earliest(), self._master.launch_next_time)
+            return task.deferLater(reactor, 0.1, _check_b_starting)
+
+        def _check_b_starting():
+            self.failUnless(b.is_starting())
+
+        return task.deferLater(reactor, 0.01, _check_a_starting)
+
+    def test_retry_deadline(self):
+        a = FakeCommand("a")
+        a.next_try_time = time.time() + 0.05
+        self._master.add_command(a)
+
+        def _check_waiting():
+            self.failIf(a.is_starting())
+            self.failUnless(("retry", "a") in self._master.timers)
+            return task.deferLater(reactor, 0.1, _check_starting)
+
+        def _check_starting():
+            self.failUnless(a.is_starting())
+
+        return task.deferLater(reactor, 0.01, _check_waiting)
+
+    def test_retry_refused_start(self):
+        a = RefusedCommand("a", sleep_after=0.01)
+        a.try_again_delay = 0.02
+        self._master.add_command(a)
+
+        def _check_retried():
+            self.failUnless(a.how_many_times_tried >= 2)
+            self.failUnless(("retry", "a") in self._master.timers)
+            a.set_running()
+            self.failIf(("retry", "a") in self._master.timers)
+
+        return task.deferLater(reactor, 0.1, _check_retried)
@@ -0,0 +1,41 @@
+"""
+Tests for the splitting of streams into lines.
+"""
+from twisted.trial import unittest
+from lunch import framing
+from lunch.test.test_slave import load_slave_script
+
+class Test_Line_Framer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.framer = self.make_framer(self.batches.append, 10)
+
+    def make_framer(self, callback, max_length):
+        return framing.LineFramer(callback, max_length)
+
+    def test_chunks(self):
+        self.framer.feed("hel")
+        self.framer.feed("lo\n\nwor")
+        self.framer.feed("ld\r\nfoo")
+        self.failUnlessEqual(self.batches, [["hello", ""], ["world"]])
+        self.framer.flush()
+        self.failUnlessEqual(self.batches[-1], ["foo"])
+        self.framer.flush()
+        self.failUnlessEqual(len(self.batches), 3)
+
+    def test_max_length(self):
+        self.framer.feed("0123456789abc\nshort\n")
+        self.failUnlessEqual(self.batches, [["0123456789", "short"]])
+        # A line which does not end is cut once it is too long:
+        self.framer.feed("0123456789")
+        self.framer.feed("abcdef")
+        self.framer.feed("ghi\nlast\n")
+        self.failUnlessEqual(self.batches[1:], [["0123456789"], ["last"]])
+        self.failUnlessEqual(self.framer.truncated, 2)
+
+class Test_Slave_Line_Framer(Test_Line_Framer):
+    """
+    The lunch-slave script has its own copy of the LineFramer.
+    """
+    def make_framer(self, callback, max_length):
+        return load_slave_script().LineFramer(callback, max_length)
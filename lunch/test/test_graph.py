@@ -1,6 +1,7 @@
 """
 Tests for the oriented ordred graph. (for process dependencies between each other)
 """
+import random
 from twisted.trial import unittest
 from lunch import graph
 
@@ -110,6 +111,174 @@ class Test_Graph(unittest.TestCase):
         all = g.get_all_dependees("a")
         self.failUnlessEqual(all, ["b", "c", "d"])
 
+    def test_remove_node(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        g.add_node("b", ["a"])
+        g.add_node("c", ["a", "b"])
+        g.remove_node("a")
+        self.failUnlessEqual(g.get_all_nodes(), [g.get_root(), "b", "c"])
+        # b has no dependency left, so it depends on the root
+        self.failUnlessEqual(g.get_dependencies("b"), [g.get_root()])
+        self.failUnlessEqual(g.get_dependencies("c"), ["b"])
+        self.failUnlessEqual(g.get_supported_by(g.get_root()), ["b"])
+        self.failUnlessRaises(graph.GraphError, g.remove_node, "a")
+
+    def test_supported_by_keeps_nodes_order(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        g.add_node("b")
+        g.add_node("c", ["a"])
+        g.add_dependency("b", "a")
+        # b was added before c, so it comes first
+        self.failUnlessEqual(g.get_supported_by("a"), ["b", "c"])
+
+def check_closure(test, g):
+    """
+    Compares the cached ancestors and descendants with those found recursively.
+    """
+    for node in g.get_all_nodes():
+        if node == g.ROOT:
+            continue
+        test.failUnlessEqual(g.get_ancestors(node), set(g.get_all_dependencies(node)))
+        test.failUnlessEqual(g.get_descendants(node), set(g.get_all_dependees(node)))
+
+class Test_Closure(unittest.TestCase):
+    """
+    Checks that the cached ancestors and descendants are kept up-to-date.
+    """
+    def _check_closure(self, g):
+        check_closure(self, g)
+
+    def test_diamond(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        g.add_node("b", ["a"])
+        g.add_node("c", ["a"])
+        g.add_node("d", ["b", "c"])
+        self.failUnlessEqual(g.get_ancestors("d"), set(["a", "b", "c"]))
+        self.failUnlessEqual(g.get_descendants("a"), set(["b", "c", "d"]))
+        g.remove_dependency("d", "b")
+        # d still depends on a, through c
+        self.failUnlessEqual(g.get_ancestors("d"), set(["a", "c"]))
+        self.failUnlessEqual(g.get_descendants("a"), set(["b", "c", "d"]))
+        self.failUnlessEqual(g.get_descendants("b"), set())
+        g.remove_node("c")
+        self.failUnlessEqual(g.get_ancestors("d"), set())
+        self.failUnlessEqual(g.get_descendants("a"), set(["b"]))
+        self._check_closure(g)
+
+    def test_depends_on_root(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        self.failUnless(g.depends_on("a", g.ROOT))
+        self.failIf(g.depends_on(g.ROOT, "a"))
+        self.failUnlessRaises(graph.GraphError, g.depends_on, "x", "a")
+
+    def test_random_changes(self):
+        rand = random.Random(1234)
+        g = graph.DirectedGraph()
+        names = []
+        for i in range(60):
+            name = "n%d" % (i)
+            deps = rand.sample(names, min(len(names), rand.randint(0, 3)))
+            if deps == []:
+                deps = None
+            g.add_node(name, deps)
+            names.append(name)
+        self._check_closure(g)
+        for i in range(40):
+            node_from, node_to = rand.sample(names, 2)
+            if node_to in g.get_dependencies(node_from):
+                g.remove_dependency(node_from, node_to)
+            else:
+                try:
+                    g.add_dependency(node_from, node_to)
+                except graph.GraphError:
+                    pass
+            self._check_closure(g)
+        for name in rand.sample(names, 20):
+            g.remove_node(name)
+            names.remove(name)
+            self._check_closure(g)
+
+class Test_Bulk(unittest.TestCase):
+    """
+    Adding and removing many nodes at once.
+    """
+    def test_add_nodes(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        # dependencies can be listed after the nodes that need them:
+        g.add_nodes([("d", ["b", "c"]), ("b", "a"), ("c", None), ("e", [])])
+        self.failUnlessEqual(g.get_all_nodes(), [g.ROOT, "a", "d", "b", "c", "e"])
+        self.failUnlessEqual(g.get_launch_order(), ["a", "b", "c", "d", "e"])
+        self.failUnlessEqual(g.get_ancestors("d"), set(["a", "b", "c"]))
+        self.failUnlessEqual(g.get_descendants("a"), set(["b", "d"]))
+        check_closure(self, g)
+
+    def test_add_nodes_is_atomic(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        g.add_node("b", "a")
+        self.failUnlessRaises(graph.GraphError, g.add_nodes, [("c", "b"), ("d", "x")])
+        self.failUnlessRaises(graph.GraphError, g.add_nodes, [("c", ["b", "e"]), ("e", "c")])
+        self.failUnlessRaises(graph.GraphError, g.add_nodes, [("a", "c"), ("c", "b")])
+        self.failUnlessEqual(g.get_all_nodes(), [g.ROOT, "a", "b"])
+        self.failUnlessEqual(g.get_dependencies("a"), [g.ROOT])
+        self.failUnlessEqual(g.get_supported_by("b"), [])
+        self.failUnlessEqual(g.get_descendants("a"), set(["b"]))
+        self.failUnlessEqual(g.get_launch_order(), ["a", "b"])
+
+    def test_same_as_add_node(self):
+        rand = random.Random(4321)
+        items = []
+        names = []
+        for i in range(100):
+            name = "n%d" % (i)
+            items.append((name, rand.sample(names, min(len(names), rand.randint(0, 3)))))
+            names.append(name)
+        one_by_one = graph.DirectedGraph()
+        for name, deps in items:
+            one_by_one.add_node(name, deps)
+        at_once = graph.DirectedGraph()
+        at_once.add_nodes(items)
+        self.failUnlessEqual(at_once.get_launch_order(), one_by_one.get_launch_order())
+        for name in names:
+            self.failUnlessEqual(at_once.get_ancestors(name), one_by_one.get_ancestors(name))
+            self.failUnlessEqual(at_once.get_descendants(name), one_by_one.get_descendants(name))
+        removed = rand.sample(names, 30)
+        for name in removed:
+            one_by_one.remove_node(name)
+        at_once.remove_nodes(removed)
+        self.failUnlessEqual(at_once.get_all_nodes(), one_by_one.get_all_nodes())
+        self.failUnlessEqual(at_once.get_launch_order(), one_by_one.get_launch_order())
+        check_closure(self, at_once)
+
+    def test_add_nodes_in_batches(self):
+        rand = random.Random(2468)
+        g = graph.DirectedGraph()
+        names = []
+        for batch in range(10):
+            items = []
+            for i in range(10):
+                name = "n%d" % (len(names) + i)
+                items.append((name, rand.sample(names, min(len(names), rand.randint(0, 3)))))
+            # existing nodes can get new dependencies as well:
+            old = rand.sample(names, min(len(names), 2))
+            for name in old:
+                items.append((name, rand.sample([item[0] for item in items], 1)))
+            try:
+                g.add_nodes(items)
+            except graph.GraphError:
+                g.add_nodes(items[:10])
+            names.extend([item[0] for item in items[:10]])
+            check_closure(self, g)
+        self.failUnlessRaises(graph.GraphError, g.add_nodes, [("x", "n0"), ("n0", "x")])
+        check_closure(self, g)
+        g.remove_nodes(rand.sample(names, 40))
+        check_closure(self, g)
+
 class Test_Traversal(unittest.TestCase):
     """
     Many tests using the same tree which contains all the cases.
@@ -155,5 +324,25 @@ class Test_Traversal(unittest.TestCase):
         visited = []
         for n in iterator:
             visited.append(n)
-        self.failUnlessEqual(visited, [self.g.ROOT, "a", "b", "c", "d", "e", "f", "g", "h", "i", "j"])
+        # i depends on both h and j, so it comes after j
+        self.failUnlessEqual(visited, [self.g.ROOT, "a", "b", "c", "d", "e", "f", "g", "h", "j", "i"])
+
+    def test_launch_order_is_cached(self):
+        order = self.g.get_launch_order()
+        self.failUnlessIdentical(order, self.g.get_launch_order())
+        self.g.add_node("k", ["c"])
+        order = self.g.get_launch_order()
+        self.failUnlessEqual(order, ["a", "b", "c", "k", "d", "e", "f", "g", "h", "j", "i"])
+        self.g.remove_node("b")
+        # c and d now depend on the root, but keep the place they were added at
+        self.failUnlessEqual(self.g.get_launch_order(), ["a", "c", "k", "d", "e", "f", "g", "h", "j", "i"])
+
+    def test_levels(self):
+        self.failUnlessEqual(self.g.get_level(self.g.ROOT), 0)
+        self.failUnlessEqual(self.g.get_level("a"), 1)
+        self.failUnlessEqual(self.g.get_level("d"), 3)
+        self.failUnlessEqual(self.g.get_level("i"), 2)
+        self.failUnlessEqual(self.g.get_levels(), [["a", "e", "g", "h", "j"], ["b", "f", "i"], ["c", "d"]])
+        self.g.add_dependency("i", "d")
+        self.failUnlessEqual(self.g.get_level("i"), 4)
 
@@ -0,0 +1,85 @@
+"""
+Tests for the lunch-slave shared between the commands of a host.
+"""
+from twisted.trial import unittest
+from twisted.internet import error
+from twisted.internet import task
+from twisted.python import failure
+from lunch import commands
+from lunch import master
+from lunch import multislave
+from lunch.states import *
+from lunch.test.fakes import SpawnRecorder
+
+master.start_stdout_logging("warning")
+
+class FakePool(SpawnRecorder, multislave.SlavePool):
+    pass
+
+class Test_Shared_Slave(unittest.TestCase):
+    def setUp(self):
+        self.pool = FakePool()
+        log_dir = self.mktemp()
+        self.commands = {}
+        for identifier in ["a", "b"]:
+            command = commands.Command("xeyes", identifier=identifier, host="example.org", log_dir=log_dir)
+            command.slave_pool = self.pool
+            self.commands[identifier] = command
+
+    def test_one_slave_per_pty_mode(self):
+        self.commands["b"].use_pty = False
+        self.commands["a"].start()
+        self.commands["b"].start()
+        self.failUnlessEqual([args for process_protocol, args in self.pool.spawned], [
+            ["ssh", "example.org", "lunch-slave", "--multi"],
+            ["ssh", "-T", "-o", "BatchMode=yes", "example.org", "lunch-slave", "--multi"]])
+        self.failUnlessEqual(sorted(self.pool.host_slaves.keys()), [("example.org", None, None, False), ("example.org", None, None, True)])
+
+    def test_ssh_setup_time(self):
+        clock = task.Clock()
+        self.pool = FakePool(clock=clock)
+        ssh_pool = commands.SSHConnectionPool(directory=self.mktemp())
+        a = self.commands["a"]
+        a.slave_pool = self.pool
+        a.ssh_pool = ssh_pool
+        a.start()
+        self.host_slave = self.pool.host_slaves[("example.org", None, None, True)]
+        self.host_slave.process_protocol.connectionMade()
+        clock.advance(1.5)
+        self._receive("* ready\r\n")
+        self.failUnlessEqual(ssh_pool.get_statistics()["miss_setup_time"], 1.5)
+
+    def _receive(self, data):
+        self.host_slave.process_protocol.outReceived(data)
+
+    def test_one_slave_per_host(self):
+        a = self.commands["a"]
+        b = self.commands["b"]
+        a.start()
+        b.start()
+        self.failUnlessEqual([args for process_protocol, args in self.pool.spawned], [["ssh", "example.org", "lunch-slave", "--multi"]])
+        self.host_slave = self.pool.host_slaves[("example.org", None, None, True)]
+        self.host_slave.process_protocol.connectionMade()
+        self._receive("* msg Welcome\r\n* ready\r\n")
+        self.failUnlessEqual(a.slave_state, STATE_RUNNING)
+        self.failUnlessEqual(b.slave_state, STATE_RUNNING)
+        transport = self.host_slave.transport
+        self.failUnlessEqual(sorted(transport.lines), ["* add a", "* add b"])
+        # lines can be split anywhere:
+        self._receive("a rea")
+        self._receive("dy\r\nb ready\r\n")
+        self.failUnless("a do xeyes" in transport.lines)
+        self.failUnless("b run " in transport.lines)
+        self._receive("a state STARTING\r\na state RUNNING\r\n")
+        self.failUnlessEqual(a.child_state, STATE_RUNNING)
+        self.failUnlessEqual(b.child_state, STATE_STOPPED)
+        # a quits:
+        a._process_transport.signalProcess(15)
+        self.failUnlessEqual(transport.lines[-1], "a quit")
+        self._receive("a state STOPPED 2.0\r\na bye\r\n")
+        self.failUnlessEqual(a.slave_state, STATE_STOPPED)
+        self.failUnlessEqual(self.host_slave.channels.keys(), ["b"])
+        # the shared lunch-slave dies:
+        self.host_slave.process_protocol.processEnded(failure.Failure(error.ProcessTerminated(1)))
+        self.failUnlessEqual(b.slave_state, STATE_STOPPED)
+        self.failUnlessEqual(self.pool.host_slaves, {})
@@ -0,0 +1,298 @@
+"""
+Tests for the protocol between the master and the lunch-slave.
+"""
+import os
+import sys
+import json
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.test import proto_helpers
+from lunch import commands
+from lunch import master
+from lunch.states import *
+from lunch.test.test_slave import load_slave_script
+from lunch.test.test_slave import get_slave_script_path
+from lunch.test.test_socketslave import wait_until
+from lunch.test.fakes import FakeTransport
+from lunch.test.fakes import NoLoggerCommand
+
+master.start_stdout_logging("warning")
+
+class TransportCommand(NoLoggerCommand):
+    """
+    Its lunch-slave is a L{FakeTransport}.
+    """
+    def _spawn_slave(self, args, environ):
+        self._process_protocol.makeConnection(FakeTransport())
+        return self._process_protocol.transport
+
+class Test_Master_Protocol(unittest.TestCase):
+    def setUp(self):
+        self.command = TransportCommand("xeyes -g '10x10'", identifier="xeyes", env={"TITLE": "two words", "A": "b=c"}, log_dir="/tmp/lunch logs")
+        self.command.start()
+        self.transport = self.command._process_transport
+        self.protocol = self.command._process_protocol
+
+    def test_version_2(self):
+        self.protocol.outReceived("msg Welcome\nready 2\n")
+        self.assertEqual(self.command.protocol_version, 2)
+        self.assertEqual(len(self.transport.lines), 1)
+        key, sep, mess = self.transport.lines[0].partition(" ")
+        self.assertEqual(key, "start")
+        frame = json.loads(mess)
+        self.assertEqual(frame["command"], "xeyes -g '10x10'")
+        self.assertEqual(frame["env"], {"TITLE": "two words", "A": "b=c"})
+        self.assertEqual(frame["logdir"], "/tmp/lunch logs")
+        # the frames can be split between reads
+        self.protocol.outReceived('child_pid {"pid": 12')
+        self.protocol.outReceived('3}\r\nstate {"state": "RUNNING"}\r\n')
+        self.assertEqual(self.command.child_pid, 123)
+        self.assertEqual(self.command.child_state, STATE_RUNNING)
+        self.protocol.outReceived('retval {"retval": 2}\nstate {"state": "STOPPED", "running_time": 10.0}\n')
+        self.assertEqual(self.command.retval, 2)
+        self.assertEqual(self.command.child_state, STATE_STOPPED)
+        # frames without the expected fields are logged and ignored:
+        self.protocol.outReceived('state {"running_time": 1.0}\noutput {}\nchild_pid {"pid": null}\n')
+        self.assertEqual(self.command.child_state, STATE_STOPPED)
+
+    def test_version_1(self):
+        self.protocol.outReceived("ready\n")
+        self.assertEqual(self.command.protocol_version, 1)
+        keys = [line.split(" ")[0] for line in self.transport.lines]
+        self.assertEqual(keys, ["do", "logdir", "env", "run"])
+        self.assertEqual(self.transport.lines[2], "env A=b=c 'TITLE=two words'")
+        self.protocol.outReceived("child_pid 123\nstate RUNNING\n")
+        self.assertEqual(self.command.child_pid, 123)
+        self.assertEqual(self.command.child_state, STATE_RUNNING)
+        # in version 1, braces are not a JSON object:
+        self._not_found = []
+        self.command.command_not_found_signal.connect(self._on_not_found)
+        self.protocol.outReceived("not_found { a; b; }\n")
+        self.assertEqual(self._not_found, ["xeyes -g '10x10'"])
+
+    def _on_not_found(self, command, command_line):
+        self._not_found.append(command_line)
+
+    def test_slave_options(self):
+        self.command.slave_options = {"direct_exec": True, "use_pty": False, "log_generations": 5}
+        self.protocol.outReceived("ready\n")
+        opts = [line for line in self.transport.lines if line.startswith("opt ")]
+        self.assertEqual(opts, ["opt direct_exec 1", "opt log_generations 5", "opt use_pty 0"])
+        self.command.protocol_version = 2
+        self.command.send_start()
+        frame = json.loads(self.transport.lines[-1].partition(" ")[2])
+        self.assertEqual(frame["options"], {"delay_kill": 8.0, "direct_exec": True, "use_pty": False, "log_generations": 5})
+
+class Test_Slave_Protocol(unittest.TestCase):
+    def setUp(self):
+        self.module = load_slave_script()
+        self.slave = self.module.Slave(identifier="test")
+        self.started = []
+        self.slave.start_child = lambda: self.started.append(True)
+        self.slave_io = self.module.SlaveIO(self.slave)
+        self.transport = proto_helpers.StringTransport()
+        self.slave_io.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.slave.close()
+
+    def _send(self, line):
+        self.transport.clear()
+        self.slave_io.dataReceived(line + "\n")
+        return self.transport.value().splitlines()
+
+    def test_version_1(self):
+        self.assertTrue("ready 2" in self.transport.value().splitlines())
+        self._send("env A=b=c 'TITLE=two words'")
+        self.assertEqual(self.slave.env, {"A": "b=c", "TITLE": "two words"})
+        self.assertEqual(self._send("ping"), ["pong"])
+        self.assertEqual(self._send("status"), ["status STOPPED"])
+
+    def test_start(self):
+        log_dir = self.mktemp()
+        frame = {"version": 2, "command": "xeyes", "env": {"TITLE": "two words"}, "logdir": log_dir, "options": {"delay_kill": 2}}
+        self._send("start " + json.dumps(frame))
+        self.assertEqual(self.started, [True])
+        self.assertEqual(self.slave.command, "xeyes")
+        self.assertEqual(self.slave.env, {"TITLE": "two words"})
+        self.assertEqual(self.slave.log_dir, log_dir)
+        self.assertEqual(self.slave.options["delay_kill"], 2.0)
+        self.assertEqual(self._send("status"), ['status {"state": "STOPPED"}'])
+
+    def test_forward_output(self):
+        self._send("opt forward_output 1")
+        self.slave_io.forward_output(["one", "two"])
+        self.assertTrue(self.transport.producer is self.slave_io.output_forwarder)
+        self.assertEqual(self._send("ping"), ["pong"])
+        self.slave_io.output_forwarder.pauseProducing() # the master reads slower than we write
+        self.transport.clear()
+        self.slave_io.forward_output(["three"])
+        self.slave_io.send_state("STOPPED")
+        self.assertEqual(self.transport.value().splitlines(), ["state STOPPED"])
+        self.transport.clear()
+        self.slave_io.output_forwarder.resumeProducing()
+        self.assertEqual(self.transport.value().splitlines(), ["output three"])
+
+    def test_bad_start(self):
+        lines = self._send("start {not json")
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("error "))
+        self.assertEqual(self.started, [])
+
+    def test_bad_option_value(self):
+        for options in [{"delay_kill": "fast"}, {"log_max_size": None}, {"direct_exec": "maybe", "delay_kill": 2}]:
+            lines = self._send("start " + json.dumps({"version": 2, "command": "xeyes", "options": options}))
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith("error "))
+            self.assertEqual(self.started, [])
+            self.assertEqual(self.slave.options["delay_kill"], 8.0)
+        self._send("start " + json.dumps({"version": 2, "command": "xeyes", "options": {"direct_exec": False, "use_pty": 0, "kill_group": "false"}}))
+        self.assertEqual(self.started, [True])
+        self.assertEqual(self.slave.options["direct_exec"], False)
+        self.assertEqual(self.slave.options["use_pty"], False)
+        self.assertEqual(self.slave.options["kill_group"], False)
+
+class LocalScriptCommand(commands.Command):
+    """
+    Runs the lunch-slave script of this source tree, with the current Python interpreter.
+    """
+    def __init__(self, *args, **kwargs):
+        commands.Command.__init__(self, *args, **kwargs)
+        self.received_keys = []
+
+    def _spawn_process(self, args, environ):
+        args = [sys.executable, get_slave_script_path()] + args[1:]
+        return reactor.spawnProcess(self._process_protocol, args[0], args, environ, usePTY=self.use_pty)
+
+    def _received_message(self, line):
+        self.received_keys.append(line.split(" ")[0])
+        commands.Command._received_message(self, line)
+
+def is_alive(pid):
+    """
+    Checks if a process exists, and is not a zombie.
+    """
+    try:
+        f = open("/proc/%d/stat" % (pid))
+        data = f.read()
+        f.close()
+    except IOError:
+        return False
+    return data[data.rindex(")") + 1:].split()[0] != "Z"
+
+class Test_Pipe_Transport(unittest.TestCase):
+    timeout = 20
+
+    def _wait_for_state(self, command, state):
+        self._waiting = (state, defer.Deferred())
+        return self._waiting[1]
+
+    def _on_state_changed(self, command, new_state):
+        state, d = self._waiting
+        if new_state == state and not d.called:
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def test_no_echo(self):
+        command = LocalScriptCommand("sleep 30", identifier="sleeper", log_dir=os.path.abspath(self.mktemp()), use_pty=False)
+        command.child_state_changed_signal.connect(self._on_state_changed)
+        running = self._wait_for_state(command, STATE_RUNNING)
+        command.start()
+        yield running
+        self.assertEqual(command.protocol_version, 2)
+        for key in ["do", "env", "run", "logdir", "start"]:
+            self.assertFalse(key in command.received_keys)
+        stopped = self._wait_for_state(command, STATE_STOPPED)
+        command.stop()
+        yield stopped
+        yield command.quit_slave()
+
+    def _on_not_found(self, command, command_line):
+        self._not_found.append(command_line)
+
+    @defer.inlineCallbacks
+    def test_direct_exec(self):
+        command = LocalScriptCommand("sleep 30", identifier="sleeper", log_dir=os.path.abspath(self.mktemp()), slave_options={"direct_exec": True, "use_pty": False})
+        command.child_state_changed_signal.connect(self._on_state_changed)
+        running = self._wait_for_state(command, STATE_RUNNING)
+        command.start()
+        yield running
+        yield wait_until(lambda: command.child_pid is not None)
+        # no shell in between:
+        cmdline = open("/proc/%d/cmdline" % (command.child_pid)).read().split("\0")
+        self.assertEqual(os.path.basename(cmdline[0]), "sleep")
+        stopped = self._wait_for_state(command, STATE_STOPPED)
+        command.stop()
+        yield stopped
+        yield command.quit_slave()
+
+    @defer.inlineCallbacks
+    def test_stop_process_group(self):
+        command = LocalScriptCommand("sleep 30 | sleep 31", identifier="pipeline", log_dir=os.path.abspath(self.mktemp()), slave_options={"use_pty": False, "kill_descendants": True})
+        command.child_state_changed_signal.connect(self._on_state_changed)
+        running = self._wait_for_state(command, STATE_RUNNING)
+        command.start()
+        yield running
+        yield wait_until(lambda: command.child_pid is not None)
+        yield wait_until(lambda: len(load_slave_script().get_descendants(command.child_pid)) == 2)
+        pids = [command.child_pid] + load_slave_script().get_descendants(command.child_pid)
+        stopped = self._wait_for_state(command, STATE_STOPPED)
+        command.stop()
+        yield stopped
+        yield command.quit_slave()
+        yield wait_until(lambda: not [pid for pid in pids if is_alive(pid)])
+
+    @defer.inlineCallbacks
+    def test_keep_previous_log(self):
+        log_dir = os.path.abspath(self.mktemp())
+        command = LocalScriptCommand("echo hello", identifier="hello", log_dir=log_dir, respawn=False, slave_options={"log_generations": 2})
+        for i in range(2):
+            command.start()
+            yield wait_until(lambda: command.how_many_times_run == i + 1 and command.child_state == STATE_STOPPED)
+        log_file = os.path.join(log_dir, "child-hello.log")
+        yield wait_until(lambda: os.path.exists(log_file + ".1.gz"))
+        self.assertEqual(open(log_file).read(), "hello\n")
+        yield command.quit_slave()
+
+    @defer.inlineCallbacks
+    def test_tail(self):
+        command = LocalScriptCommand("sh -c 'echo one; echo two; sleep 30'", identifier="talker", log_dir=os.path.abspath(self.mktemp()))
+        command.request_tail(follow=True) # sent once the lunch-slave is ready
+        command.start()
+        yield wait_until(lambda: list(command.recent_output) == ["one", "two"])
+        command.request_tail(1)
+        yield wait_until(lambda: list(command.recent_output) == ["two"])
+        command.stop_tail()
+        command.stop()
+        yield wait_until(lambda: command.child_state == STATE_STOPPED)
+        yield command.quit_slave()
+
+    @defer.inlineCallbacks
+    def test_forward_output(self):
+        command = LocalScriptCommand("sh -c 'echo one; echo two; sleep 30'", identifier="forwarded", log_dir=os.path.abspath(self.mktemp()), slave_options={"forward_output": True})
+        command.start()
+        yield wait_until(lambda: list(command.recent_output) == ["one", "two"])
+        command.stop()
+        yield wait_until(lambda: command.child_state == STATE_STOPPED)
+        yield command.quit_slave()
+        self.assertEqual(open(os.path.join(command.slave_log_dir, "forwarded-forwarded.log")).read(), "one\ntwo\n")
+
+    @defer.inlineCallbacks
+    def test_direct_exec_not_found(self):
+        self._not_found = []
+        command = LocalScriptCommand("no-such-executable --help", identifier="nothing", log_dir=os.path.abspath(self.mktemp()), slave_options={"direct_exec": True}, respawn=False)
+        command.command_not_found_signal.connect(self._on_not_found)
+        command.start()
+        yield wait_until(lambda: command.slave_state == STATE_RUNNING and not command.is_starting())
+        self.assertEqual(self._not_found, ["no-such-executable --help"])
+        self.assertEqual(command.child_state, STATE_STOPPED)
+        yield command.quit_slave()
+
+    @defer.inlineCallbacks
+    def test_direct_exec_not_found_is_retried(self):
+        lunch_master = master.Master(event_driven=True)
+        command = LocalScriptCommand("no-such-executable --help", identifier="nothing", log_dir=os.path.abspath(self.mktemp()), slave_options={"direct_exec": True}, try_again_delay=0.1)
+        lunch_master.add_command(command)
+        yield wait_until(lambda: command.how_many_times_tried >= 6) # it used to stop being retried after 4 tries
+        yield lunch_master.cleanup()
@@ -0,0 +1,97 @@
+"""
+Tests for the simulation of a Lunch Master with fake lunch-slaves.
+"""
+from twisted.trial import unittest
+from lunch import commands
+from lunch import master
+from lunch import simulator
+from lunch.states import *
+
+master.start_stdout_logging("warning")
+
+class Test_Simulator(unittest.TestCase):
+    def _simulate(self, seed=0, **kwargs):
+        simulation = simulator.Simulator(seed=seed, **kwargs)
+        commands = []
+        for i in range(20):
+            depends = None
+            if i % 5 != 0:
+                depends = ["n%d" % (i - 1)]
+            commands.append(simulation.create_command("n%d" % (i), depends=depends, sleep_after=0.1))
+        simulation.add_commands(commands)
+        self.addCleanup(simulation.cleanup)
+        return simulation
+
+    def test_cold_start_and_recovery(self):
+        simulation = self._simulate(event_driven=True)
+        # started one after the other
+        self.failUnlessApproximates(simulation.cold_start(), 20 * 0.1, 0.2)
+        simulation.inject_crashes(["n0"])
+        recovery_time = simulation.recover()
+        self.failIfEqual(recovery_time, None)
+        report = simulation.get_report()
+        self.failUnlessEqual(report["commands"], 20)
+        self.failUnlessEqual(report["crash_recovery_time"], recovery_time)
+        self.failUnless(report["scheduler_cpu_per_simulated_second"] > 0)
+        # the dependees of n0 were restarted as well:
+        for i in range(5):
+            self.failUnlessEqual(simulation.master.get_command("n%d" % (i)).how_many_times_run, 2)
+        self.failUnlessEqual(simulation.master.get_command("n5").how_many_times_run, 1)
+
+    def test_parallel_launch_is_faster(self):
+        serial = self._simulate(event_driven=True).cold_start()
+        parallel = self._simulate(event_driven=True, parallel_launch=True).cold_start()
+        self.failUnless(parallel < serial)
+
+    def test_deterministic(self):
+        model = simulator.ChildModel(mean_time_to_crash=5.0, start_failures=1)
+        results = []
+        for i in range(2):
+            simulation = self._simulate(seed=42, model=model)
+            simulation.advance(30.0)
+            results.append([command.how_many_times_tried for command in simulation.master.get_all_commands()])
+        self.failUnlessEqual(results[0], results[1])
+
+    def test_protocol_version_1(self):
+        model = simulator.ChildModel(protocol_version=1)
+        simulation = self._simulate(model=model, event_driven=True)
+        self.failIfEqual(simulation.cold_start(), None)
+        for command in simulation.master.get_all_commands():
+            self.failUnlessEqual(command.protocol_version, 1)
+
+    def test_heartbeat(self):
+        model = simulator.ChildModel(message_latency=0.01)
+        simulation = self._simulate(model=model, event_driven=True)
+        for command in simulation.master.get_all_commands():
+            command.heartbeat_interval = 1.0
+        simulation.cold_start()
+        simulation.advance(5.0)
+        stats = simulation.master.get_command("n3").round_trip_times.get_statistics()
+        self.failUnless(stats["count"] >= 4)
+        self.failUnlessApproximates(stats["ewma"], 0.01, 0.001)
+        self.failUnlessApproximates(stats["p99"], 0.01, 0.001)
+        self.failUnlessEqual(stats["timeouts"], 0)
+        latencies = simulation.master.get_latencies()
+        self.failUnlessEqual(latencies[None]["commands"], 20)
+        self.failUnlessApproximates(latencies[None]["ewma"], 0.01, 0.001)
+        # a hung lunch-slave is killed, and the master starts a new one:
+        simulation.freeze_slaves(["n7"])
+        command = simulation.master.get_command("n7")
+        # detected between 3 and 4 seconds later, depending on when the last ping was sent:
+        detection_time = simulation.run_until(lambda: command.round_trip_times.timeouts == 1, 10.0)
+        self.failUnless(3.0 <= detection_time <= 4.0)
+        self.failIfEqual(simulation.run_until(simulation.all_running, 10.0), None)
+        self.failUnlessEqual(command.how_many_times_run, 2)
+        self.failIf(simulation.slaves["n7"].frozen)
+
+class Test_Round_Trip_Times(unittest.TestCase):
+    def test_statistics(self):
+        rtt = commands.RoundTripTimes()
+        self.failUnlessEqual(rtt.get_statistics()["p99"], None)
+        for i in range(1, 101):
+            rtt.add(i / 100.0)
+        stats = rtt.get_statistics()
+        self.failUnlessEqual(stats["last"], 1.0)
+        self.failUnlessEqual(stats["p99"], 0.99)
+        self.failUnlessEqual(stats["count"], 100)
+        self.failUnless(0.5 < stats["ewma"] < 1.0)
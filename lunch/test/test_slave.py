@@ -1,7 +1,32 @@
 """
 Test cases for the lunch-slave process.
 """
+import os
+import sys
+import imp
+import gzip
 from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer
+from twisted.internet import task
+
+def get_slave_script_path():
+    """
+    Returns the path to the lunch-slave script of this source tree.
+    """
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "scripts", "lunch-slave")
+
+def load_slave_script():
+    """
+    Imports the lunch-slave script as a module.
+    """
+    path = get_slave_script_path()
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True # no scripts/lunch-slavec file
+    try:
+        return imp.load_source("lunch_slave", path)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
 
 class Test_Slave(unittest.TestCase):
     pass
@@ -32,3 +57,206 @@ class Test_Slave(unittest.TestCase):
 #    test_stop.skip = "TODO"
 #    test_help.skip = "TODO"
 #    test_quit.skip = "TODO"
+
+class Test_Multi_Slave(unittest.TestCase):
+    def setUp(self):
+        self.module = load_slave_script()
+        self.slave_io = self.module.MultiSlaveIO()
+        self.transport = proto_helpers.StringTransport()
+        self.slave_io.makeConnection(self.transport)
+
+    def tearDown(self):
+        for child_io in self.slave_io.children.values():
+            child_io.slave.close()
+
+    def _send(self, line):
+        self.transport.clear()
+        self.slave_io.dataReceived(line + "\n")
+        return self.transport.value().splitlines()
+
+    def test_children(self):
+        self.failUnless("* ready" in self.transport.value().splitlines())
+        self.failUnlessEqual(self._send("* ping"), ["* pong"])
+        self.failUnlessEqual(self._send("* add a"), ["a ready 2"])
+        self.failUnlessEqual(self._send("a ping"), ["a pong"])
+        # created when first used:
+        self.failUnlessEqual(self._send("b status"), ["b ready 2", "b status STOPPED"])
+        self.failUnlessEqual(self._send("* list"), ["a status STOPPED", "b status STOPPED"])
+        self.failUnlessEqual(self._send("a quit"), ["a bye Exiting lunch-slave."])
+        self.failUnlessEqual(self.slave_io.children.keys(), ["b"])
+        self.failUnlessEqual(self._send("* foo"), ["* error foo no such command."])
+
+class Test_Direct_Exec(unittest.TestCase):
+    def setUp(self):
+        self.module = load_slave_script()
+
+    def test_split_command(self):
+        split_command = self.module.split_command
+        self.failUnlessEqual(split_command("xeyes -geometry 100x100"), ["xeyes", "-geometry", "100x100"])
+        self.failUnlessEqual(split_command("echo 'two words'"), ["echo", "two words"])
+        for command in ["ls | wc", "echo $HOME", "ls *.py", "cat < a", "sleep 1; ls", "FOO=1 xeyes", "cd /tmp", "echo 'unclosed", ""]:
+            self.failUnlessEqual(split_command(command), None)
+
+    def test_which(self):
+        which = self.module.which
+        self.failUnlessEqual(which("sh", "/nowhere:/bin"), "/bin/sh")
+        self.failUnless(("sh", "/nowhere:/bin") in self.module._which_cache)
+        self.failUnlessEqual(which("/bin/sh", ""), "/bin/sh")
+        self.failUnlessEqual(which("no-such-executable", "/bin"), None)
+
+class Test_Log_Writer(unittest.TestCase):
+    def setUp(self):
+        self.module = load_slave_script()
+        self.path = self.mktemp()
+        self.clock = task.Clock()
+
+    def _read(self):
+        return open(self.path).read()
+
+    def test_interval(self):
+        writer = self.module.LogWriter(self.path, "interval", 0.1, clock=self.clock)
+        writer.write_lines(["a", "b"])
+        writer.write_lines(["", "c"])
+        self.failUnlessEqual(self._read(), "")
+        self.clock.advance(0.1)
+        self.failUnlessEqual(self._read(), "a\nb\n\nc\n")
+        self.failUnlessEqual(writer.writes, 1)
+        self.failUnlessEqual(self.clock.getDelayedCalls(), []) # nothing to do while idle
+        writer.close()
+        stats = writer.get_statistics()
+        self.failUnlessEqual((stats["lines"], stats["bytes"], stats["writes"]), (4, 7, 1))
+        self.failUnless(stats["lines_per_second"] > 0)
+
+    def test_size(self):
+        writer = self.module.LogWriter(self.path, "size", buffer_size=10, clock=self.clock)
+        writer.write_lines(["1234"])
+        self.clock.advance(10)
+        self.failUnlessEqual(self._read(), "")
+        writer.write_lines(["56789"])
+        self.failUnlessEqual(self._read(), "1234\n56789\n")
+        writer.write_lines(["end"])
+        writer.close()
+        self.failUnlessEqual(self._read(), "1234\n56789\nend\n")
+        self.failUnlessEqual(writer.writes, 2)
+        self.failUnlessEqual(oct(os.stat(self.path).st_mode & 0777), "0600")
+
+    def test_fsync_on_exit(self):
+        writer = self.module.LogWriter(self.path, "fsync-on-exit", clock=self.clock)
+        writer.write_lines(["a"])
+        self.failUnlessEqual(self._read(), "")
+        writer.close()
+        self.failUnlessEqual(self._read(), "a\n")
+        self.failUnlessRaises(self.module.SlaveError, self.module.LogWriter, self.path, "never")
+
+class Test_Log_Rotation(unittest.TestCase):
+    def setUp(self):
+        self.module = load_slave_script()
+        self.path = os.path.abspath(self.mktemp())
+        self.clock = task.Clock()
+
+    def _read_gzip(self, path):
+        f = gzip.open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    @defer.inlineCallbacks
+    def test_max_size(self):
+        writer = self.module.LogWriter(self.path, "size", buffer_size=1, clock=self.clock, max_size=10, generations=2)
+        for i in range(3):
+            writer.write_lines(["run %d" % (i), "more"])
+            yield writer.rotation
+        writer.write_lines(["short"])
+        writer.close()
+        self.failUnlessEqual(open(self.path).read(), "short\n")
+        self.failUnlessEqual(self._read_gzip(self.path + ".1.gz"), "run 2\nmore\n")
+        self.failUnlessEqual(self._read_gzip(self.path + ".2.gz"), "run 1\nmore\n")
+        self.failIf(os.path.exists(self.path + ".3.gz"))
+        self.failUnlessEqual([name for name in os.listdir(os.path.dirname(self.path)) if name.endswith(".rotating")], [])
+
+    @defer.inlineCallbacks
+    def test_max_age(self):
+        writer = self.module.LogWriter(self.path, "size", buffer_size=1, clock=self.clock, max_age=60.0, generations=1, compress=False)
+        writer.write_lines(["old"])
+        self.failUnlessEqual(writer.rotation, None)
+        self.clock.advance(60.0)
+        writer.write_lines(["older than a minute"])
+        yield writer.rotation
+        writer.close()
+        self.failUnlessEqual(open(self.path + ".1").read(), "old\nolder than a minute\n")
+        self.failUnlessEqual(open(self.path).read(), "")
+
+    @defer.inlineCallbacks
+    def test_no_generation(self):
+        writer = self.module.LogWriter(self.path, "size", buffer_size=1, clock=self.clock, max_size=1)
+        writer.write_lines(["dropped"])
+        yield writer.rotation
+        writer.close()
+        self.failUnlessEqual(os.listdir(os.path.dirname(self.path)), [os.path.basename(self.path)])
+
+class Test_Output_Ring(unittest.TestCase):
+    def test_bounds(self):
+        ring = load_slave_script().OutputRing(max_lines=3, max_bytes=12)
+        ring.add(["a", "b"])
+        self.failUnlessEqual(ring.get_lines(), ["a", "b"])
+        ring.add(["c", "d"])
+        self.failUnlessEqual(ring.get_lines(), ["b", "c", "d"])
+        self.failUnlessEqual(ring.get_lines(2), ["c", "d"])
+        self.failUnlessEqual(ring.get_lines(0), [])
+        ring.add(["0123456789"]) # 11 bytes with its newline
+        self.failUnlessEqual(ring.get_lines(), ["0123456789"])
+        ring.add(["a much longer line than the limit"])
+        self.failUnlessEqual(len(ring), 1) # the last line is always kept
+
+class FakeSlaveIO(object):
+    """
+    Records what an L{OutputForwarder} sends.
+    """
+    def __init__(self):
+        self.lines = []
+        self.frames = []
+
+    def send_output(self, lines):
+        self.lines.extend(lines)
+
+    def send_frame(self, key, text="", fields=None):
+        self.frames.append((key, fields))
+
+class Test_Output_Forwarder(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.slave_io = FakeSlaveIO()
+
+    def test_rate(self):
+        forwarder = load_slave_script().OutputForwarder(self.slave_io, rate=10.0, max_lines=100, clock=self.clock)
+        forwarder.add([str(i) for i in range(25)])
+        self.failUnlessEqual(len(self.slave_io.lines), 10) # one second worth of lines at once
+        self.clock.advance(0.5)
+        self.failUnlessEqual(len(self.slave_io.lines), 15)
+        self.clock.pump([0.5, 0.5])
+        self.failUnlessEqual(self.slave_io.lines, [str(i) for i in range(25)])
+        self.failUnlessEqual(self.clock.getDelayedCalls(), [])
+
+    def test_summarize(self):
+        forwarder = load_slave_script().OutputForwarder(self.slave_io, rate=0, max_lines=3, clock=self.clock)
+        forwarder.pauseProducing()
+        forwarder.add(["a", "b"])
+        forwarder.add(["c", "d", "e"])
+        self.failUnlessEqual(self.slave_io.lines, [])
+        forwarder.resumeProducing()
+        self.failUnlessEqual(self.slave_io.lines, ["a", "b", "c"])
+        self.failUnlessEqual(self.slave_io.frames, [("output_dropped", {"count": 2})])
+        self.failUnlessEqual(forwarder.lines_dropped, 2)
+        forwarder.add(["f"])
+        self.failUnlessEqual(self.slave_io.lines, ["a", "b", "c", "f"])
+        self.failUnlessEqual(len(self.slave_io.frames), 1)
+
+    def test_drop(self):
+        forwarder = load_slave_script().OutputForwarder(self.slave_io, rate=0, max_lines=1, policy="drop", clock=self.clock)
+        forwarder.pauseProducing()
+        forwarder.add(["a", "b"])
+        forwarder.resumeProducing()
+        self.failUnlessEqual(self.slave_io.lines, ["a"])
+        self.failUnlessEqual(self.slave_io.frames, [])
+        self.failUnlessEqual(forwarder.lines_dropped, 1)
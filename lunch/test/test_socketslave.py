@@ -0,0 +1,119 @@
+"""
+Tests for the lunch-slave daemon, reached through a socket.
+"""
+import os
+import sys
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from lunch import commands
+from lunch import master
+from lunch import socketslave
+from lunch.states import *
+from lunch.test.test_slave import get_slave_script_path
+
+master.start_stdout_logging("warning")
+
+class DaemonProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self):
+        self.ended = defer.Deferred()
+        self.output = ""
+
+    def outReceived(self, data):
+        self.output += data
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+def wait_until(predicate, interval=0.02):
+    """
+    Returns a Deferred fired once the predicate returns True.
+    """
+    d = defer.Deferred()
+    def _check():
+        if predicate():
+            d.callback(None)
+        else:
+            reactor.callLater(interval, _check)
+    _check()
+    return d
+
+class Test_Parse_Address(unittest.TestCase):
+    def test_addresses(self):
+        self.assertEqual(socketslave.parse_address("unix:/tmp/lunch.sock"), ("unix", "/tmp/lunch.sock"))
+        self.assertEqual(socketslave.parse_address("tcp:7777"), ("tcp", ("127.0.0.1", 7777)))
+        self.assertEqual(socketslave.parse_address("tcp:example.org:7777"), ("tcp", ("example.org", 7777)))
+        for address in ["unix:", "tcp:", "tcp:example.org", "udp:7777", "/tmp/lunch.sock"]:
+            self.assertRaises(ValueError, socketslave.parse_address, address)
+        self.assertRaises(ValueError, commands.Command, "xeyes", slave_address="nowhere")
+
+class Test_Daemon(unittest.TestCase):
+    timeout = 20
+    grace = 0.0 # of the daemon
+
+    def setUp(self):
+        self.socket_path = os.path.abspath(self.mktemp())
+        self.daemon = DaemonProcessProtocol()
+        args = [sys.executable, get_slave_script_path(), "--listen", "unix:" + self.socket_path, "--grace", str(self.grace)]
+        reactor.spawnProcess(self.daemon, args[0], args, os.environ, usePTY=False)
+        return wait_until(lambda: os.path.exists(self.socket_path))
+
+    def tearDown(self):
+        self.daemon.transport.signalProcess(15)
+        return self.daemon.ended
+
+    @defer.inlineCallbacks
+    def test_sessions(self):
+        log_dir = os.path.abspath(self.mktemp())
+        # The daemon outlives each session:
+        for i in range(2):
+            command = commands.Command("sleep 30", identifier="sleeper%d" % (i), log_dir=log_dir, slave_address="unix:" + self.socket_path)
+            command.start()
+            yield wait_until(lambda: command.child_state == STATE_RUNNING)
+            self.assertEqual(command.protocol_version, 2)
+            self.assertTrue(command.child_pid is not None)
+            command.stop()
+            yield wait_until(lambda: command.child_state == STATE_STOPPED)
+            yield command.quit_slave()
+            self.assertEqual(command.slave_state, STATE_STOPPED)
+            self.assertTrue(os.path.exists(os.path.join(log_dir, "child-sleeper%d.log" % (i))))
+
+    @defer.inlineCallbacks
+    def test_connection_refused(self):
+        command = commands.Command("sleep 30", identifier="sleeper", log_dir=os.path.abspath(self.mktemp()), slave_address="unix:" + self.socket_path + ".nothing")
+        command.start()
+        yield wait_until(lambda: command.slave_state == STATE_STOPPED)
+        self.assertEqual(command.child_state, STATE_STOPPED)
+
+class Test_Reattach(Test_Daemon):
+    grace = 10.0
+
+    @defer.inlineCallbacks
+    def test_reattach(self):
+        command = commands.Command("sleep 30", identifier="sleeper", log_dir=os.path.abspath(self.mktemp()), slave_address="unix:" + self.socket_path, reattach=True)
+        command.start()
+        yield wait_until(lambda: command.child_state == STATE_RUNNING)
+        pid = command.child_pid
+        # Lose the connection, as if the network went down:
+        command._process_transport.loseConnection()
+        yield wait_until(lambda: command.slave_state == STATE_STOPPED)
+        self.assertEqual(command.child_state, STATE_STOPPED)
+        command.start()
+        yield wait_until(lambda: command.child_state == STATE_RUNNING)
+        self.assertEqual(command.child_pid, pid)
+        self.assertEqual(command.how_many_times_run, 1)
+        command.stop()
+        yield wait_until(lambda: command.child_state == STATE_STOPPED)
+        yield command.quit_slave()
+
+    @defer.inlineCallbacks
+    def test_proxy(self):
+        proxy = DaemonProcessProtocol()
+        args = [sys.executable, get_slave_script_path(), "--proxy", "unix:" + self.socket_path]
+        reactor.spawnProcess(proxy, args[0], args, os.environ, usePTY=False)
+        proxy.transport.write("attach nobody\n")
+        yield wait_until(lambda: "not_attached nobody" in proxy.output)
+        self.assertTrue(proxy.output.startswith("msg "))
+        proxy.transport.closeStdin()
+        yield proxy.ended
@@ -0,0 +1,103 @@
+"""
+Tests for the SSH connections shared between the lunch-slaves of a host.
+"""
+import os
+from twisted.trial import unittest
+from twisted.internet import task
+from lunch import commands
+from lunch import master
+from lunch.test.fakes import NoLoggerCommand
+
+master.start_stdout_logging("warning")
+
+FAKE_SSH = """#!/bin/sh
+# Stands for ssh: logs its arguments, and removes the control socket on "-O exit".
+echo "$@" >> %(log)s
+for arg in "$@"; do
+    case "$arg" in
+        ControlPath=*) rm -f "${arg#ControlPath=}" ;;
+    esac
+done
+"""
+
+class CapturingCommand(NoLoggerCommand):
+    """
+    Does not spawn any process, but keeps the command line of its lunch-slave.
+    """
+    def _spawn_slave(self, args, environ):
+        self.spawned_args = args
+        return None
+
+class Test_SSH_Pool(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.pool = commands.SSHConnectionPool(directory=self.directory, persist=30)
+
+    def _fake_connect(self, host, user=None, ssh_port=None):
+        # What the ssh process would do: create the control socket.
+        open(self.pool.get_control_path(host, user, ssh_port), "w").close()
+
+    def test_hits_and_misses(self):
+        options, hit = self.pool.prepare("example.org", "bob", 2222)
+        self.assertFalse(hit)
+        self.assertTrue(os.path.isdir(self.directory))
+        self.assertTrue("ControlMaster=auto" in options)
+        self.assertTrue("ControlPersist=30" in options)
+        self.assertTrue("ControlPath=%s" % (self.pool.get_control_path("example.org", "bob", 2222)) in options)
+        self._fake_connect("example.org", "bob", 2222)
+        options, hit = self.pool.prepare("example.org", "bob", 2222)
+        self.assertTrue(hit)
+        options, hit = self.pool.prepare("example.org", "alice", 2222)
+        self.assertFalse(hit)
+        self.pool.record_setup_time(False, 1.0)
+        self.pool.record_setup_time(False, 2.0)
+        self.pool.record_setup_time(True, 0.25)
+        stats = self.pool.get_statistics()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["mean_miss_setup_time"], 1.5)
+        self.assertEqual(stats["mean_hit_setup_time"], 0.25)
+
+    def test_long_control_path(self):
+        path = self.pool.get_control_path("a" * 200)
+        self.assertTrue(len(path) <= len(self.directory) + 33)
+
+    def test_command_line(self):
+        args = commands.get_slave_command_line("example.org", None, None, ["--id", "x"], ["-o", "ControlMaster=auto"])
+        self.assertEqual(args, ["ssh", "-o", "ControlMaster=auto", "example.org", "lunch-slave", "--id", "x"])
+
+    def test_command_setup_time(self):
+        clock = task.Clock()
+        command = CapturingCommand("xeyes", identifier="xeyes", host="example.org", clock=clock)
+        command.ssh_pool = self.pool
+        command.start()
+        self.assertTrue("ControlMaster=auto" in command.spawned_args)
+        self.assertEqual(command.spawned_args[0], "ssh")
+        clock.advance(1.5)
+        command.enabled = False # so that it does not send anything to the missing lunch-slave
+        command.recv_ready("")
+        stats = self.pool.get_statistics()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["miss_setup_time"], 1.5)
+
+    def test_close_all(self):
+        log_file = os.path.abspath(self.mktemp())
+        fake_ssh = os.path.abspath(self.mktemp())
+        f = open(fake_ssh, "w")
+        f.write(FAKE_SSH % {"log": log_file})
+        f.close()
+        os.chmod(fake_ssh, 0755)
+        self.pool.ssh_executable = fake_ssh
+        self.pool.prepare("example.org", None, 2222)
+        self._fake_connect("example.org", None, 2222)
+        self.pool.prepare("example.com") # never connected
+        def _check(result):
+            self.assertFalse(self.pool.is_connected("example.org", None, 2222))
+            lines = open(log_file).read().splitlines()
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith("-O exit"))
+            self.assertTrue(lines[0].endswith("-p 2222 example.org"))
+            self.assertEqual(self.pool.keys, set())
+        d = self.pool.close_all()
+        d.addCallback(_check)
+        return d
@@ -0,0 +1,37 @@
+"""
+Tests for the heap of deadlines used by the master.
+"""
+from twisted.trial import unittest
+from lunch import timers
+
+class Test_Timer_Heap(unittest.TestCase):
+    def test_earliest(self):
+        heap = timers.TimerHeap()
+        self.failUnlessEqual(heap.get_earliest(), None)
+        heap.schedule("a", 3.0)
+        heap.schedule("b", 1.0)
+        heap.schedule("c", 2.0)
+        self.failUnlessEqual(heap.get_earliest(), 1.0)
+        self.failUnlessEqual(len(heap), 3)
+
+    def test_pop_expired(self):
+        heap = timers.TimerHeap()
+        heap.schedule("a", 3.0)
+        heap.schedule("b", 1.0)
+        heap.schedule("c", 2.0)
+        self.failUnlessEqual(heap.pop_expired(2.0), ["b", "c"])
+        self.failUnlessEqual(heap.pop_expired(2.5), [])
+        self.failUnlessEqual(heap.get_earliest(), 3.0)
+        self.failIf("b" in heap)
+
+    def test_replace_and_cancel(self):
+        heap = timers.TimerHeap()
+        heap.schedule("a", 1.0)
+        heap.schedule("b", 2.0)
+        heap.schedule("a", 5.0) # replaces the first deadline
+        self.failUnlessEqual(heap.get_earliest(), 2.0)
+        heap.cancel("b")
+        self.failUnlessEqual(heap.get_earliest(), 5.0)
+        self.failUnlessEqual(heap.pop_expired(4.0), [])
+        self.failUnlessEqual(heap.pop_expired(5.0), ["a"])
+        self.failUnlessEqual(len(heap), 0)
@@ -0,0 +1,127 @@
+"""
+Tests for the lunch-slaves started in advance.
+"""
+import os
+import sys
+import json
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import failure
+from lunch import master
+from lunch import warmpool
+from lunch.states import *
+from lunch.test.test_slave import get_slave_script_path
+from lunch.test.test_protocol import LocalScriptCommand
+from lunch.test.fakes import NoLoggerCommand
+from lunch.test.fakes import SpawnRecorder
+
+master.start_stdout_logging("warning")
+
+class FakePool(SpawnRecorder, warmpool.WarmSlavePool):
+    def get_spawned_slaves(self):
+        """
+        @rtype: C{list} of L{lunch.warmpool.WarmSlave}
+        """
+        return [process_protocol.warm_slave for process_protocol, args in self.spawned]
+
+class Test_Warm_Pool(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = FakePool(size=1, idle_timeout=30.0, clock=self.clock)
+        self.command = NoLoggerCommand("xeyes", identifier="xeyes", host="example.org", clock=self.clock)
+        self.command.warm_pool = self.pool
+
+    def _ready(self, warm_slave):
+        warm_slave.process_protocol.outReceived("msg Welcome\r\nready 2\r\n")
+
+    def test_take(self):
+        # the first time, there is nothing to take, but the pool starts one:
+        self.assertEqual(self.pool.take(self.command, None), None)
+        self.assertEqual(len(self.pool.spawned), 1)
+        warm_slave = self.pool.get_spawned_slaves()[0]
+        self.assertEqual(warm_slave.args, ["ssh", "example.org", "lunch-slave"])
+        self.assertEqual(self.pool.get_idle_count(), 0)
+        self._ready(warm_slave)
+        self.assertEqual(self.pool.get_idle_count(), 1)
+        # the command takes it:
+        self.command.start()
+        self.assertEqual(self.command._process_transport, warm_slave.transport)
+        self.assertEqual(self.command.slave_state, STATE_RUNNING)
+        self.assertEqual(len(self.pool.spawned), 2) # refilled
+        self.clock.advance(0)
+        key, sep, mess = warm_slave.transport.lines[-1].partition(" ")
+        self.assertEqual(key, "start")
+        self.assertEqual(json.loads(mess)["identifier"], "xeyes")
+        # what the lunch-slave sends now goes to the command:
+        warm_slave.process_protocol.outReceived('state {"state": "RUNNING"}\n')
+        self.assertEqual(self.command.child_state, STATE_RUNNING)
+        warm_slave.process_protocol.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.assertEqual(self.command.slave_state, STATE_STOPPED)
+        self.assertEqual(self.pool.statistics["hits"], 1)
+        self.assertEqual(self.pool.statistics["misses"], 1)
+
+    def test_idle_timeout(self):
+        self.pool.take(self.command, None)
+        warm_slave = self.pool.get_spawned_slaves()[0]
+        self._ready(warm_slave)
+        self.clock.advance(31.0)
+        self.assertEqual(self.pool.statistics["expired"], 1)
+        self.assertEqual(warm_slave.transport.lines, ["quit"])
+        self.assertTrue(warm_slave.transport.closed)
+        self.assertEqual(self.pool.get_idle_count(), 0)
+        self.assertEqual(len(self.pool.spawned), 1) # not refilled until a command takes one
+
+    def test_close(self):
+        self.pool.take(self.command, None)
+        warm_slave = self.pool.get_spawned_slaves()[0]
+        self._ready(warm_slave)
+        d = self.pool.close()
+        self.assertEqual(warm_slave.transport.lines, ["quit"])
+        warm_slave.process_protocol.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.assertTrue(d.called)
+
+class LocalScriptPool(warmpool.WarmSlavePool):
+    """
+    Runs the lunch-slave script of this source tree.
+    """
+    def _spawn(self, process_protocol, args, environ, use_pty=True):
+        args = [sys.executable, get_slave_script_path()] + args[1:]
+        return reactor.spawnProcess(process_protocol, args[0], args, environ, usePTY=use_pty)
+
+class Test_Warm_Pool_Process(unittest.TestCase):
+    timeout = 20
+
+    def _wait_until(self, predicate):
+        d = defer.Deferred()
+        def _check():
+            if predicate():
+                d.callback(None)
+            else:
+                reactor.callLater(0.02, _check)
+        _check()
+        return d
+
+    @defer.inlineCallbacks
+    def test_respawn_with_warm_slave(self):
+        pool = LocalScriptPool(size=1)
+        log_dir = os.path.abspath(self.mktemp())
+        command = LocalScriptCommand("sleep 30", identifier="sleeper", log_dir=log_dir, use_pty=False)
+        command.warm_pool = pool
+        # Its first lunch-slave is started by the command, which is a miss.
+        # Its second one was started in advance by the pool.
+        for i in range(2):
+            command.start()
+            yield self._wait_until(lambda: command.child_state == STATE_RUNNING)
+            command.stop()
+            yield self._wait_until(lambda: command.child_state == STATE_STOPPED)
+            yield command.quit_slave()
+            command._quit_slave_deferred = None
+            yield self._wait_until(lambda: pool.get_idle_count() == 1)
+        self.assertEqual(pool.statistics["hits"], 1)
+        self.assertEqual(pool.statistics["misses"], 1)
+        self.assertTrue(os.path.exists(os.path.join(log_dir, "child-sleeper.log")))
+        self.assertFalse(os.path.exists(os.path.join(log_dir, "child-default.log")))
+        yield pool.close()
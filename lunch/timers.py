@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Min-heap of deadlines, used by the master to wake up exactly when 
+something has to be done, instead of comparing times at every iteration.
+"""
+import heapq
+import itertools
+
+class TimerHeap(object):
+    """
+    Deadlines, each identified by a key, sorted so that the earliest one is 
+    always known.
+
+    Scheduling a deadline for a key that already has one replaces it. 
+    Replaced and cancelled entries are left in the heap and skipped when 
+    they reach its top.
+    """
+    def __init__(self):
+        self._heap = [] # list of (time, sequence number, key) tuples.
+        self._deadlines = {} # dict key: time
+        self._sequence = itertools.count() # so that keys are never compared
+
+    def schedule(self, key, when):
+        """
+        Sets the deadline for a key.
+        @param key: Any hashable.
+        @param when: Time, in seconds since the epoch.
+        @type when: C{float}
+        """
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, self._sequence.next(), key))
+
+    def cancel(self, key):
+        """
+        Removes the deadline for a key, if it has one.
+        """
+        self._deadlines.pop(key, None)
+
+    def get_deadline(self, key):
+        """
+        Returns the deadline for a key, or None.
+        """
+        return self._deadlines.get(key)
+
+    def get_earliest(self):
+        """
+        Returns the earliest deadline, or None if there is none.
+        @rtype: C{float}
+        """
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_expired(self, now):
+        """
+        Removes and returns the keys whose deadline is not later than now.
+        @param now: Current time.
+        @rtype: C{list}
+        """
+        ret = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            when, sequence, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            ret.append(key)
+        return ret
+
+    def clear(self):
+        """
+        Removes all the deadlines.
+        """
+        self._heap = []
+        self._deadlines = {}
+
+    def _discard_stale(self):
+        """
+        Pops the entries at the top of the heap that were replaced or cancelled.
+        """
+        heap = self._heap
+        while heap:
+            when, sequence, key = heap[0]
+            if self._deadlines.get(key) == when:
+                break
+            heapq.heappop(heap)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Keeps idle lunch-slaves ready to be given to the commands of a host.
+
+Starting a lunch-slave costs the startup of Python and Twisted, and of SSH
+for remote hosts. A L{WarmSlavePool} starts some in advance. Once one has 
+said "ready", a command that needs a lunch-slave takes it right away, and 
+tells it its identifier. The pool then starts another one in the background.
+
+An idle lunch-slave quits once it has waited for idle_timeout seconds. The 
+pool only starts new ones for a host when one of its commands takes one.
+"""
+import os
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+
+from lunch import commands
+from lunch import logger
+
+log = logger.start(name='warmpool')
+
+class WarmSlaveProcessProtocol(protocol.ProcessProtocol):
+    """
+    Process of an idle lunch-slave. 
+    
+    Waits for its "ready" line, and then forwards everything to the process 
+    protocol of the command that took it.
+    """
+    def __init__(self, warm_slave):
+        self.warm_slave = warm_slave
+        self.target = None # L{lunch.commands.SlaveProcessProtocol} of the command, once taken.
+        self._buffer = "" # lines not given to the command yet
+
+    def outReceived(self, data):
+        if self.target is not None:
+            self.target.outReceived(data)
+            return
+        self._buffer += data
+        while not self.warm_slave.ready and "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            words = line.strip().split(" ")
+            if words[0] == "ready":
+                version = 1
+                if len(words) > 1 and words[1].isdigit():
+                    version = int(words[1])
+                self.warm_slave._on_ready(version)
+
+    def errReceived(self, data):
+        if self.target is not None:
+            self.target.errReceived(data)
+        else:
+            for line in data.splitlines():
+                if line.strip() != "":
+                    log.debug("Idle lunch-slave %s> stderr: %s" % (self.warm_slave, line))
+
+    def processEnded(self, reason):
+        if self.target is not None:
+            self.target.processEnded(reason)
+        else:
+            self.warm_slave._on_process_ended()
+
+class WarmSlave(object):
+    """
+    A lunch-slave started in advance, not given to any command yet.
+    """
+    def __init__(self, pool, key, args):
+        """
+        @param pool: L{WarmSlavePool}
+        @param key: (host, user, ssh_port, use_pty) tuple.
+        @param args: Command line of the lunch-slave.
+        """
+        self.pool = pool
+        self.key = key
+        self.args = args
+        self.ready = False
+        self.ended = False
+        self.version = 1 # of the protocol, from its "ready" line.
+        self.process_protocol = WarmSlaveProcessProtocol(self)
+        self.transport = None
+        self._idle_call = None # DelayedCall to quit it when it waited for too long.
+        self._ended_deferreds = []
+
+    def start(self):
+        environ = {}
+        environ.update(os.environ) # passing the whole env (for SSH keys and more)
+        log.info("Idle lunch-slave %s> $ %s" % (self, " ".join(self.args)))
+        self.transport = self.pool._spawn(self.process_protocol, self.args, environ, self.key[3])
+
+    def take(self, process_protocol):
+        """
+        Gives this lunch-slave to a command. 
+        It connects it, and tells it this lunch-slave is ready in the next iteration.
+        @param process_protocol: L{lunch.commands.SlaveProcessProtocol} of the command.
+        @return: The transport of the process.
+        """
+        self._cancel_idle_call()
+        self.process_protocol.target = process_protocol
+        process_protocol.makeConnection(self.transport)
+        leftover = self.process_protocol._buffer
+        self.process_protocol._buffer = ""
+        self.pool.clock.callLater(0, process_protocol.outReceived, "ready %d\n%s" % (self.version, leftover))
+        return self.transport
+
+    def quit(self):
+        """
+        Closes the stdin of this idle lunch-slave, which makes it quit.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        self._cancel_idle_call()
+        d = defer.Deferred()
+        if self.ended:
+            d.callback(None)
+            return d
+        self._ended_deferreds.append(d)
+        if self.transport is not None:
+            self.transport.write("quit\n")
+            self.transport.loseConnection()
+        return d
+
+    def _cancel_idle_call(self):
+        if self._idle_call is not None:
+            if self._idle_call.active():
+                self._idle_call.cancel()
+            self._idle_call = None
+
+    def _on_ready(self, version):
+        self.ready = True
+        self.version = version
+        if self.pool.idle_timeout > 0:
+            self._idle_call = self.pool.clock.callLater(self.pool.idle_timeout, self.pool._expire, self)
+        self.pool._on_ready(self)
+
+    def _on_process_ended(self):
+        self.ended = True
+        self._cancel_idle_call()
+        self.pool._forget(self)
+        for d in self._ended_deferreds:
+            d.callback(None)
+        self._ended_deferreds = []
+
+    def __str__(self):
+        host, user, ssh_port, use_pty = self.key
+        if host is None:
+            return "localhost"
+        elif user is None:
+            return host
+        return "%s@%s" % (user, host)
+
+class WarmSlavePool(object):
+    """
+    Keeps up to size idle lunch-slaves for each host, user, SSH port and transport.
+    """
+    def __init__(self, size=1, idle_timeout=60.0, clock=None):
+        """
+        @param size: How many idle lunch-slaves to keep for each host.
+        @param idle_timeout: Time after which an idle lunch-slave quits. 0 means never.
+        @param clock: Provider of twisted.internet.interfaces.IReactorTime. Defaults to the reactor.
+        """
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.clock = clock # IReactorTime provider, such as the reactor or a twisted.internet.task.Clock.
+        if clock is None:
+            self.clock = reactor
+        self.warm_slaves = {} # dict of key: list of L{WarmSlave}, ready or not.
+        self.statistics = {
+            "hits": 0, # commands that took an idle lunch-slave
+            "misses": 0, # commands that had to start their own
+            "spawned": 0, # lunch-slaves started by the pool
+            "expired": 0, # idle lunch-slaves that quit after idle_timeout
+            }
+
+    def take(self, command, process_protocol):
+        """
+        Gives an idle lunch-slave to a command, if one is ready. 
+        Starts new ones in the background, in both cases.
+        @param command: L{lunch.commands.Command}
+        @param process_protocol: L{lunch.commands.SlaveProcessProtocol} of the command.
+        @return: The transport of its process, or None if there is no idle lunch-slave ready.
+        """
+        key = (command.host, command.user, command.ssh_port, command.use_pty)
+        transport = None
+        for warm_slave in self.warm_slaves.get(key, []):
+            if warm_slave.ready and not warm_slave.ended:
+                self.warm_slaves[key].remove(warm_slave)
+                log.info("Giving idle lunch-slave %s to %s." % (warm_slave, command.identifier))
+                transport = warm_slave.take(process_protocol)
+                self.statistics["hits"] += 1
+                break
+        else:
+            self.statistics["misses"] += 1
+        self._fill(key, command.ssh_pool)
+        return transport
+
+    def get_idle_count(self, key=None):
+        """
+        Returns how many lunch-slaves are ready and idle, for a key or in total.
+        """
+        if key is None:
+            keys = self.warm_slaves.keys()
+        else:
+            keys = [key]
+        return len([warm_slave for k in keys for warm_slave in self.warm_slaves.get(k, []) if warm_slave.ready])
+
+    def close(self):
+        """
+        Makes all the idle lunch-slaves quit.
+        @rtype: L{twisted.internet.defer.DeferredList}
+        """
+        deferreds = []
+        for warm_slaves in self.warm_slaves.values():
+            for warm_slave in list(warm_slaves):
+                deferreds.append(warm_slave.quit())
+        self.warm_slaves = {}
+        return defer.DeferredList(deferreds)
+
+    def _fill(self, key, ssh_pool=None):
+        """
+        Starts lunch-slaves until there are size of them for a key.
+        """
+        host, user, ssh_port, use_pty = key
+        warm_slaves = self.warm_slaves.setdefault(key, [])
+        while len(warm_slaves) < self.size:
+            ssh_options = None
+            if host is not None and ssh_pool is not None:
+                ssh_options, hit = ssh_pool.prepare(host, user, ssh_port)
+            args = commands.get_slave_command_line(host, user, ssh_port, None, ssh_options, use_pty)
+            warm_slave = WarmSlave(self, key, args)
+            warm_slaves.append(warm_slave)
+            self.statistics["spawned"] += 1
+            try:
+                warm_slave.start()
+            except RuntimeError, e:
+                log.error("Could not start an idle lunch-slave: %s" % (e))
+                warm_slaves.remove(warm_slave)
+                break
+
+    def _on_ready(self, warm_slave):
+        log.debug("Idle lunch-slave %s is ready." % (warm_slave))
+
+    def _expire(self, warm_slave):
+        self.statistics["expired"] += 1
+        log.info("Idle lunch-slave %s waited for %s seconds. It quits." % (warm_slave, self.idle_timeout))
+        self._forget(warm_slave)
+        warm_slave._idle_call = None
+        warm_slave.quit()
+
+    def _forget(self, warm_slave):
+        warm_slaves = self.warm_slaves.get(warm_slave.key, [])
+        if warm_slave in warm_slaves:
+            warm_slaves.remove(warm_slave)
+
+    def _spawn(self, process_protocol, args, environ, use_pty=True):
+        """
+        Spawns an idle lunch-slave process.
+        """
+        return commands.spawn_slave_process(process_protocol, args, environ, use_pty)
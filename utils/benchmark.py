@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks for the dependencies graph and the scheduler of the Master.
+
+Builds synthetic graphs of several sizes and shapes, and times the
+operations the Master relies on. The results are written as JSON, so that
+they can be compared from one revision to another.
+
+Usage: ./utils/benchmark.py [-o results.json] [-s 10,100] [-r 3]
+
+The shapes are:
+ * wide: no dependency at all.
+ * chains: chains of CHAIN_LENGTH nodes, each depending on the previous one.
+ * diamonds: groups of four nodes, the bottom one depending on two others which depend on the top one.
+ * random: each node depends on 0 to 2 of the nodes added before it.
+
+The chains are bounded, since the cached ancestors and descendants of a
+single chain of 10000 nodes would need 50 million entries, and since
+get_all_dependees is recursive.
+"""
+import os
+import sys
+import time
+import json
+import random
+import platform
+from optparse import OptionParser
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.split(os.path.dirname(os.path.abspath(__file__)))[0])
+
+import lunch
+from lunch import graph
+from lunch import master
+from lunch.simulator import FakeCommand
+
+SIZES = [10, 100, 1000, 10000]
+SHAPES = ["wide", "chains", "diamonds", "random"]
+CHAIN_LENGTH = 100
+
+def make_nodes(shape, size, seed=0):
+    """
+    Returns the list of (node, deps) tuples of a synthetic graph.
+    """
+    rand = random.Random(seed)
+    ret = []
+    for i in range(size):
+        name = "n%d" % (i)
+        deps = None
+        if shape == "chains":
+            if i % CHAIN_LENGTH != 0:
+                deps = ["n%d" % (i - 1)]
+        elif shape == "diamonds":
+            top = i - i % 4
+            if i % 4 in [1, 2]:
+                deps = ["n%d" % (top)]
+            elif i % 4 == 3:
+                deps = ["n%d" % (top + 1), "n%d" % (top + 2)]
+        elif shape == "random":
+            deps = rand.sample(range(i), min(i, rand.randint(0, 2)))
+            deps = ["n%d" % (dep) for dep in deps]
+        elif shape != "wide":
+            raise ValueError("Unknown shape %s." % (shape))
+        ret.append((name, deps))
+    return ret
+
+def make_graph(nodes):
+    g = graph.DirectedGraph()
+    g.add_nodes(nodes)
+    return g
+
+def best_of(repeat, setup, func, teardown=None):
+    """
+    Calls setup(), func(setup result) and then teardown(setup result) the given number of times.
+    Returns the shortest duration of func, in seconds.
+    """
+    durations = []
+    for i in range(repeat):
+        data = setup()
+        begin = time.time()
+        func(data)
+        durations.append(time.time() - begin)
+        if teardown is not None:
+            teardown(data)
+    return min(durations)
+
+def _add_node_one_by_one(nodes):
+    g = graph.DirectedGraph()
+    for node, deps in nodes:
+        g.add_node(node, deps)
+
+def _iterate(g):
+    g._invalidate_order() # so that the launching order is not read from the cache
+    for node in graph.iter_from_root_to_leaves(g):
+        pass
+
+def _make_master(nodes, parallel_launch):
+    def _setup():
+        lunch_master = master.Master(parallel_launch=parallel_launch, event_driven=True)
+        lunch_master.add_commands([FakeCommand(node, deps) for node, deps in nodes])
+        return lunch_master
+    return _setup
+
+def _tick(lunch_master):
+    lunch_master._mark_all_dirty()
+    lunch_master.main_loop()
+
+def _cleanup(lunch_master):
+    lunch_master.cleanup()
+
+def _make_commands(nodes):
+    def _setup():
+        return (master.Master(event_driven=True), [FakeCommand(node, deps) for node, deps in nodes])
+    return _setup
+
+def _add_command_one_by_one(data):
+    lunch_master, commands = data
+    for command in commands:
+        lunch_master.add_command(command)
+
+def run_benchmarks(shapes=SHAPES, sizes=SIZES, repeat=3, verbose=False):
+    """
+    Runs all the benchmarks.
+    @rettype: list of dict
+    """
+    results = []
+    for shape in shapes:
+        for size in sizes:
+            nodes = make_nodes(shape, size)
+            benchmarks = [
+                ("add_node", lambda: nodes, _add_node_one_by_one, None),
+                ("add_nodes", lambda: nodes, make_graph, None),
+                ("get_all_dependees", lambda: make_graph(nodes), lambda g: g.get_all_dependees(), None),
+                ("iter_from_root_to_leaves", lambda: make_graph(nodes), _iterate, None),
+                ("master_add_command", _make_commands(nodes), _add_command_one_by_one, lambda data: _cleanup(data[0])),
+                ("main_loop_serial", _make_master(nodes, False), _tick, _cleanup),
+                ("main_loop_parallel", _make_master(nodes, True), _tick, _cleanup),
+                ]
+            for operation, setup, func, teardown in benchmarks:
+                seconds = best_of(repeat, setup, func, teardown)
+                results.append({
+                    "shape": shape,
+                    "size": size,
+                    "operation": operation,
+                    "seconds": seconds,
+                    "repeat": repeat,
+                    })
+                if verbose:
+                    print >> sys.stderr, "%-10s %6d %-26s %10.6f s" % (shape, size, operation, seconds)
+    return results
+
+def run():
+    parser = OptionParser(usage="%prog [options]", description="Times the dependencies graph and the scheduler of Lunch, and writes the results as JSON.")
+    parser.add_option("-o", "--output", type="string", help="Path of the JSON file to write. Default is the standard output.")
+    parser.add_option("-s", "--sizes", type="string", default=",".join([str(size) for size in SIZES]), help="Comma-separated numbers of nodes. Default is %default.")
+    parser.add_option("-S", "--shapes", type="string", default=",".join(SHAPES), help="Comma-separated shapes of graphs. Default is %default.")
+    parser.add_option("-r", "--repeat", type="int", default=3, help="How many times each operation is timed. The best time is kept. Default is %default.")
+    parser.add_option("-v", "--verbose", action="store_true", help="Prints the results on the standard error as they come.")
+    (options, args) = parser.parse_args()
+    master.start_stdout_logging("warning")
+    sizes = [int(size) for size in options.sizes.split(",")]
+    shapes = options.shapes.split(",")
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error("Unknown shape %s. Choose among %s." % (shape, ", ".join(SHAPES)))
+    data = {
+        "lunch_version": lunch.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": run_benchmarks(shapes, sizes, options.repeat, options.verbose),
+        }
+    if options.output is None:
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        f = open(options.output, "w")
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.close()
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simulates a Lunch Master with many commands, in virtual time.
+See L{lunch.simulator}.
+
+Starts all the commands, makes some of them crash, waits until they are
+all running again, and writes the measures as JSON.
+
+Usage: ./utils/simulate.py [-n 1000] [-S random] [-c 10] [-p] [-e]
+"""
+import os
+import sys
+import json
+from optparse import OptionParser
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.split(os.path.dirname(os.path.abspath(__file__)))[0])
+
+from lunch import master
+from lunch import simulator
+import benchmark # make_nodes
+
+def run():
+    parser = OptionParser(usage="%prog [options]", description="Simulates a Lunch Master with many commands, and writes the measures as JSON.")
+    parser.add_option("-n", "--commands", type="int", default=1000, help="How many commands to simulate. Default is %default.")
+    parser.add_option("-S", "--shape", type="string", default="random", help="Shape of the dependencies graph. One of %s. Default is %%default." % (", ".join(benchmark.SHAPES)))
+    parser.add_option("-c", "--crashes", type="int", default=10, help="How many children to crash once they are all running. Default is %default.")
+    parser.add_option("-s", "--seed", type="int", default=0, help="Seed of the random numbers. Default is %default.")
+    parser.add_option("-p", "--parallel", action="store_true", help="Enables the parallel launch.")
+    parser.add_option("-e", "--event-driven", action="store_true", help="Enables the event-driven scheduler.")
+    parser.add_option("-a", "--sleep-after", type="float", default=0.0, help="The sleep_after of each command. Default is %default.")
+    parser.add_option("-l", "--start-latency", type="float", default=0.1, help="Time for each child to be running. Default is %default.")
+    parser.add_option("-o", "--output", type="string", help="Path of the JSON file to write. Default is the standard output.")
+    (options, args) = parser.parse_args()
+    if options.shape not in benchmark.SHAPES:
+        parser.error("Unknown shape %s." % (options.shape))
+    master.start_stdout_logging("warning")
+    model = simulator.ChildModel(start_latency=options.start_latency)
+    simulation = simulator.Simulator(seed=options.seed, model=model, parallel_launch=options.parallel, event_driven=options.event_driven)
+    nodes = benchmark.make_nodes(options.shape, options.commands, options.seed)
+    simulation.add_commands([simulation.create_command(node, depends=deps, sleep_after=options.sleep_after) for node, deps in nodes])
+    simulation.cold_start()
+    crashed = simulation.random.sample([node for node, deps in nodes], min(options.crashes, len(nodes)))
+    simulation.inject_crashes(crashed)
+    simulation.recover()
+    data = simulation.get_report()
+    data.update({
+        "shape": options.shape,
+        "seed": options.seed,
+        "crashes": len(crashed),
+        "parallel_launch": bool(options.parallel),
+        "event_driven": bool(options.event_driven),
+        })
+    simulation.cleanup()
+    if options.output is None:
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        f = open(options.output, "w")
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.close()
+
+if __name__ == "__main__":
+    run()